@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import click
+import functools
 import numpy as np
 from matplotlib import pyplot as plt
 
@@ -13,13 +14,15 @@ import lib.plot as libplot
 import lib.debug as debug
 import lib.complex as complex
 import lib.utils as utils
+import lib.keyrank as keyrank
+import lib.keyenum as keyenum
+import lib.results as results
 
 import os
 from os import path
 from scipy import stats
 from scipy.stats import multivariate_normal, linregress, norm, pearsonr, entropy
 from scipy.stats import ttest_ind, f
-from scipy import signal
 import pickle
 import itertools
 import binascii
@@ -42,6 +45,8 @@ SAVE_IMAGES = None
 NUM_KEY_BYTES = None
 BRUTEFORCE = None
 BIT_BOUND_END = None
+BRUTEFORCE_JOBS = None
+BRUTEFORCE_CHECKPOINT = None
 PLAINTEXTS = None
 KEYS = None
 CIPHERTEXTS = None
@@ -70,15 +75,51 @@ TRACES_PROFILE = None
 LOG_PROBA = None
 COMPTYPE = None
 CUSTOM_DTYPE = None
-
-def load_data(subset, forced_profile = None):
+ALIGN_SUBSAMPLE = None
+ALIGN_CACHE = None
+ALIGN_KEY = None
+SAVE_LOG_PROBA = None
+RESULT = None
+RESULT_PATH = None
+PROFILE_STAGES = None
+SKIP_BAD = None
+# Validity bitmap of the loaded traces, or None if no trace is skipped.
+VALID = None
+# Floating-point type of the statistics of the traces (e.g. MEANS, VARS, RF).
+PRECISION = np.float64
+
+# Fields of the profile required by each attack algorithm.
+PROFILE_FIELDS = {"pcc": ["POIS", "MEANS", "MEAN_TRACE", "SAMP_RATE"], "pdf": ["POIS", "MEANS", "COVS", "MEAN_TRACE", "SAMP_RATE"]}
+
+def stage(name):
+    """Decorator recording the metrics of the decorated function as the NAME
+    stage of the result record."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if RESULT is None:
+                return func(*args, **kwargs)
+            with RESULT.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@stage("load")
+def load_data(subset, forced_profile = None, comps = None):
     """Load the data (keys, plaintexts, traces) into global variables. Must be
     called at the beginning of each @cli.command().
 
     :param forced_profile: If set to a path, use the profile under this directory.
+                           Its fields are loaded on demand by the caller.
+    :param comps: If set to a list of component types, derive all of them from
+                  the same loaded traces and return a dictionary of traces
+                  indexed by component, TRACES being set to the first one.
 
     """
-    global DATASET, SUBSET, PROFILE, PLAINTEXTS, KEYS, FIXED_KEY, TRACES, CIPHERTEXTS, NUM_TRACES, START_POINT, END_POINT, NORM, NORM2
+    global DATASET, SUBSET, PROFILE, PLAINTEXTS, KEYS, FIXED_KEY, TRACES, CIPHERTEXTS, NUM_TRACES, START_POINT, END_POINT, NORM, NORM2, ALIGN_KEY, VALID
+    # NOTE: RESULT is None outside of the click group (e.g. bench.py).
+    if RESULT is not None:
+        RESULT.set_config(click.get_current_context().params)
     # The original generic_load() function used in Screaming Channels implies that:
     # - FIXED_KEY should be a bool.
     # - PLAINTEXTS and KEYS should be a list of list of int read from hex
@@ -89,7 +130,22 @@ def load_data(subset, forced_profile = None):
     DATASET = dataset.Dataset.pickle_load(DATASET_PATH)
     assert(DATASET)
     SUBSET = DATASET.get_subset(subset)
-    SUBSET.load_trace(range(0, NUM_TRACES), nf=False, ff=True, start_point=START_POINT, end_point=END_POINT, custom_dtype=CUSTOM_DTYPE)
+    ALIGN_KEY = None
+    # NOTE: Use the bitmap of all traces, such that it does not depend on
+    # the number of loaded traces.
+    VALID = SUBSET.get_valid() if SKIP_BAD else None
+    if VALID is not None and VALID.all():
+        VALID = None
+    elif VALID is not None:
+        l.LOGGER.info("Skip {} invalid traces".format(np.count_nonzero(~VALID[:NUM_TRACES if NUM_TRACES > 0 else len(VALID)])))
+    # NOTE: Traces saved using our custom dtype are loaded directly as their
+    # components, without the np.complex64 intermediate.
+    fused = CUSTOM_DTYPE is True and not load.is_dataset_packed(SUBSET.get_path())
+    if fused is True:
+        loaded = SUBSET.load_trace_comps(range(0, NUM_TRACES), [COMPTYPE] if comps is None else comps,
+                                         start_point=START_POINT, end_point=END_POINT, valid=VALID)
+    else:
+        SUBSET.load_trace(range(0, NUM_TRACES), nf=False, ff=True, start_point=START_POINT, end_point=END_POINT, custom_dtype=CUSTOM_DTYPE, valid=VALID)
     # Load the profile from the dataset or a standalone one.
     if forced_profile is None or forced_profile == "":
         PROFILE = DATASET.get_profile()
@@ -98,17 +154,29 @@ def load_data(subset, forced_profile = None):
     else:
         l.LOGGER.info("Load the forced profile from {}".format(forced_profile))
         PROFILE = dataset.Profile(fp=forced_profile)
-        PROFILE.load()
     PLAINTEXTS                  = SUBSET.pt
     KEYS                        = SUBSET.ks
     FIXED_KEY                   = load.is_key_fixed(SUBSET.get_path())
-    TRACES                      = SUBSET.ff
-    KEYS, PLAINTEXTS, _, TRACES = load.reduce_entry_all_dataset(KEYS, PLAINTEXTS, None, TRACES, NUM_TRACES)
+    TRACES                      = loaded[0] if fused is True else SUBSET.ff
+    KEYS, PLAINTEXTS, _, TRACES = load.reduce_entry_all_dataset(KEYS, PLAINTEXTS, None, TRACES, NUM_TRACES, valid=VALID)
     PLAINTEXTS                  = PLAINTEXTS.tolist()
     KEYS                        = KEYS.tolist()
-    TRACES                      = complex.get_comp(TRACES, COMPTYPE)
-    if NORM or NORM2:
-        TRACES = analyze.normalize_zscore(TRACES, NORM2)
+    if comps is None:
+        TRACES = get_comp(TRACES, COMPTYPE)
+        traces = None
+    elif fused is True:
+        # NOTE: Every component has been derived from the same I/Q samples
+        # read once, hence reduce the other ones as the first one.
+        nb = NUM_TRACES if NUM_TRACES > 0 else len(SUBSET.ks)
+        loaded = [TRACES] + [load.reduce_entry_all_dataset(None, None, None, t, nb, valid=VALID)[3] for t in loaded[1:]]
+        traces = {comp: get_comp(t, comp) for comp, t in zip(comps, loaded)}
+        TRACES = traces[comps[0]]
+    else:
+        # NOTE: The I/Q traces are read only once and every component is
+        # derived from the same buffer.
+        traces = {comp: get_comp(TRACES, comp) for comp in comps}
+        TRACES = traces[comps[0]]
+        SUBSET.unload_trace()
     assert(isinstance(PLAINTEXTS, list))
     assert(isinstance(KEYS, list))
     assert(isinstance(TRACES, np.ndarray))
@@ -118,6 +186,30 @@ def load_data(subset, forced_profile = None):
     PLAINTEXTS = np.asarray(PLAINTEXTS)
     KEYS = np.asarray(KEYS)
     CIPHERTEXTS = np.asarray(CIPHERTEXTS)
+    return traces
+
+def result_close():
+    """Append the result record of the current command to the results store
+    and print the summary of its stages if requested."""
+    RESULT.close()
+    if PROFILE_STAGES is True:
+        print("")
+        print(RESULT.summary())
+    if RESULT_PATH is None or not RESULT.has_result():
+        return
+    try:
+        RESULT.save(RESULT_PATH)
+    except OSError as e:
+        l.LOGGER.error("Cannot append result record to '{}': {}".format(RESULT_PATH, e))
+
+@stage("get_comp")
+def get_comp(traces, comp):
+    """Return the COMP component of the loaded TRACES, normalized according to
+    the --norm and --norm2 options."""
+    traces = complex.get_comp(traces, comp)
+    if NORM or NORM2:
+        traces = analyze.normalize_zscore(traces, NORM2)
+    return traces
 
 @click.group()
 @click.option("--dataset-path", type=click.Path(exists=True, file_okay=False),
@@ -142,6 +234,10 @@ def load_data(subset, forced_profile = None):
               help="Attempt to fix a few wrong key bits with informed exhaustive search.")
 @click.option("--bit-bound-end", default=40, show_default=True,
               help="Set upper bound to key rank when bruteforcing.")
+@click.option("--bruteforce-jobs", default=0, show_default=True,
+              help="Number of processes used when bruteforcing (0 for all CPUs).")
+@click.option("--bruteforce-checkpoint", default="", type=click.Path(dir_okay=False),
+              help="If specified, save the bruteforce progress to this file and resume from it if it exists.")
 @click.option("--average/--no-average", default=True, show_default=True,
               help="Use average of a batch as preprocessing.")
 @click.option("--norm/--no-norm", default=False, show_default=True,
@@ -154,8 +250,24 @@ def load_data(subset, forced_profile = None):
 @click.option("--log/--no-log", default=True, help="Enable or disable logging.")
 @click.option("--comptype", default="AMPLITUDE", help="Choose between amplitude [AMPLITUDE] or phase rotation [PHASE_ROT].")
 @click.option("--custom-dtype/--no-custom-dtype", default=False, help="Load traces using custom Numpy dtype or default Numpy format.")
+@click.option("--align-subsample", default="none", show_default=True, type=click.Choice(["none", "parabolic", "upsample"]),
+              help="Refine the alignment below the sample using parabolic interpolation or spectral upsampling of the cross-correlation peak.")
+@click.option("--align-cache/--no-align-cache", default=True, show_default=True,
+              help="Save the alignment shifts in the subset directory and re-use them on later runs.")
+@click.option("--precision", default="float64", show_default=True, type=click.Choice(["float32", "float64"]),
+              help="Floating-point precision of the statistics of the traces (class means, variances, k-fold correlations). Final scores are always float64.")
+@click.option("--save-log-proba", default="", type=click.Path(dir_okay=False),
+              help="If specified, save the LOG_PROBA scores and the known key to this .npz file before key ranking.")
+@click.option("--skip-bad/--no-skip-bad", default=True, show_default=True,
+              help="Skip the invalid traces of the subset (bad entries and validity bitmap) without loading them.")
+@click.option("--result/--no-result", default=True, show_default=True,
+              help="Append a structured record of the attack results to the results store.")
+@click.option("--result-path", default="", type=click.Path(dir_okay=False),
+              help="If specified, use this results store instead of the one of the dataset directory.")
+@click.option("--profile-stages/--no-profile-stages", default=False, show_default=True,
+              help="Print a summary table of the wall time, CPU time, peak memory and bytes read of each stage.")
 def cli(dataset_path, num_traces, start_point, end_point, plot, save_images, wait, num_key_bytes,
-        bruteforce, bit_bound_end, name, average, norm, norm2, mimo, loglevel, log, comptype, custom_dtype):
+        bruteforce, bit_bound_end, bruteforce_jobs, bruteforce_checkpoint, name, average, norm, norm2, mimo, loglevel, log, comptype, custom_dtype, align_subsample, align_cache, precision, save_log_proba, skip_bad, result, result_path, profile_stages):
     """
     Run an attack against previously collected traces.
 
@@ -163,7 +275,7 @@ def cli(dataset_path, num_traces, start_point, end_point, plot, save_images, wai
     apply to all attacks; see the individual attacks' documentation for
     attack-specific options.
     """
-    global SAVE_IMAGES, PLOT, GWAIT, NUM_KEY_BYTES, BRUTEFORCE, BIT_BOUND_END, NUM_TRACES, START_POINT, END_POINT, NORM, NORM2, DATASET_PATH, COMPTYPE, CUSTOM_DTYPE
+    global SAVE_IMAGES, PLOT, GWAIT, NUM_KEY_BYTES, BRUTEFORCE, BIT_BOUND_END, BRUTEFORCE_JOBS, BRUTEFORCE_CHECKPOINT, NUM_TRACES, START_POINT, END_POINT, NORM, NORM2, DATASET_PATH, COMPTYPE, CUSTOM_DTYPE, ALIGN_SUBSAMPLE, ALIGN_CACHE, PRECISION, SAVE_LOG_PROBA, SKIP_BAD, RESULT, RESULT_PATH, PROFILE_STAGES
     l.configure(log, loglevel)
     SAVE_IMAGES = save_images
     PLOT = plot
@@ -173,6 +285,8 @@ def cli(dataset_path, num_traces, start_point, end_point, plot, save_images, wai
         raise Exception("Bruteforce not available for num_key_bytes != 16")
     BRUTEFORCE = bruteforce
     BIT_BOUND_END = bit_bound_end
+    BRUTEFORCE_JOBS = bruteforce_jobs
+    BRUTEFORCE_CHECKPOINT = bruteforce_checkpoint
     NUM_TRACES = num_traces
     START_POINT = start_point
     END_POINT = end_point
@@ -181,6 +295,56 @@ def cli(dataset_path, num_traces, start_point, end_point, plot, save_images, wai
     DATASET_PATH = dataset_path
     COMPTYPE = comptype
     CUSTOM_DTYPE = custom_dtype
+    ALIGN_SUBSAMPLE = align_subsample
+    ALIGN_CACHE = align_cache
+    PRECISION = np.dtype(precision).type
+    SAVE_LOG_PROBA = save_log_proba
+    SKIP_BAD = skip_bad
+    RESULT_PATH = None
+    if result is True and result_path != "":
+        RESULT_PATH = result_path
+    elif result is True and dataset_path is not None:
+        RESULT_PATH = results.get_path(dataset_path)
+    PROFILE_STAGES = profile_stages
+    ctx = click.get_current_context()
+    RESULT = results.Record(ctx.invoked_subcommand, ctx.params)
+    ctx.call_on_close(result_close)
+
+@stage("align")
+def align_traces(traces, template, cache=True):
+    """Align TRACES against TEMPLATE, using sub-sample shifts if requested
+    through the top-level --align-subsample option. See get_align_shifts()
+    for CACHE."""
+    return analyze.shift_all(traces, get_align_shifts(traces, template, cache=cache))
+
+@stage("shifts")
+def get_align_shifts(traces, template, cache=True):
+    """Return the shifts aligning TRACES against TEMPLATE.
+
+    If --align-cache is set and CACHE is True, the shifts are saved in the
+    directory of the loaded subset and re-used by later runs using the same
+    template, loading parameters and trace files. Successive alignments are
+    chained in the key, since shifts depend on previously applied
+    alignments. CACHE has to be False if TRACES[i] is not the trace #i of the
+    subset.
+
+    """
+    global ALIGN_KEY
+    template = template if template is not None else traces[0]
+    subsample = ALIGN_SUBSAMPLE is not None and ALIGN_SUBSAMPLE != "none"
+    method = ALIGN_SUBSAMPLE if subsample else "parabolic"
+    if not ALIGN_CACHE or cache is False:
+        return analyze.get_shifts_all(traces, DATASET.samp_rate, template, subsample=subsample,
+                                      method=method, tqdm_log=True)
+    # NOTE: Normalization is computed on the whole set, hence shifts can only
+    # be re-used for the same number of traces in this case.
+    ALIGN_KEY = analyze.get_shifts_key(template, chain=ALIGN_KEY, sr=DATASET.samp_rate,
+                                       start=START_POINT, end=END_POINT, samples=traces.shape[1],
+                                       comptype=COMPTYPE, norm=NORM, norm2=NORM2,
+                                       nb=len(traces) if NORM or NORM2 else 0,
+                                       subsample=ALIGN_SUBSAMPLE, **dataset.Subset.get_valid_key(VALID), **SUBSET.get_traces_key())
+    return SUBSET.get_shifts(ALIGN_KEY, traces, DATASET.samp_rate, template,
+                             subsample=subsample, method=method, tqdm_log=True)
 
 # * CCS18 UTILS (from ChipWhisper)
 
@@ -189,9 +353,10 @@ def cov(x, y):
     # Note that var(x) = cov(x, x)
     return np.cov(x, y)[0][1]
 
-hw = [bin(n).count("1") for n in range(256)]
+# NOTE: Use np.ndarray such that leakage functions can be applied on arrays.
+hw = np.array([bin(n).count("1") for n in range(256)])
 
-sbox=(
+sbox=np.array((
 0x63,0x7c,0x77,0x7b,0xf2,0x6b,0x6f,0xc5,0x30,0x01,0x67,0x2b,0xfe,0xd7,0xab,0x76,
 0xca,0x82,0xc9,0x7d,0xfa,0x59,0x47,0xf0,0xad,0xd4,0xa2,0xaf,0x9c,0xa4,0x72,0xc0,
 0xb7,0xfd,0x93,0x26,0x36,0x3f,0xf7,0xcc,0x34,0xa5,0xe5,0xf1,0x71,0xd8,0x31,0x15,
@@ -207,7 +372,7 @@ sbox=(
 0xba,0x78,0x25,0x2e,0x1c,0xa6,0xb4,0xc6,0xe8,0xdd,0x74,0x1f,0x4b,0xbd,0x8b,0x8a,
 0x70,0x3e,0xb5,0x66,0x48,0x03,0xf6,0x0e,0x61,0x35,0x57,0xb9,0x86,0xc1,0x1d,0x9e,
 0xe1,0xf8,0x98,0x11,0x69,0xd9,0x8e,0x94,0x9b,0x1e,0x87,0xe9,0xce,0x55,0x28,0xdf,
-0x8c,0xa1,0x89,0x0d,0xbf,0xe6,0x42,0x68,0x41,0x99,0x2d,0x0f,0xb0,0x54,0xbb,0x16)
+0x8c,0xa1,0x89,0x0d,0xbf,0xe6,0x42,0x68,0x41,0x99,0x2d,0x0f,0xb0,0x54,0xbb,0x16))
 
 def intermediate(pt, keyguess):
     return sbox[pt ^ keyguess]
@@ -246,6 +411,9 @@ def print_result(bestguess,knownkey,pge):
     print("PGE MEDIAN:    %d"%np.median(pge))
     print("PGE MAX:       %d"%np.max(pge))
     print("HD SUM:        %d"%np.sum(hd))
+    if RESULT is not None:
+        RESULT.set(bestguess=np.asarray(bestguess), known_key=np.asarray(knownkey), pge=np.asarray(pge), hd=hd,
+                   correct_bytes=tot, pge_mean=np.mean(pge), pge_median=np.median(pge), pge_max=np.max(pge), hd_sum=np.sum(hd))
 
 # * CHES20 UTILS
 
@@ -253,6 +421,7 @@ def print_result(bestguess,knownkey,pge):
 # Set CLASSES to list of all possibles values of leak variable.
 # Set VARIABLE_FUNC to leakage function (e.g. p ^ k).
 # Set VARIABLES to leakage function applied to plaintexts and keys of all traces for each subbytes (shape 16, num_traces).
+@stage("variables")
 def compute_variables(variable):
     global VARIABLES, CLASSES, VARIABLE_FUNC, FIXED_PLAINTEXT
     VARIABLES = np.zeros((NUM_KEY_BYTES, len(TRACES)), dtype=int)
@@ -323,24 +492,20 @@ def classify():
 
 # Estimate mean, variance, and standard deviation for each class for each
 # subbytes, and the average trace for all traces
+# The moments are computed for all subbytes at once from VARIABLES, without
+# requiring SETS.
+@stage("estimate")
 def estimate():
     global MEANS, VARS, STDS
 
     PROFILE.MEAN_TRACE = np.average(TRACES, axis=0)
-    MEANS = np.zeros((NUM_KEY_BYTES, len(CLASSES), len(TRACES[0])))
-    VARS = np.zeros((NUM_KEY_BYTES, len(CLASSES), len(TRACES[0])))
-    STDS = np.zeros((NUM_KEY_BYTES, len(CLASSES), len(TRACES[0])))
-
-    for bnum in range(NUM_KEY_BYTES):
-        for cla in CLASSES:
-            MEANS[bnum][cla] = np.average(SETS[bnum][cla], axis=0)
-            VARS[bnum][cla] = np.var(SETS[bnum][cla], axis=0)
-            STDS[bnum][cla] = np.std(SETS[bnum][cla], axis=0)
+    _, MEANS, VARS = analyze.grouped_moments(TRACES, VARIABLES, len(CLASSES), dtype=PRECISION)
+    STDS = np.sqrt(VARS)
 
 # Estimate the side-channel SNR
 def estimate_snr():
     global SNRS
-    SNRS = np.zeros((NUM_KEY_BYTES, len(TRACES[0])))
+    SNRS = np.zeros((NUM_KEY_BYTES, len(TRACES[0])), dtype=PRECISION)
     for bnum in range(NUM_KEY_BYTES):
         SNRS[bnum] = np.var(MEANS[bnum], axis=0) / np.average(VARS[bnum], axis=0)
 
@@ -350,8 +515,8 @@ def estimate_ttest():
     TTESTS = np.zeros((NUM_KEY_BYTES, len(TRACES[0])))
     PTTESTS = np.zeros((NUM_KEY_BYTES, len(TRACES[0])))
     for bnum in range(NUM_KEY_BYTES):
-        TTESTS[bnum], PTTESTS[bnum] = ttest_ind(SETS[bnum][1],
-                SETS[bnum][0], axis=0, equal_var=False)
+        TTESTS[bnum], PTTESTS[bnum] = ttest_ind(TRACES[VARIABLES[bnum] == 1],
+                TRACES[VARIABLES[bnum] == 0], axis=0, equal_var=False)
 
     tmax = np.max(np.absolute(TTESTS[0]))
     p = PTTESTS[0][np.argmax(np.absolute(TTESTS[0]))]
@@ -381,22 +546,13 @@ def split(fold, k_fold):
 # average of each class
 def classify_and_estimate_profile():
     global MEANS_PROFILE
-    MEANS_PROFILE = np.zeros((NUM_KEY_BYTES, len(CLASSES), len(TRACES[0])))
-    sets = [[[] for _ in CLASSES] for b in range(NUM_KEY_BYTES)]
-    for bnum in range(NUM_KEY_BYTES):
-        for cla, trace in list(zip(VARIABLES_PROFILE[bnum], TRACES_PROFILE)):
-            sets[bnum][cla].append(trace)
-
-        sets[bnum] = [np.array(sets[bnum][cla]) for cla in CLASSES]
-    for bnum in range(NUM_KEY_BYTES):
-        for cla in CLASSES:
-            MEANS_PROFILE[bnum][cla] = np.average(sets[bnum][cla], axis=0)
+    _, MEANS_PROFILE, _ = analyze.grouped_moments(TRACES_PROFILE, VARIABLES_PROFILE, len(CLASSES), dtype=PRECISION)
 
 # Assign to each test trace the trace estimated with the profiling set for the
 # same value of the leak variable
 def estimate_test():
     global MEANS_TEST
-    MEANS_TEST = np.zeros((NUM_KEY_BYTES, len(TRACES_TEST), len(TRACES[0])))
+    MEANS_TEST = np.zeros((NUM_KEY_BYTES, len(TRACES_TEST), len(TRACES[0])), dtype=PRECISION)
     for bnum in range(NUM_KEY_BYTES):
         for i, trace in enumerate(TRACES_TEST):
             MEANS_TEST[bnum][i] = MEANS_PROFILE[bnum][VARIABLES_TEST[bnum][i]]
@@ -433,8 +589,8 @@ def estimate_r(k_fold):
     # PROFILE.RZS = np.zeros((NUM_KEY_BYTES, len(TRACES[0])))
     PS = np.zeros((NUM_KEY_BYTES, len(TRACES[0])))
 
-    RF = np.zeros((NUM_KEY_BYTES, k_fold, len(TRACES[0])))
-    PF = np.zeros((NUM_KEY_BYTES, k_fold, len(TRACES[0])))
+    RF = np.zeros((NUM_KEY_BYTES, k_fold, len(TRACES[0])), dtype=PRECISION)
+    PF = np.zeros((NUM_KEY_BYTES, k_fold, len(TRACES[0])), dtype=PRECISION)
     for fold in range(0,k_fold):
         split(fold, k_fold)
         classify_and_estimate_profile()
@@ -471,12 +627,12 @@ def estimate_corr():
 # subbytes. Shape = (subbyte_idx, num_pois).
 # To find POIS, k-fold ro-test, t-test, signal to noise ratio (SNR), sum of
 # absolute differences (SOAD) can be used.
+@stage("pois")
 def find_pois(pois_algo, k_fold, num_pois, poi_spacing, template_dir='profile'):
     global SNRS, SOADS
 
     PROFILE.RZS = np.zeros((NUM_KEY_BYTES, len(TRACES[0])))
     PROFILE.RS = np.zeros((NUM_KEY_BYTES, len(TRACES[0])))
-    PROFILE.POIS = np.zeros((NUM_KEY_BYTES, num_pois), dtype=int)
 
     informative = np.zeros((NUM_KEY_BYTES, len(TRACES[0])))
     num_plots = 2
@@ -513,16 +669,7 @@ def find_pois(pois_algo, k_fold, num_pois, poi_spacing, template_dir='profile'):
     else:
         raise Exception("POIs algo type %s is not supported" % pois_algo)
 
-    for bnum in range(NUM_KEY_BYTES):
-        temp = np.array(informative[bnum])
-        for i in range(num_pois):
-            poi = np.argmax(temp)
-            PROFILE.POIS[bnum][i] = poi
-
-            pmin = max(0, poi - poi_spacing)
-            pmax = min(poi + poi_spacing, len(temp))
-            for j in range(pmin, pmax):
-                temp[j] = 0
+    PROFILE.POIS = select_pois(informative, num_pois, poi_spacing)
 
     if PLOT or SAVE_IMAGES:
         plt.subplots_adjust(hspace = 1)
@@ -595,9 +742,27 @@ def find_pois(pois_algo, k_fold, num_pois, poi_spacing, template_dir='profile'):
             plt.show()
         plt.clf()
 
+# Select the NUM_POIS most informative points of each subbyte from INFORMATIVE
+# (shape (nb_subbytes, nb_samples)), spaced by at least POI_SPACING points.
+# Return the POIs as a np.ndarray of shape (nb_subbytes, num_pois).
+def select_pois(informative, num_pois, poi_spacing):
+    pois = np.zeros((len(informative), num_pois), dtype=int)
+    for bnum in range(len(informative)):
+        temp = np.array(informative[bnum])
+        for i in range(num_pois):
+            poi = np.argmax(temp)
+            pois[bnum][i] = poi
+
+            pmin = max(0, poi - poi_spacing)
+            pmax = min(poi + poi_spacing, len(temp))
+            for j in range(pmin, pmax):
+                temp[j] = 0
+    return pois
+
 # Once the POIs are known, we can drop all the other points of the traces
 # Optionally, instead of taking the peak only, we can take the average of a
 # small window areound the peak
+@stage("reduce")
 def reduce_traces(num_pois, window=0):
     global TRACES_REDUCED
 
@@ -612,24 +777,18 @@ def reduce_traces(num_pois, window=0):
                 TRACES_REDUCED[bnum][i][poi] = np.average(trace[start:end])
 
 # Estimate means, std, and covariance for each possible class
+@stage("build_profile")
 def build_profile(variable, template_dir='profile', pois_algo="none"):
     num_pois = len(PROFILE.POIS[0])
     num_classes = len(CLASSES)
 
-    PROFILE.MEANS = np.zeros((NUM_KEY_BYTES, num_classes, num_pois))
-    PROFILE.STDS = np.zeros((NUM_KEY_BYTES, num_classes, num_pois))
-    PROFILE.COVS = np.zeros((NUM_KEY_BYTES, num_classes, num_pois, num_pois))
+    PROFILE.MEANS = np.zeros((NUM_KEY_BYTES, num_classes, num_pois), dtype=PRECISION)
+    PROFILE.STDS = np.zeros((NUM_KEY_BYTES, num_classes, num_pois), dtype=PRECISION)
 
     for bnum in range(NUM_KEY_BYTES):
-        for cla in CLASSES:
-            for i in range(num_pois):
-                PROFILE.MEANS[bnum][cla][i] = MEANS[bnum][cla][PROFILE.POIS[bnum][i]]
-                PROFILE.STDS[bnum][cla][i] = STDS[bnum][cla][PROFILE.POIS[bnum][i]]
-                for j in range(num_pois):
-                    if(len(SETS[bnum][cla])>0):
-                        PROFILE.COVS[bnum][cla][i][j] = cov(
-                                SETS[bnum][cla][:, PROFILE.POIS[bnum][i]],
-                                SETS[bnum][cla][:, PROFILE.POIS[bnum][j]])
+        PROFILE.MEANS[bnum] = MEANS[bnum][:, PROFILE.POIS[bnum]]
+        PROFILE.STDS[bnum] = STDS[bnum][:, PROFILE.POIS[bnum]]
+    PROFILE.COVS = analyze.grouped_cov(TRACES, VARIABLES, num_classes, PROFILE.POIS, PROFILE.MEANS)
 
     if PLOT or SAVE_IMAGES:
         for i in range(num_pois):
@@ -751,7 +910,49 @@ def fit(lr_type, variable):
     PROFILE.MEANS = PROFILE_MEANS_FIT
     PROFILE.COVS = None
 
+# Return the classes of all traces for all key guesses of byte BNUM as a 2D
+# np.ndarray of shape (num_traces, 256).
+def get_classes(bnum):
+    return get_guess_classes(np.asarray(PLAINTEXTS)[:, bnum])
+
+# Return the classes of the plaintext bytes P (1D np.ndarray) for all key
+# guesses as a 2D np.ndarray of shape (len(p), 256).
+def get_guess_classes(p):
+    p = np.asarray(p)[:, np.newaxis]
+    k = np.arange(256)[np.newaxis, :]
+    try:
+        cla = np.broadcast_to(VARIABLE_FUNC(p, k), (len(p), 256))
+    except (TypeError, ValueError):
+        # Leakage function only working on scalars.
+        cla = np.vectorize(VARIABLE_FUNC, otypes=[int])(p, k)
+    return cla
+
+# Return the sum over the NUM_POIS first POIs of the Pearson correlation
+# between the MEANS profile (shape (num_classes, num_pois)) of the hypothetical
+# classes and TRACES_REDUCED for all key guesses of byte BNUM. Since the
+# leakages only take num_classes values, the correlation is computed from
+# per-class sums of the traces for the 256 key guesses at once.
+def score_pcc(bnum, means, num_pois):
+    num_classes = len(means)
+    cla = get_classes(bnum)
+    # NOTE: Negative classes index the profile from the end as with lists.
+    cla = np.where(cla < 0, cla + num_classes, cla)
+    idx = (cla + np.arange(256) * num_classes).ravel()
+    n = len(cla)
+    count = np.bincount(idx, minlength=256 * num_classes).reshape(256, num_classes)
+    scores = np.zeros(256, dtype=np.float64)
+    for i in range(num_pois):
+        # Center both variables to limit cancellation in the sums.
+        y = TRACES_REDUCED[bnum][:, i] - np.mean(TRACES_REDUCED[bnum][:, i])
+        m = means[:, i] - np.mean(means[:, i])
+        sum_y = np.bincount(idx, weights=np.repeat(y, 256), minlength=256 * num_classes).reshape(256, num_classes)
+        sum_x = count @ m
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores += (sum_y @ m) / np.sqrt((count @ m ** 2 - sum_x ** 2 / n) * np.sum(y ** 2))
+    return scores
+
 # Run a template attack or a profiled correlation attack
+@stage("score")
 def run_attack(attack_algo, average_bytes, num_pois, pooled_cov, variable, retmore=False):
     global LOG_PROBA
 
@@ -816,6 +1017,7 @@ def run_attack(attack_algo, average_bytes, num_pois, pooled_cov, variable, retmo
                 pge[bnum] = list(P_k.argsort()[::-1]).index(KEYS[0][bnum])
             print("PGE ", pge[bnum])
             scores.append(P_k)
+        maxcpa = np.copy(LOG_PROBA)
 
     elif attack_algo == "pcc":
 
@@ -828,27 +1030,11 @@ def run_attack(attack_algo, average_bytes, num_pois, pooled_cov, variable, retmo
         # NOTE: Use np.float64 required by HEL (otherwise, segfault).
         maxcpa = np.empty((NUM_KEY_BYTES, 256), dtype=np.float64)
         for bnum in range(0, NUM_KEY_BYTES):
-            cpaoutput = [0]*256
             print("Subkey %2d"%bnum)
-            for kguess in range(256):
-
-                clas = [VARIABLE_FUNC(PLAINTEXTS[j][bnum], kguess) for j in
-                        range(len(TRACES))]
-                if average_bytes:
-                    leaks = np.asarray([PROFILE_MEANS_AVG[clas[j]] for j in
-                        range(len(TRACES))])
-                else:
-                    leaks = np.asarray([PROFILE.MEANS[bnum][clas[j]] for j in
-                        range(len(TRACES))])
-
-                # Combine POIs as proposed in
-                # https://pastel.archives-ouvertes.fr/pastel-00850528/document
-                maxcpa[bnum][kguess] = 0
-                for i in range(num_pois):
-                    r,p = pearsonr(leaks[:, i], TRACES_REDUCED[bnum][:, i])
-                    maxcpa[bnum][kguess] += r
-
-                LOG_PROBA[bnum][kguess] = maxcpa[bnum][kguess]
+            # Combine POIs as proposed in
+            # https://pastel.archives-ouvertes.fr/pastel-00850528/document
+            maxcpa[bnum] = score_pcc(bnum, PROFILE_MEANS_AVG if average_bytes else PROFILE.MEANS[bnum], num_pois)
+            LOG_PROBA[bnum] = maxcpa[bnum]
 
             bestguess[bnum] = np.argmax(maxcpa[bnum])
 
@@ -871,6 +1057,108 @@ def run_attack(attack_algo, average_bytes, num_pois, pooled_cov, variable, retmo
     else:
         return maxcpa
 
+# Same than score_pcc() but computed from the sums of the traces at the POIs
+# grouped by value of the plaintext byte: COUNT of shape (256,), SUM1 and SUM2
+# of shape (256, num_pois). It is possible since traces sharing the same
+# plaintext byte share the same class for every key guess, whose classes are
+# given by CLA of shape (256, 256) (see get_guess_classes()).
+def score_pcc_sums(cla, count, sum1, sum2, means):
+    num_classes = len(means)
+    idx = (cla + np.arange(256) * num_classes).ravel()
+    n = np.sum(count)
+    cnt = np.bincount(idx, weights=np.repeat(count, 256), minlength=256 * num_classes).reshape(256, num_classes)
+    scores = np.zeros(256, dtype=np.float64)
+    for i in range(means.shape[1]):
+        # Center both variables to limit cancellation in the sums.
+        ybar = np.sum(sum1[:, i]) / n
+        sum_y = np.bincount(idx, weights=np.repeat(sum1[:, i], 256), minlength=256 * num_classes).reshape(256, num_classes) - cnt * ybar
+        sum_yy = np.sum(sum2[:, i]) - n * ybar ** 2
+        m = means[:, i] - np.mean(means[:, i])
+        sum_x = cnt @ m
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores += (sum_y @ m) / np.sqrt((cnt @ m ** 2 - sum_x ** 2 / n) * sum_yy)
+    return scores
+
+# Return the SNR of every sample for every subbyte, computed from the sums of
+# the traces grouped by value of the plaintext bytes (COUNT of shape
+# (nb_subbytes, 256), SUM1 and SUM2 of shape (nb_subbytes, 256, nb_samples))
+# and the classes of the known key, CLA being the classes of all plaintext
+# bytes for all key guesses (see get_guess_classes()).
+def estimate_snr_sums(cla, count, sum1, sum2):
+    snrs = np.zeros((NUM_KEY_BYTES, sum1.shape[2]))
+    for bnum in range(NUM_KEY_BYTES):
+        onehot = np.zeros((len(CLASSES), 256))
+        onehot[cla[:, KEYS[0][bnum]], np.arange(256)] = 1
+        n = (onehot @ count[bnum])[:, np.newaxis]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = (onehot @ sum1[bnum]) / n
+            variances = (onehot @ sum2[bnum]) / n - means ** 2
+            snrs[bnum] = np.nanvar(means, axis=0) / np.nanmean(variances, axis=0)
+    return np.nan_to_num(snrs)
+
+# Online profiled correlation attack processing the attack traces by chunks of
+# CHUNK traces. Each chunk is aligned and accumulated into per-plaintext sums
+# for every subbyte, from which the POIs (if POIS_ALGO is "snr") and the scores
+# are updated using the current POIs. Stop once the estimated key rank is
+# lower than RANK_BOUND (log2) and changed by less than TOL bits during
+# PATIENCE chunks. Return True if the key is found.
+# NOTE: Both the stop rule (key rank) and the SNR used to select the POIs rely
+# on the known key, hence the number of traces recorded in the result is an
+# optimistic estimation, flagged by the online_pois_known_key field.
+@stage("online")
+def run_attack_online(chunk, pois_algo, num_pois, poi_spacing, average_bytes, align_attack, align_profile, rank_bound, tol, patience):
+    global LOG_PROBA
+
+    if pois_algo not in ("", "snr"):
+        raise Exception("POIs algo type %s is not supported by the online attack" % pois_algo)
+    num_classes = len(CLASSES)
+    cla = get_guess_classes(np.arange(256))
+    # NOTE: Negative classes index the profile from the end as with lists.
+    cla = np.where(cla < 0, cla + num_classes, cla)
+    means = np.average(PROFILE.MEANS, axis=0) if average_bytes else None
+    pois = PROFILE.POIS[:, 0:num_pois]
+    # NOTE: With fixed POIs, only accumulate the sums of their samples, POIS
+    # is then remapped to the accumulated columns by IDX. The SNR requires
+    # the sums of all samples.
+    cols = np.unique(pois) if pois_algo == "" else slice(None)
+    idx = np.searchsorted(cols, pois) if pois_algo == "" else None
+    ref, count, sum1, sum2 = None, 0, 0, 0
+    ranks = []
+    # NOTE: Use np.float64 required by HEL (otherwise, segfault).
+    LOG_PROBA = np.zeros((NUM_KEY_BYTES, 256), dtype=np.float64)
+
+    print("")
+    for start in range(0, len(TRACES), chunk):
+        traces = TRACES[start:start + chunk]
+        # NOTE: Don't cache the shifts of a chunk, the cache is indexed by
+        # trace number from the start of the subset.
+        if align_attack is True:
+            traces = align_traces(traces, TRACES[0], cache=False)
+        if align_profile is True:
+            traces = align_traces(traces, PROFILE.MEAN_TRACE, cache=False)
+        x = traces[:, cols]
+        ref = np.mean(x, axis=0, dtype=np.float64) if ref is None else ref
+        c, s1, s2 = analyze.grouped_sums(x, PLAINTEXTS[start:start + chunk].T, 256, ref)
+        count, sum1, sum2 = count + c, sum1 + s1, sum2 + s2
+
+        if pois_algo == "snr":
+            pois = idx = select_pois(estimate_snr_sums(cla, count, sum1, sum2), num_pois, poi_spacing)
+        for bnum in range(NUM_KEY_BYTES):
+            m = means if average_bytes else PROFILE.MEANS[bnum]
+            LOG_PROBA[bnum] = score_pcc_sums(cla, count[bnum], sum1[bnum][:, idx[bnum]], sum2[bnum][:, idx[bnum]], m[:, 0:num_pois])
+        LOG_PROBA = np.nan_to_num(LOG_PROBA)
+
+        ranks.append(keyrank.rank(LOG_PROBA, KEYS[0])[1])
+        print("Traces: %d rank: 2^%.2f" % (start + len(traces), ranks[-1]))
+        if len(ranks) > patience and ranks[-1] <= rank_bound and np.max(np.abs(np.diff(ranks[-patience - 1:]))) < tol:
+            l.LOGGER.info("Key rank converged after {} traces".format(start + len(traces)))
+            break
+
+    PROFILE.POIS = pois
+    if RESULT is not None:
+        RESULT.set(online_traces=start + len(traces), online_ranks=ranks, online_pois_known_key=pois_algo == "snr")
+    return print_scores(LOG_PROBA, KEYS[0])
+
 # Wrapper to compute AES
 def aes(pt, key):
     from Crypto.Cipher import AES
@@ -886,12 +1174,22 @@ def aes(pt, key):
     return ct
 
 # Wrapper to call the Histogram Enumeration Library for key-ranking
+# Fall back on the built-in histogram rank estimation if HEL is not installed.
+@stage("rank")
 def rank():
-    # Perform key ranking only if HEL is installed.
+    # NOTE: Use np.float64 required by HEL (otherwise, segfault).
+    log_proba = np.ascontiguousarray(LOG_PROBA, dtype=np.float64)
+    if SAVE_LOG_PROBA != "":
+        np.savez(SAVE_LOG_PROBA, LOG_PROBA=log_proba, KEY=np.asarray(KEYS[0]))
+        l.LOGGER.info("LOG_PROBA saved to '{}'".format(SAVE_LOG_PROBA))
+    if RESULT is not None:
+        RESULT.set(log_proba=log_proba)
+
     try:
         from python_hel import hel
     except Exception as e:
-        l.LOGGER.error("Can't import HEL and perform key ranking!")
+        l.LOGGER.warning("Can't import HEL, perform key ranking using built-in histograms!")
+        result_rank(*rank_histogram(log_proba, KEYS[0]))
         return
     
     print("")
@@ -905,49 +1203,49 @@ def rank():
     merge = 2
     bins = 512
 
-    rank_min, rank_rounded, rank_max, time_rank = hel.rank(LOG_PROBA, known_key, merge, bins)
+    rank_min, rank_rounded, rank_max, time_rank = hel.rank(log_proba, known_key, merge, bins)
+    # NOTE: HEL returns the ranks while the built-in estimation returns their log2.
+    result_rank(np.log2(float(rank_min)), np.log2(float(rank_rounded)), np.log2(float(rank_max)), time_rank)
+
+# Record the log2 of the key rank bounds in the result record.
+def result_rank(rank_min, rank_rounded, rank_max, time_rank):
+    if RESULT is not None:
+        RESULT.set(rank_min=rank_min, rank_rounded=rank_rounded, rank_max=rank_max)
 
-# Wrapper to call the Histogram Enumeration Library for key-enumeration
+# Key ranking using the built-in histogram rank estimation, printing the results
+# like HEL.
+def rank_histogram(log_proba, known_key):
+    print("")
+    print("Starting key ranking using histograms")
+    rank_min, rank_rounded, rank_max, time_rank = keyrank.rank(log_proba, known_key)
+    print("min: 2^%.2f" % rank_min)
+    print("actual rounded: 2^%.2f" % rank_rounded)
+    print("max: 2^%.2f" % rank_max)
+    print("time rank: %.4f seconds" % time_rank)
+    return rank_min, rank_rounded, rank_max, time_rank
+
+# Parallel key enumeration in decreasing order of probability, verifying the
+# candidates against two known plaintext/ciphertext pairs with a vectorized AES.
+# The progress is saved into BRUTEFORCE_CHECKPOINT, if any, to resume long
+# enumerations.
+@stage("bruteforce")
 def bruteforce(bit_bound_end):
     print("")
-    print("Starting key enumeration using HEL")
-    import ctypes
-    from Crypto.Cipher import AES
-
-    from python_hel import hel
-
-    pt1 = np.array(PLAINTEXTS[0], dtype=ctypes.c_ubyte).tolist()
-    pt2 = np.array(PLAINTEXTS[1], dtype=ctypes.c_ubyte).tolist()
-
+    print("Starting key enumeration using histograms")
     print("Assuming that we know two plaintext/ciphertext pairs")
-    #_key = ''.join([chr(c) for c in KEYS[0]])
-    __key = KEYS[0].tolist()
-    _key = b''.join([b.to_bytes(1,"little") for b in __key])
-    #_pt1 = ''.join([chr(c) for c in pt1])
-    _pt1 = b''.join([b.to_bytes(1,"little") for b in pt1])
-    #_pt2 = ''.join([chr(c) for c in pt2])
-    _pt2 = b''.join([b.to_bytes(1,"little") for b in pt2])
-
-
-    cipher = AES.new(_key, AES.MODE_ECB)
-
-    _ct1 = cipher.encrypt(_pt1)
-    _ct2 = cipher.encrypt(_pt2)
-
-    #ct1 = [ord(c) for c in _ct1]
-    ct1 = [c for c in _ct1]
-    ct1 = np.array(ct1, dtype=ctypes.c_ubyte)
-    #ct2 = [ord(c) for c in _ct2]
-    ct2 = [c for c in _ct2]
-    ct2 = np.array(ct2, dtype=ctypes.c_ubyte)
-
-    merge = 2
-    bins = 512
-    bit_bound_start = 0
-    #bit_bound_end = 30
-
-    found = hel.bruteforce(LOG_PROBA, pt1, pt2, ct1, ct2, merge,
-        bins, bit_bound_start, bit_bound_end)
+    pts = [np.array(PLAINTEXTS[i], dtype=np.uint8).tolist() for i in range(2)]
+    cts = [aes(pt, np.array(KEYS[0], dtype=np.uint8).tolist()) for pt in pts]
+    key, nb_keys = keyenum.enumerate_keys(np.ascontiguousarray(LOG_PROBA, dtype=np.float64), pts, cts, bit_bound_end,
+                                          jobs=BRUTEFORCE_JOBS, checkpoint=BRUTEFORCE_CHECKPOINT)
+    found = key is not None
+    if RESULT is not None:
+        RESULT.set(bruteforce_found=found, bruteforce_keys=nb_keys)
+    print("enumerated: 2^%.2f keys" % np.log2(max(nb_keys, 1)))
+    if found:
+        print("key found: %s" % bytes(key.tolist()).hex())
+    else:
+        print("key not found up to rank 2^%d" % bit_bound_end)
+    return found
 
 
 # * CHES20 ATTACKS
@@ -992,29 +1290,24 @@ def profile(variable, lr_type, pois_algo, k_fold, num_pois, poi_spacing, pois_di
     except Exception as e:
         pass
 
+    PROFILE.SAMP_RATE = DATASET.samp_rate
     if resamp_to > 0:
-        from tqdm import tqdm
-        resamp_from=DATASET.samp_rate
-        num_from = len(TRACES[0])
-        num_to = int((len(TRACES[0]) / resamp_from) * resamp_to)
-        l.LOGGER.info("Resampling: {} points / {:.2f} MHz -> {} points / {:.2f} MHz".format(num_from, (resamp_from / 1e6), num_to, (resamp_to / 1e6)))
-        TRACES_resampled = np.empty((TRACES.shape[0], num_to), dtype=TRACES.dtype)
-        for i, t in enumerate(tqdm(TRACES, desc="Resampling")):
-            TRACES_resampled[i] = signal.resample(t, num_to)
-        TRACES = TRACES_resampled
+        l.LOGGER.info("Resampling: {} points / {:.2f} MHz -> {:.2f} MHz".format(len(TRACES[0]), (DATASET.samp_rate / 1e6), (resamp_to / 1e6)))
+        TRACES = analyze.resample(TRACES, DATASET.samp_rate, resamp_to)
+        PROFILE.SAMP_RATE = resamp_to
 
     if align:
-        TRACES = analyze.align_all(TRACES, DATASET.samp_rate, template=PROFILE.MEAN_TRACE, tqdm_log=True)
+        TRACES = align_traces(TRACES, PROFILE.MEAN_TRACE)
 
     if pois_dir != "":
-        pois = np.load(os.path.join(pois_dir, dataset.Profile.POIS_FN))
+        pois_profile = dataset.Profile(fp=pois_dir)
+        pois_profile.load(["POIS"])
+        pois = pois_profile.POIS
         TRACES = TRACES[:,np.sort(pois.flatten())]
 
     def profile_exec(variable, lr_type, pois_algo, k_fold, num_pois, poi_spacing, pois_dir):
         # Set VARIABLES.
         compute_variables(variable)
-        # Set SETS.
-        classify()
         # Set MEANS, VARS, STDS, PROFILE.PROFILE_MEAN_TRACE.
         estimate()
         # Set POIS.
@@ -1061,8 +1354,17 @@ def profile(variable, lr_type, pois_algo, k_fold, num_pois, poi_spacing, pois_di
              help="Align the average of the attack traces with the profile before to attack.")
 @click.option("--profile", default="", type=click.Path(), show_default=True,
              help="If specified, use the profile from this directory.")
+@click.option("--online-chunk", default=0, show_default=True,
+              help="If set, run an online pcc attack processing the traces by chunks of this size and stopping once the key rank converged. The key rank is computed using the known key, and so are the POIs if --pois-algo is snr.")
+@click.option("--online-rank", default=1.0, show_default=True,
+              help="Key rank (log2), computed using the known key, under which the online attack can stop.")
+@click.option("--online-tol", default=1.0, show_default=True,
+              help="Maximum change of the key rank (log2), computed using the known key, between chunks for the online attack to stop.")
+@click.option("--online-patience", default=2, show_default=True, type=click.IntRange(min=1),
+              help="Number of chunks during which the key rank, computed using the known key, has to be stable for the online attack to stop.")
 def attack(variable, pois_algo, num_pois, poi_spacing,
-           attack_algo, k_fold, average_bytes, pooled_cov, window, align, align_attack, align_profile, align_profile_avg, profile):
+           attack_algo, k_fold, average_bytes, pooled_cov, window, align, align_attack, align_profile, align_profile_avg, profile,
+           online_chunk, online_rank, online_tol, online_patience):
     """
     Template attack or profiled correlation attack.
 
@@ -1072,7 +1374,22 @@ def attack(variable, pois_algo, num_pois, poi_spacing,
     global PROFILE, TRACES
     load_data(dataset.SubsetType.ATTACK, profile)
     assert(PROFILE)
-    PROFILE.load()
+    PROFILE.load(PROFILE_FIELDS.get(attack_algo))
+    PROFILE.resample(DATASET.samp_rate)
+
+    # NOTE: The online attack aligns the traces chunk by chunk by itself.
+    if online_chunk > 0:
+        if attack_algo != "pcc" or window != 0 or align_profile_avg is True:
+            raise Exception("The online attack only supports pcc without window nor average alignment")
+        if not FIXED_KEY:
+            raise Exception("This set DOES NOT use a FIXED KEY")
+        compute_variables(variable)
+        found = run_attack_online(online_chunk, pois_algo, len(PROFILE.POIS[0]) if num_pois == 0 else num_pois, poi_spacing, average_bytes,
+                                  align is True or align_attack is True, align is True or align_profile is True, online_rank, online_tol, online_patience)
+        rank()
+        if BRUTEFORCE and not found:
+            bruteforce(BIT_BOUND_END)
+        return
     
 
     # NOTE: Disable those plots as they are not so useful in their current
@@ -1086,10 +1403,10 @@ def attack(variable, pois_algo, num_pois, poi_spacing,
 
     if align is True or align_attack is True:
         l.LOGGER.info("Align attack traces with themselves...")
-        TRACES = analyze.align_all(TRACES, DATASET.samp_rate, template=TRACES[0], tqdm_log=True)
+        TRACES = align_traces(TRACES, TRACES[0])
     if align is True or align_profile is True:
         l.LOGGER.info("Align attack traces with the profile...")
-        TRACES = analyze.align_all(TRACES, DATASET.samp_rate, template=PROFILE.MEAN_TRACE, tqdm_log=True)
+        TRACES = align_traces(TRACES, PROFILE.MEAN_TRACE)
     if align_profile_avg is True:
         l.LOGGER.info("Align average of attack traces with the profile using single shift...")
         shift = analyze.align(template=PROFILE.MEAN_TRACE, target=np.average(TRACES, axis=0), sr=DATASET.samp_rate, get_shift_only=True, normalize=True)
@@ -1124,9 +1441,8 @@ def attack(variable, pois_algo, num_pois, poi_spacing,
         num_pois = len(PROFILE.POIS[0])
 
     if pois_algo != "":
-        classify()
         estimate()
-        find_pois(pois_algo, num_pois, k_fold, poi_spacing)
+        find_pois(pois_algo, k_fold, num_pois, poi_spacing)
 
     reduce_traces(num_pois, window)
     found = run_attack(attack_algo, average_bytes, num_pois, pooled_cov,
@@ -1169,43 +1485,69 @@ def attack(variable, pois_algo, num_pois, poi_spacing,
 @click.option("--profile", default="", type=click.Path(), show_default=True,
              help="If specified, use the profile from this directory.")
 @click.option("--comptype", default="RECOMBIN",
-              help="Choose between amplitude [AMPLITUDE], phase rotation [PHASE_ROT], recombination [RECOMBIN].")
+              help="Choose between amplitude [AMPLITUDE], phase rotation [PHASE_ROT], recombination [RECOMBIN] of both, or a comma-separated list of components to recombine.")
 def attack_recombined(variable, pois_algo, num_pois, poi_spacing,
                       attack_algo, k_fold, average_bytes, pooled_cov, window, align, align_attack, align_profile, align_profile_avg, profile, comptype):
-    global PROFILE, TRACES, COMPTYPE
+    """Attack using one or multiple components of the signal.
+
+    The attack traces are loaded once and every component is derived from the
+    same I/Q buffer. The alignment shifts are computed once on the first
+    component and applied to all of them. Each component is attacked with its
+    own profile (PROFILE can contain "{}" which is replaced by the component
+    name), and the scores of the components are recombined using an addition.
 
-    maxcpa = {"AMPLITUDE": None, "PHASE_ROT": None, "RECOMBIN": None}
+    """
+    global PROFILE, TRACES, COMPTYPE, LOG_PROBA
 
-    if comptype == "AMPLITUDE" or comptype == "PHASE_ROT":
-        compdefault = comptype
-        complist = [comptype]
-    elif comptype == "RECOMBIN":
-        compdefault = "AMPLITUDE"
+    if comptype == "RECOMBIN":
         complist = ["AMPLITUDE", "PHASE_ROT"]
+    else:
+        complist = comptype.split(",")
+    for comp in complist:
+        if comp not in complex.CompType.__members__:
+            raise Exception("Component type not supported: %s" % comp)
 
+    COMPTYPE = complist[0]
+    traces = load_data(dataset.SubsetType.ATTACK, profile.format(complist[0]), comps=complist)
+    assert(PROFILE)
+    profiles = {}
     for comp in complist:
-        COMPTYPE = comp
-        load_data(dataset.SubsetType.ATTACK, profile.format(comp))
-        assert(PROFILE)
-        PROFILE.load()
+        if profile.format(comp) == profile.format(complist[0]):
+            profiles[comp] = PROFILE
+        else:
+            profiles[comp] = dataset.Profile(fp=profile.format(comp))
+        profiles[comp].load(PROFILE_FIELDS.get(attack_algo))
+        profiles[comp].resample(DATASET.samp_rate)
 
-        if PLOT:
-            # Plot the attack trace and its delimiters.
-            libplot.plot_time_spec_sync_axis(DATASET.attack_set.get_trace_from_disk(idx=0, nf=False, ff=True, custom_dtype=CUSTOM_DTYPE)[dataset.TraceType.FF.value],
-                                             peaks=[START_POINT, END_POINT], title="Attack trace #0 and delimiters", xtime=False, comp=COMPTYPE)
-        
-
-        if align is True or align_attack is True:
-            l.LOGGER.info("Align attack traces with themselves...")
-            TRACES = analyze.align_all(TRACES, DATASET.samp_rate, template=TRACES[0], tqdm_log=True)
-        if align is True or align_profile is True:
-            l.LOGGER.info("Align attack traces with the profile...")
-            TRACES = analyze.align_all(TRACES, DATASET.samp_rate, template=PROFILE.MEAN_TRACE, tqdm_log=True)
-        if align_profile_avg is True:
-            l.LOGGER.info("Align average of attack traces with the profile using single shift...")
-            shift = analyze.align(template=PROFILE.MEAN_TRACE, target=np.average(TRACES, axis=0), sr=DATASET.samp_rate, get_shift_only=True, normalize=True)
-            for trace_idx in range(len(TRACES)):
-                TRACES[trace_idx] = analyze.shift(TRACES[trace_idx], shift)
+    if PLOT:
+        # Plot the attack trace and its delimiters.
+        libplot.plot_time_spec_sync_axis(DATASET.attack_set.get_trace_from_disk(idx=0, nf=False, ff=True, custom_dtype=CUSTOM_DTYPE)[dataset.TraceType.FF.value],
+                                         peaks=[START_POINT, END_POINT], title="Attack trace #0 and delimiters", xtime=False, comp=COMPTYPE)
+
+    # NOTE: Shifts are computed on the first component only and applied on
+    # every components, since they are derived from the same traces.
+    if align is True or align_attack is True:
+        l.LOGGER.info("Align attack traces with themselves...")
+        shifts = get_align_shifts(traces[COMPTYPE], traces[COMPTYPE][0])
+        traces = {comp: analyze.shift_all(traces[comp], shifts) for comp in complist}
+    if align is True or align_profile is True:
+        l.LOGGER.info("Align attack traces with the profile...")
+        shifts = get_align_shifts(traces[COMPTYPE], profiles[COMPTYPE].MEAN_TRACE)
+        traces = {comp: analyze.shift_all(traces[comp], shifts) for comp in complist}
+    if align_profile_avg is True:
+        l.LOGGER.info("Align average of attack traces with the profile using single shift...")
+        shift = analyze.align(template=profiles[COMPTYPE].MEAN_TRACE, target=np.average(traces[COMPTYPE], axis=0), sr=DATASET.samp_rate, get_shift_only=True, normalize=True)
+        shifts = np.full(len(traces[COMPTYPE]), shift)
+        traces = {comp: analyze.shift_all(traces[comp], shifts) for comp in complist}
+
+    TRACES = traces[COMPTYPE]
+    compute_variables(variable)
+    if num_pois == 0:
+        num_pois = len(profiles[COMPTYPE].POIS[0])
+
+    maxcpa = {}
+    for comp in complist:
+        COMPTYPE, TRACES, PROFILE = comp, traces[comp], profiles[comp]
 
         if PLOT or SAVE_IMAGES:
             plt.subplot(3, 1, 1)
@@ -1223,44 +1565,30 @@ def attack_recombined(variable, pois_algo, num_pois, poi_spacing,
                 # NOTE: Fix savefig() layout.
                 figure = plt.gcf() # Get current figure
                 figure.set_size_inches(32, 18) # Set figure's size manually to your full screen (32x18).
-                plt.savefig('attack_alignment.pdf', bbox_inches='tight', dpi=100)
+                plt.savefig('attack_alignment_{}.pdf'.format(comp), bbox_inches='tight', dpi=100)
             if PLOT:
                 plt.show()
 
-        compute_variables(variable)
-
-        if num_pois == 0:
-            num_pois = len(PROFILE.POIS[0])
-
         if pois_algo != "":
-            classify()
             estimate()
-            find_pois(pois_algo, num_pois, k_fold, poi_spacing)
+            find_pois(pois_algo, k_fold, num_pois, poi_spacing)
 
         reduce_traces(num_pois, window)
         maxcpa[comp] = run_attack(attack_algo, average_bytes, num_pois, pooled_cov, variable, retmore=True)
 
-    bestguess = [0] * 16
-    pge = [256] * 16
-    cparefs = [None] * NUM_KEY_BYTES
-    maxcpa["RECOMBIN"] = np.empty_like(maxcpa[compdefault])
-    for bnum in range(0, NUM_KEY_BYTES):
-        for kguess in range(256):
-            # NOTE: Combination of correlation coefficient from 2 channels
-            # (amplitude and phase rotation) inspired from POI recombination
-            # but using addition instead of multiplication.
-            if comptype == "RECOMBIN":
-                maxcpa["RECOMBIN"][bnum][kguess] = maxcpa["AMPLITUDE"][bnum][kguess] + maxcpa["PHASE_ROT"][bnum][kguess]
-            else:
-                maxcpa["RECOMBIN"][bnum][kguess] = maxcpa[compdefault][bnum][kguess]
-            LOG_PROBA[bnum][kguess] = np.copy(maxcpa["RECOMBIN"][bnum][kguess])
-        bestguess[bnum] = np.argmax(maxcpa["RECOMBIN"][bnum])
-        cparefs[bnum] = np.argsort(maxcpa["RECOMBIN"][bnum])[::-1]
-        pge[bnum] = list(cparefs[bnum]).index(KEYS[0][bnum])
+    # NOTE: Combination of correlation coefficient from multiple channels
+    # (e.g. amplitude and phase rotation) inspired from POI recombination but
+    # using addition instead of multiplication.
+    # NOTE: Use np.float64 required by HEL (otherwise, segfault).
+    LOG_PROBA = np.sum([maxcpa[comp] for comp in complist], axis=0, dtype=np.float64)
+    bestguess = np.argmax(LOG_PROBA, axis=1)
+    cparefs = np.argsort(LOG_PROBA, axis=1)[:, ::-1]
     known = KEYS[0]
+    pge = [list(cparefs[bnum]).index(known[bnum]) for bnum in range(NUM_KEY_BYTES)]
 
     # Print simple results without key estimation.
     print_result(bestguess, known, pge)
+    found = (bestguess == known).all()
 
     # Always rank if HEL is available.
     rank()
@@ -1268,6 +1596,121 @@ def attack_recombined(variable, pois_algo, num_pois, poi_spacing,
     if BRUTEFORCE and not found:
         bruteforce(BIT_BOUND_END)
 
+# NOTE: Copied from attack_recombined().
+@cli.command()
+@click.option("--variables", default="hw_sbox_out,p_xor_k,sbox_out", show_default=True,
+              help="Comma-separated list of variables to attack.")
+@click.option("--num-pois", default=1, show_default=True,
+              help="Number of points of interest.")
+@click.option("--attack-algo", default="pcc", show_default=True,
+              help="Algo used to rank the guesses (pdf, pcc)")
+@click.option("--average-bytes/--no-average-bytes", default=False, show_default=True,
+              help="Average the profile of the 16 bytes into one, for now it works only with pcc.")
+@click.option("--pooled-cov/--no-pooled-cov", default=False, show_default=True,
+              help="Pooled covariance for template attacks.")
+@click.option("--window", default=0, show_default=True,
+              help="Average poi-window to poi+window samples.")
+@click.option("--align/--no-align", default=False, show_default=True,
+             help="Enable --align-attack and --align-profile options.")
+@click.option("--align-attack/--no-align-attack", default=True, show_default=True,
+             help="Align the attack traces between themselves before to attack.")
+@click.option("--align-profile/--no-align-profile", default=False, show_default=True,
+             help="Align the attack traces with the profile of the first variable before to attack.")
+@click.option("--profile", default="", type=click.Path(), show_default=True,
+             help="If specified, use the profile from this directory.")
+@click.option("--combine/--no-combine", default=True, show_default=True,
+              help="Combine the scores of all variables using an addition.")
+def attack_multi(variables, num_pois, attack_algo, average_bytes, pooled_cov, window, align, align_attack, align_profile, profile, combine):
+    """Attack several leakage variables at once.
+
+    The attack traces are loaded and aligned once and every variable in
+    VARIABLES is attacked with its own profile (PROFILE can contain "{}" which
+    is replaced by the variable name). The traces are only reduced once per
+    distinct profile. The results of each variable are reported, and the
+    scores of all variables are optionally combined using an addition.
+    Otherwise, the scores and the result of the variable with the best key
+    rank are kept.
+
+    """
+    global PROFILE, TRACES, TRACES_REDUCED, LOG_PROBA
+
+    varlist = variables.split(",")
+    load_data(dataset.SubsetType.ATTACK, profile.format(varlist[0]))
+    assert(PROFILE)
+    profiles = {}
+    for var in varlist:
+        if profile.format(var) == profile.format(varlist[0]):
+            profiles[var] = PROFILE
+        else:
+            profiles[var] = dataset.Profile(fp=profile.format(var))
+        profiles[var].load(PROFILE_FIELDS.get(attack_algo))
+        profiles[var].resample(DATASET.samp_rate)
+
+    if align is True or align_attack is True:
+        l.LOGGER.info("Align attack traces with themselves...")
+        TRACES = align_traces(TRACES, TRACES[0])
+    if align is True or align_profile is True:
+        l.LOGGER.info("Align attack traces with the profile...")
+        TRACES = align_traces(TRACES, profiles[varlist[0]].MEAN_TRACE)
+
+    if not FIXED_KEY and any(var not in ("hw_p", "p") for var in varlist):
+        raise Exception("This set DOES NOT use a FIXED KEY")
+
+    scores = {}
+    reduced = {}
+    var_results = {}
+    for var in varlist:
+        PROFILE = profiles[var]
+        compute_variables(var)
+        if len(PROFILE.MEANS[0]) != len(CLASSES):
+            raise Exception("Profile of variable %s has %d classes instead of %d" % (var, len(PROFILE.MEANS[0]), len(CLASSES)))
+        if num_pois == 0:
+            num_pois = len(PROFILE.POIS[0])
+        # NOTE: Variables sharing the same profile share the same reduced traces.
+        if id(PROFILE) not in reduced:
+            reduce_traces(num_pois, window)
+            reduced[id(PROFILE)] = TRACES_REDUCED
+        TRACES_REDUCED = reduced[id(PROFILE)]
+        scores[var] = run_attack(attack_algo, average_bytes, num_pois, pooled_cov, var, retmore=True)
+        known = PLAINTEXTS[0] if FIXED_PLAINTEXT else KEYS[0]
+        print("")
+        print("VARIABLE: {}".format(var))
+        LOG_PROBA = scores[var]
+        found = print_scores(LOG_PROBA, known)
+        rank()
+        var_results[var] = {k: RESULT.data[k] for k in ("correct_bytes", "pge", "pge_median", "rank_min", "rank_rounded", "rank_max") if k in RESULT.data}
+    RESULT.set(variables=var_results)
+
+    if combine is True and len(varlist) > 1:
+        # NOTE: Use np.float64 required by HEL (otherwise, segfault).
+        LOG_PROBA = np.sum([scores[var] for var in varlist], axis=0, dtype=np.float64)
+        print("")
+        print("VARIABLE: {}".format("+".join(varlist)))
+        found = print_scores(LOG_PROBA, KEYS[0])
+        rank()
+    elif len(varlist) > 1:
+        # NOTE: Rank again the best variable, such that LOG_PROBA and the
+        # top-level result are not the ones of the last variable.
+        best = min(varlist, key=lambda var: (var_results[var].get("rank_rounded", np.inf), -var_results[var].get("correct_bytes", 0)))
+        LOG_PROBA = scores[best]
+        print("")
+        print("BEST VARIABLE: {}".format(best))
+        found = print_scores(LOG_PROBA, known)
+        rank()
+        RESULT.set(best_variable=best)
+
+    if BRUTEFORCE and not found:
+        bruteforce(BIT_BOUND_END)
+
+# Print the results of the LOG_PROBA scores of shape (NUM_KEY_BYTES, 256)
+# against the KNOWN key and return True if the key is found.
+def print_scores(log_proba, known):
+    bestguess = np.argmax(log_proba, axis=1)
+    cparefs = np.argsort(log_proba, axis=1)[:, ::-1]
+    pge = [list(cparefs[bnum]).index(known[bnum]) for bnum in range(NUM_KEY_BYTES)]
+    print_result(bestguess, known, pge)
+    return (bestguess == known).all()
+
 
 # * CCS18 ATTACKS, but with new load and new bruteforce
 
@@ -1310,51 +1753,35 @@ def tra_create(template_dir, num_pois, poi_spacing):
     tempKey = KEYS
     fixed_key = FIXED_KEY
 
-    for knum in range(NUM_KEY_BYTES):
-        if(fixed_key):
-            tempSbox = [sbox[PLAINTEXTS[i][knum] ^ tempKey[0][knum]] for i in range(len(TRACES))]
-        else:
-            tempSbox = [sbox[PLAINTEXTS[i][knum] ^ tempKey[i][knum]] for i in range(len(TRACES))]
-
-        tempHW = [hw[s] for s in tempSbox]
-
-        # Sort traces by HW
-        # Make 9 blank lists - one for each Hamming weight
-        tempTracesHW = [[] for _ in range(9)]
-
-        # Fill them up
-        for i, trace in enumerate(TRACES):
-            HW = tempHW[i]
-            tempTracesHW[HW].append(trace)
-
-        # Check to have at least a trace for each HW
-        for HW in range(9):
-            assert len(tempTracesHW[HW]) != 0, "No trace with HW = %d, try increasing the number of traces" % HW
+    # HW coming out of sbox for every subkey and trace.
+    if(fixed_key):
+        tempHW = hw[sbox[PLAINTEXTS[:, :NUM_KEY_BYTES] ^ tempKey[0][:NUM_KEY_BYTES]]].T
+    else:
+        tempHW = hw[sbox[PLAINTEXTS[:, :NUM_KEY_BYTES] ^ tempKey[:, :NUM_KEY_BYTES]]].T
 
-        # Switch to numpy arrays
-        tempTracesHW = [np.array(tempTracesHW[HW]) for HW in range(9)]
+    # Find averages of every HW for every subkey at once.
+    tempCount, tempMeans, _ = analyze.grouped_moments(TRACES, tempHW, 9)
 
-        # Find averages
-        tempMeans = np.zeros((9, len(TRACES[0])))
-        for i in range(9):
-            tempMeans[i] = np.average(tempTracesHW[i], 0)
+    # Check to have at least a trace for each HW
+    for HW in range(9):
+        assert tempCount[:, HW].all(), "No trace with HW = %d, try increasing the number of traces" % HW
 
+    POIs = np.zeros((NUM_KEY_BYTES, num_pois), dtype=int)
+    for knum in range(NUM_KEY_BYTES):
         # Find sum of differences
         tempSumDiff = np.zeros(len(TRACES[0]))
         for i in range(9):
-            for j in range(i):
-                tempSumDiff += np.abs(tempMeans[i] - tempMeans[j])
+            tempSumDiff += np.sum(np.abs(tempMeans[knum][i] - tempMeans[knum][:i]), axis=0)
 
         if PLOT:
             plt.plot(tempSumDiff,label="subkey %d"%knum)
             plt.legend()
 
         # Find POIs
-        POIs = []
         for i in range(num_pois):
             # Find the max
             nextPOI = tempSumDiff.argmax()
-            POIs.append(nextPOI)
+            POIs[knum][i] = nextPOI
 
             # Make sure we don't pick a nearby value
             poiMin = max(0, nextPOI - poi_spacing)
@@ -1362,28 +1789,40 @@ def tra_create(template_dir, num_pois, poi_spacing):
             for j in range(poiMin, poiMax):
                 tempSumDiff[j] = 0
 
-        # Fill up mean and covariance matrix for each HW
-        meanMatrix = np.zeros((9, num_pois))
-        covMatrix  = np.zeros((9, num_pois, num_pois))
-        for HW in range(9):
-            for i in range(num_pois):
-                # Fill in mean
-                meanMatrix[HW][i] = tempMeans[HW][POIs[i]]
-                for j in range(num_pois):
-                    x = tempTracesHW[HW][:,POIs[i]]
-                    y = tempTracesHW[HW][:,POIs[j]]
-                    covMatrix[HW,i,j] = cov(x, y)
-
-        with open(path.join(template_dir, 'POIs_%d' % knum), 'wb') as fp:
-            pickle.dump(POIs, fp)
-        with open(path.join(template_dir, 'covMatrix_%d' % knum), 'wb') as fp:
-            pickle.dump(covMatrix, fp)
-        with open(path.join(template_dir, 'meanMatrix_%d' % knum), 'wb') as fp:
-            pickle.dump(meanMatrix, fp)
+    # Fill up mean and covariance matrix for each HW, reading only the POIs.
+    meanMatrix = np.take_along_axis(tempMeans, POIs[:, np.newaxis, :].repeat(9, axis=1), axis=2)
+    covMatrix = analyze.grouped_cov(TRACES, tempHW, 9, POIs, meanMatrix)
+
+    for knum in range(NUM_KEY_BYTES):
+        np.savez(path.join(template_dir, TRA_TEMPLATE_FN % knum), POIs=POIs[knum], covMatrix=covMatrix[knum], meanMatrix=meanMatrix[knum])
 
     if PLOT:
         plt.show()
 
+# Number of traces for which the TRA log-likelihoods are accumulated at once.
+TRA_CHUNK = 4096
+# Filename of the TRA template of a key byte.
+TRA_TEMPLATE_FN = "template_%d.npz"
+
+def tra_load_template(template_dir, knum):
+    """Load the TRA template of byte KNUM from TEMPLATE_DIR.
+
+    Return a tuple of (POIs, covMatrix, meanMatrix). Templates created before
+    the .npz format are loaded from their separated pickled files.
+
+    """
+    fp = path.join(template_dir, TRA_TEMPLATE_FN % knum)
+    if path.exists(fp):
+        with np.load(fp) as template:
+            return template["POIs"], template["covMatrix"], template["meanMatrix"]
+    with open(path.join(template_dir, 'POIs_%d' % knum), 'rb') as fp:
+        POIs = np.asarray(pickle.load(fp))
+    with open(path.join(template_dir, 'covMatrix_%d' % knum), 'rb') as fp:
+        covMatrix = pickle.load(fp)
+    with open(path.join(template_dir, 'meanMatrix_%d' % knum), 'rb') as fp:
+        meanMatrix = pickle.load(fp)
+    return POIs, covMatrix, meanMatrix
+
 @cli.command()
 @click.argument("template_dir", type=click.Path(exists=True, file_okay=False))
 def tra_attack(template_dir):
@@ -1412,51 +1851,37 @@ def tra_attack(template_dir):
 
     tot = 0
     for knum in range(0,NUM_KEY_BYTES):
-        with open(path.join(template_dir, 'POIs_%d' % knum), 'rb') as fp:
-            POIs = pickle.load(fp)
-        with open(path.join(template_dir, 'covMatrix_%d' % knum), 'rb') as fp:
-            covMatrix = pickle.load(fp)
-        with open(path.join(template_dir, 'meanMatrix_%d' % knum), 'rb') as fp:
-            meanMatrix = pickle.load(fp)
+        POIs, covMatrix, meanMatrix = tra_load_template(template_dir, knum)
 
-        # Ring buffer for keeping track of the last N best guesses
-        window = [None] * 10
-        window_index = 0
+        # Log-likelihood of every trace for every HW, computed at once.
+        a = TRACES[:, POIs]
+        logpdf = np.stack([multivariate_normal(meanMatrix[HW], covMatrix[HW]).logpdf(a).reshape(len(a)) for HW in range(9)], axis=1)
+        # HW coming out of sbox for every trace and key guess.
+        HWs = hw[sbox[PLAINTEXTS[:, knum, np.newaxis] ^ np.arange(256)]]
+
+        # Number of consecutive best guesses equal to the key, the subkey
+        # being found when the last N best guesses are correct.
+        window = 10
+        run = 0
 
         # Running total of log P_k
         P_k = np.zeros(256)
-        for j, trace in enumerate(TRACES):
-            # Grab key points and put them in a small matrix
-            a = [trace[poi] for poi in POIs]
-
-            # Test each key
-            for k in range(256):
-                # Find HW coming out of sbox
-                HW = hw[sbox[PLAINTEXTS[j][knum] ^ k]]
-
-                # Find p_{k,j}
-                rv = multivariate_normal(meanMatrix[HW], covMatrix[HW])
-                p_kj = rv.pdf(a)
-
-                # Add it to running total
-                P_k[k] += np.log(p_kj)
-
-            guessed = P_k.argsort()[-1]
-            window[window_index] = guessed
-            window_index = (window_index + 1) % len(window)
-            if j % 10 == 1:
-                # import os
-                # os.system('clear')
-                print("PGE ",list(P_k.argsort()[::-1]).index(atkKey[knum]), end=' ')
-                # for g in P_k.argsort()[::-1]:
-                    # if g == atkKey[knum]:
-                        # print '\033[92m%02x\033[0m'%g,
-                    # else:
-                        # print '%02x'%g,
+        for start in range(0, len(TRACES), TRA_CHUNK):
+            stop = min(start + TRA_CHUNK, len(TRACES))
+            P_ks = P_k + np.cumsum(np.take_along_axis(logpdf[start:stop], HWs[start:stop], axis=1), axis=0)
+            guessed = P_ks.argmax(axis=1)
+            # Length of the run of correct guesses ending at each trace.
+            j = np.arange(start, stop)
+            last_wrong = np.maximum.accumulate(np.where(guessed != atkKey[knum], j, start - 1 - run))
+            found = np.flatnonzero((j - last_wrong >= window) | ((j == len(TRACES) - 1) & (guessed == atkKey[knum])))
+            stop_j = stop if len(found) == 0 else start + found[0] + 1
+            for jj in range(start + (1 - start) % 10, stop_j, 10):
+                print("PGE ", list(P_ks[jj - start].argsort()[::-1]).index(atkKey[knum]), end=' ')
                 print("")
-
-            if all(k == atkKey[knum] for k in window) or (j == len(TRACES)-1 and guessed == atkKey[knum]):
-                print("subkey %2d found with %4d traces" % (knum, j))
+            P_k = P_ks[stop_j - start - 1]
+            run = stop - 1 - last_wrong[-1]
+            if len(found) > 0:
+                print("subkey %2d found with %4d traces" % (knum, stop_j - 1))
                 tot += 1
                 break
         else:
@@ -1495,7 +1920,7 @@ def cra(align_attack):
 
     if align_attack is True:
         l.LOGGER.info("Align attack traces with themselves...")
-        TRACES = analyze.align_all(TRACES, DATASET.samp_rate, template=TRACES[0], tqdm_log=True)
+        TRACES = align_traces(TRACES, TRACES[0])
 
     if GWAIT:
         print("Loading complete")
@@ -1581,5 +2006,61 @@ def cra(align_attack):
     if BRUTEFORCE and not (bestguess == KEYS[0]).all():
         bruteforce(BIT_BOUND_END)
 
+# * Key ranking
+
+@cli.command()
+@click.argument("log_proba_path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--key", default="", help="Known key in hexadecimal, required if not stored with the scores.")
+@click.option("--bins", default=keyrank.NB_BINS, show_default=True, help="Number of bins per key byte.")
+def rank_compare(log_proba_path, key, bins):
+    """
+    Compare key rank estimations on stored scores.
+
+    LOG_PROBA_PATH is either a .npz file saved using --save-log-proba, or a
+    .npy file containing a LOG_PROBA array of shape (16, 256), in which case
+    --key must be given. Print the rank bounds estimated by the built-in
+    histograms and by HEL if it is installed.
+    """
+    stored = np.load(log_proba_path)
+    if isinstance(stored, np.ndarray):
+        log_proba = stored
+    else:
+        log_proba = stored["LOG_PROBA"]
+        key = key if key != "" else bytes(stored["KEY"].astype(np.uint8)).hex()
+    if key == "":
+        raise Exception("Known key is required for scores stored without key!")
+    known_key = list(bytes.fromhex(key))
+    log_proba = np.ascontiguousarray(log_proba, dtype=np.float64)
+
+    print("Histograms: min=2^%.2f rounded=2^%.2f max=2^%.2f time=%.4fs" % keyrank.rank(log_proba, known_key, bins))
+    try:
+        from python_hel import hel
+    except Exception as e:
+        l.LOGGER.error("Can't import HEL to compare key ranking!")
+        return
+    merge = 2
+    rank_min, rank_rounded, rank_max, time_rank = hel.rank(log_proba, known_key, merge, bins)
+    print("HEL:        min=2^%.2f rounded=2^%.2f max=2^%.2f time=%.4fs" % (np.log2(float(rank_min)), np.log2(float(rank_rounded)), np.log2(float(rank_max)), time_rank))
+
+# * Results
+
+@cli.command()
+@click.argument("output", type=click.Path(dir_okay=False))
+@click.option("--command", default="", help="If specified, only export the records of this attack command.")
+@click.option("--fields", default="", help="Comma-separated list of fields to export (e.g. config.num_traces,rank_rounded,correct_bytes,pge_median). Nested fields are joined with dots.")
+def results_export(output, command, fields):
+    """
+    Export the result records into a table.
+
+    Read the results store of the dataset (or the one given by --result-path)
+    and write one row per record into OUTPUT, either a CSV file using ';' as
+    separator or a Parquet file if its extension is .parquet.
+    """
+    if RESULT_PATH is None:
+        raise Exception("No results store, use --dataset-path or --result-path!")
+    records = results.load(RESULT_PATH, command if command != "" else None)
+    results.export(records, output, fields.split(",") if fields != "" else None)
+    l.LOGGER.info("Exported {} records to '{}'".format(len(records), output))
+
 if __name__ == "__main__":
     cli()
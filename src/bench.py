@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+"""Benchmark suite of the processing and attack commands.
+
+Run the commands of attack.py and dataset.py on synthetic datasets (see
+lib/synthetic.py) inside the current process, measure them using the stages of
+their result records, and append the measures to a history file to track the
+throughput across code changes.
+
+Since the key of the synthetic datasets is known, the benchmarks also check
+that the attacks recover it and that the fast paths of the alignment and of
+the AES give the same results as the reference ones, such that an
+optimization breaking them is caught.
+
+"""
+
+import os
+from os import path
+import subprocess
+import datetime
+import socket
+import shlex
+
+import click
+import numpy as np
+
+import lib.log as l
+import lib.results as results
+import lib.instrument as instrument
+import lib.synthetic as synthetic
+import lib.load as load
+import lib.codec as codec
+import lib.analyze as analyze
+import lib.keyenum as keyenum
+import lib.dataset as dataset
+from lib.soapysdr import MySoapySDR
+import attack
+import dataset as dataset_cli
+
+# * Constants
+
+# File name of the history inside the benchmark directory.
+HISTORY_FN = "bench.jsonl"
+# Benchmarks as (NAME, CLI, SUBSET, ARGS) tuples. ARGS is formatted using the
+# benchmark directory (outdir), the synthetic datasets (extracted and raw) and
+# the options of the run command.
+BENCHMARKS = [
+    ("align", dataset_cli, "train",
+     "--no-log align {extracted} train --num-traces {nb_train} --custom-dtype"),
+    ("profile", attack, "train",
+     "{attack_opts} --num-traces {nb_train} profile --pois-algo snr --num-pois 1 --poi-spacing 2"),
+    ("attack_pcc", attack, "attack",
+     "{attack_opts} --num-traces {nb_attack} attack --attack-algo pcc --profile {extracted}/profile --num-pois 1 --poi-spacing 2 --align"),
+    ("attack_pdf", attack, "attack",
+     "{attack_opts} --num-traces {nb_attack} attack --attack-algo pdf --profile {extracted}/profile --num-pois 1 --poi-spacing 2 --align"),
+    ("cra", attack, "attack",
+     "{attack_opts} --num-traces {nb_attack} cra"),
+    ("tra_create", attack, "train",
+     "{attack_opts} --num-traces {nb_train} tra-create {outdir}/tra --num-pois 1 --poi-spacing 2"),
+    ("tra_attack", attack, "attack",
+     "{attack_opts} --num-traces {nb_attack} tra-attack {outdir}/tra"),
+    ("average", dataset_cli, "raw",
+     "--no-log average {raw} {outdir}/average train --nb-aes {nb_aes} --no-plot --template 0 --stop -1 --force --jobs {jobs}"),
+]
+# Benchmarks of attacks which should recover the whole key of the synthetic
+# dataset.
+KEY_BENCHMARKS = ["attack_pcc", "attack_pdf", "cra", "tra_attack"]
+# Options of attack.py shared by all benchmarks.
+ATTACK_OPTS = "--no-log --no-plot --no-result --no-align-cache --custom-dtype --dataset-path {extracted}"
+
+# * Functions
+
+def get_commit():
+    """Return the hash of the current Git commit of the source code, or None if
+    it cannot be determined."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=path.dirname(path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(cli, args):
+    """Run the click command group CLI with the ARGS list of arguments inside
+    the current process. Return a tuple of the metrics of the whole run (see
+    instrument.measure()) and an error message or None on success."""
+    error = None
+    # NOTE: Commands re-configure the shared logger.
+    level = l.LOGGER.level
+    start = instrument.snapshot()
+    try:
+        cli.cli.main(args, standalone_mode=False)
+    except (Exception, SystemExit) as e:
+        error = "{}: {}".format(type(e).__name__, e)
+    l.LOGGER.setLevel(level)
+    return instrument.measure(start, instrument.snapshot()), error
+
+def check_aes(nb=64, seed=0):
+    """Return an error message if the vectorized AES (see
+    keyenum.aes_encrypt()) differs from attack.aes() for NB random keys, or
+    None otherwise."""
+    rng = np.random.default_rng(seed)
+    pt = rng.integers(0, 256, 16, dtype=np.uint8)
+    keys = rng.integers(0, 256, (nb, 16), dtype=np.uint8)
+    cts = keyenum.aes_encrypt(pt, keys)
+    expected = np.array([attack.aes(pt.tolist(), k.tolist()) for k in keys], dtype=np.uint8)
+    nb_bad = np.count_nonzero(np.any(cts != expected, axis=1))
+    return None if nb_bad == 0 else "{} ciphertexts out of {} differ".format(nb_bad, nb)
+
+def check_shifts(dir, nb=50, max_shift=20, seed=0):
+    """Return an error message if aligning NB traces of the attack subset of
+    the DIR dataset, randomly shifted by up to MAX_SHIFT samples, using
+    analyze.get_shifts_all() and analyze.shift_all() differs from aligning
+    them one by one using analyze.align(), or None otherwise."""
+    dset = dataset.Dataset.pickle_load(dir, log=False)
+    _, traces = load.load_all_traces(dset.attack_set.get_path(), stop=nb, nf_wanted=False, ff_wanted=True, bar=False)
+    rng = np.random.default_rng(seed)
+    traces = analyze.shift_all(np.asarray(traces), rng.integers(-max_shift, max_shift + 1, len(traces)))
+    template = traces[0]
+    expected = np.array([analyze.align(template, t, dset.samp_rate) for t in traces])
+    aligned = analyze.shift_all(traces, analyze.get_shifts_all(traces, dset.samp_rate, template))
+    nb_bad = np.count_nonzero(np.any(aligned != expected, axis=1))
+    return None if nb_bad == 0 else "{} traces out of {} differ".format(nb_bad, len(traces))
+
+# * Command-line interface
+
+@click.group(context_settings={'show_default': True})
+@click.option("--log/--no-log", default=True, help="Enable or disable logging.")
+@click.option("--loglevel", default="INFO", help="Set the logging level.")
+def cli(log, loglevel):
+    """Benchmark suite."""
+    l.configure(log, loglevel)
+
+@cli.command()
+@click.argument("outdir", type=click.Path(file_okay=False))
+@click.option("--nb-train", default=2000, help="Number of traces of the train subset.")
+@click.option("--nb-attack", default=200, help="Number of traces of the attack subset.")
+@click.option("--nb-samples", default=1000, help="Number of samples of an AES computation.")
+@click.option("--nb-aes", default=10, help="Number of AES in the raw traces.")
+@click.option("--nb-raw", default=100, help="Number of raw traces.")
+@click.option("--jitter", default=0, help="Maximum random shift of the traces in samples.")
+@click.option("--jobs", default=0, help="Number of workers of the dataset processing [0 = single process ; -1 = maximum].")
+@click.option("--regenerate/--no-regenerate", default=False, help="Regenerate the synthetic datasets even if they exist.")
+@click.option("--only", default="", help="Comma-separated names of the benchmarks to run [empty = all].")
+@click.option("--history", default="", type=click.Path(dir_okay=False),
+              help="If specified, append the measures to this file instead of the one of OUTDIR.")
+def run(outdir, nb_train, nb_attack, nb_samples, nb_aes, nb_raw, jitter, jobs, regenerate, only, history):
+    """Run the benchmarks.
+
+    OUTDIR is the benchmark directory, containing the synthetic datasets
+    (generated once and re-used by later runs unless --regenerate is given),
+    the outputs of the benchmarks and the history of the measures.
+
+    Exit with a non-zero code if a benchmark fails, if an attack does not
+    recover the key of the synthetic dataset (see KEY_BENCHMARKS) or if a
+    check of the fast paths fails (see check_aes() and check_shifts()).
+
+    """
+    paths = {"outdir": outdir, "extracted": path.join(outdir, "extracted"), "raw": path.join(outdir, "raw")}
+    only = [] if only == "" else only.split(",")
+    # * Generate the synthetic datasets.
+    if regenerate is True or not path.exists(path.join(paths["extracted"], "dataset.pyc")):
+        synthetic.create(paths["extracted"], nb_train, nb_attack, nb_samples=nb_samples, jitter=jitter)
+    if regenerate is True or not path.exists(path.join(paths["raw"], "dataset.pyc")):
+        synthetic.create(paths["raw"], nb_raw, 0, nb_samples=nb_samples, jitter=jitter, nb_aes=nb_aes, seed=1)
+    os.makedirs(path.join(outdir, "average"), exist_ok=True)
+    # * Run the benchmarks.
+    fmt = dict(paths, nb_train=nb_train, nb_attack=nb_attack, nb_aes=nb_aes, jobs=jobs)
+    fmt["attack_opts"] = ATTACK_OPTS.format(**fmt)
+    nb_traces = {"train": nb_train, "attack": nb_attack, "raw": nb_raw}
+    record = {
+        "date": datetime.datetime.now().isoformat(),
+        "host": socket.gethostname(),
+        "cpus": os.cpu_count(),
+        "commit": get_commit(),
+        "config": {"nb_train": nb_train, "nb_attack": nb_attack, "nb_samples": nb_samples, "nb_aes": nb_aes, "nb_raw": nb_raw, "jitter": jitter, "jobs": jobs},
+        "benchmarks": {},
+    }
+    for name, cli_module, subset, args in BENCHMARKS:
+        if only and name not in only:
+            continue
+        l.LOGGER.info("Run benchmark '{}'".format(name))
+        attack.RESULT = None
+        metrics, error = run_benchmark(cli_module, shlex.split(args.format(**fmt)))
+        metrics["traces"] = nb_traces[subset]
+        metrics["throughput"] = nb_traces[subset] / metrics["wall"]
+        if error is not None:
+            metrics["error"] = error
+            l.LOGGER.error("Benchmark '{}' failed: {}".format(name, error))
+        # Keep the stages and the key rank of attack.py commands.
+        if cli_module is attack and attack.RESULT is not None:
+            metrics["stages"] = attack.RESULT.data["stages"]
+            for k in ("correct_bytes", "rank_rounded"):
+                if k in attack.RESULT.data:
+                    metrics[k] = attack.RESULT.data[k]
+        record["benchmarks"][name] = metrics
+    # * Check the results.
+    failures = ["{}: {}".format(name, m["error"]) for name, m in record["benchmarks"].items() if "error" in m]
+    failures += ["{}: {} correct bytes".format(name, m.get("correct_bytes", 0)) for name, m in record["benchmarks"].items()
+                 if name in KEY_BENCHMARKS and "error" not in m and m.get("correct_bytes") != attack.NUM_KEY_BYTES]
+    record["checks"] = {"aes": check_aes(), "shifts": check_shifts(paths["extracted"])}
+    failures += ["{}: {}".format(name, error) for name, error in record["checks"].items() if error is not None]
+    # * Save and print the measures.
+    history = path.join(outdir, HISTORY_FN) if history == "" else history
+    results.append(history, record)
+    print("{:<12} {:>10} {:>10} {:>12} {:>12} {:>8} {:>8}".format("benchmark", "wall [s]", "cpu [s]", "rss peak", "traces/s", "bytes", "rank"))
+    for name, m in record["benchmarks"].items():
+        print("{:<12} {:>10.3f} {:>10.3f} {:>12} {:>12.1f} {:>8} {:>8}".format(
+            name, m["wall"], m["cpu"], instrument.format_size(m["rss_peak"]), m["throughput"],
+            m.get("correct_bytes", "-"), "-" if m.get("rank_rounded") is None else "{:.1f}".format(m["rank_rounded"])))
+    l.LOGGER.info("Measures appended to '{}'".format(history))
+    if failures:
+        l.log_n_exit("{} checks failed:\n{}".format(len(failures), "\n".join(failures)), 1, traceback=False)
+
+@cli.command("codec")
+@click.argument("outdir", type=click.Path(file_okay=False))
+@click.option("--codecs", default="zstd,zlib:1,zlib:6", help="Comma-separated CODEC[:LEVEL] compressions to benchmark.")
+@click.option("--nb-raw", default=100, help="Number of raw traces.")
+@click.option("--nb-aes", default=10, help="Number of AES in the raw traces.")
+@click.option("--nb-samples", default=1000, help="Number of samples of an AES computation.")
+@click.option("--history", default="", type=click.Path(dir_okay=False),
+              help="If specified, append the measures to this file instead of the one of OUTDIR.")
+def codec_run(outdir, codecs, nb_raw, nb_aes, nb_samples, history):
+    """Benchmark the compressed trace storage.
+
+    OUTDIR is the benchmark directory, whose synthetic raw dataset (created if
+    needed, see the run command) is saved with every compression of CODECS in
+    a sub-directory. Loading the compressed traces (see load.load_trace()) is
+    compared against loading the uncompressed traces using np.fromfile().
+
+    """
+    raw = path.join(outdir, "raw")
+    if not path.exists(path.join(raw, "dataset.pyc")):
+        synthetic.create(raw, nb_raw, 0, nb_samples=nb_samples, nb_aes=nb_aes, seed=1)
+    indir = path.join(raw, "train")
+    nb = load.get_nb(indir)
+    size = sum(path.getsize(load.get_dataset_path_unpack_ff(indir, i)) for i in range(nb))
+    record = {
+        "date": datetime.datetime.now().isoformat(),
+        "host": socket.gethostname(),
+        "cpus": os.cpu_count(),
+        "commit": get_commit(),
+        "config": {"codecs": codecs, "nb_raw": nb, "size": size},
+        "benchmarks": {},
+    }
+    def measure_load(dir, fn):
+        start = instrument.snapshot()
+        for i in range(nb):
+            fn(load.get_dataset_path_unpack_ff(dir, i))
+        metrics = instrument.measure(start, instrument.snapshot())
+        metrics["traces"], metrics["throughput"] = nb, nb / metrics["wall"]
+        return metrics
+    # NOTE: Load once to measure all the compressions with a warm page cache.
+    measure_load(indir, MySoapySDR.numpy_load)
+    record["benchmarks"]["fromfile"] = measure_load(indir, lambda fp: np.fromfile(fp, dtype=MySoapySDR.DTYPE))
+    record["benchmarks"]["fromfile"]["size"] = size
+    record["benchmarks"]["uncompressed"] = measure_load(indir, load.load_trace)
+    record["benchmarks"]["uncompressed"]["size"] = size
+    for spec in codecs.split(","):
+        compression = codec.get_codec(*codec.parse(spec))
+        name = "{}_{}".format(*compression)
+        dir = path.join(outdir, "codec", name)
+        os.makedirs(dir, exist_ok=True)
+        start = instrument.snapshot()
+        for i in range(nb):
+            load.save_trace(load.get_dataset_path_unpack_ff(dir, i), load.load_trace(load.get_dataset_path_unpack_ff(indir, i)), compression=compression)
+        wall_save = instrument.measure(start, instrument.snapshot())["wall"]
+        record["benchmarks"][name] = measure_load(dir, load.load_trace)
+        record["benchmarks"][name]["save_wall"] = wall_save
+        record["benchmarks"][name]["size"] = sum(path.getsize(load.get_dataset_path_unpack_ff(dir, i)) for i in range(nb))
+    history = path.join(outdir, HISTORY_FN) if history == "" else history
+    results.append(history, record)
+    print("{:<14} {:>10} {:>10} {:>10} {:>12} {:>8}".format("storage", "load [s]", "cpu [s]", "save [s]", "load [MB/s]", "ratio"))
+    for name, m in record["benchmarks"].items():
+        print("{:<14} {:>10.3f} {:>10.3f} {:>10} {:>12.1f} {:>8.3f}".format(
+            name, m["wall"], m["cpu"], "-" if "save_wall" not in m else "{:.3f}".format(m["save_wall"]),
+            size / 1e6 / m["wall"], m["size"] / size))
+    l.LOGGER.info("Measures appended to '{}'".format(history))
+
+@cli.command()
+@click.argument("history", type=click.Path(exists=True))
+@click.option("--metric", default="throughput", type=click.Choice(["throughput", "wall", "cpu", "rss_peak"]),
+              help="Metric to print for each benchmark.")
+def history(history, metric):
+    """Print the history of the benchmarks.
+
+    HISTORY is either a benchmark directory or a history file. Print one line
+    per run with the METRIC of every benchmark, oldest first.
+
+    """
+    fp = path.join(history, HISTORY_FN) if path.isdir(history) else history
+    records = results.load(fp)
+    names = []
+    for record in records:
+        names += [k for k in record["benchmarks"] if k not in names]
+    print("{:<20} {:<10} ".format("date", "commit") + " ".join("{:>12}".format(n) for n in names))
+    for record in records:
+        values = [record["benchmarks"].get(n, {}).get(metric) for n in names]
+        print("{:<20} {:<10} ".format(record["date"][:19], str(record["commit"])) + " ".join(
+            "{:>12}".format("-" if v is None else "{:.2f}".format(v) if metric != "rss_peak" else instrument.format_size(v)) for v in values))
+
+if __name__ == "__main__":
+    cli()
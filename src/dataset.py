@@ -9,21 +9,42 @@
 
 import os
 from os import path
+import shutil
 import numpy as np
 from matplotlib import pyplot as plt
 from scipy import signal
 import click
+from tqdm import tqdm
 
 import lib.plot as libplot
 import lib.utils as utils
 import lib.debug as libdebug
 import lib.analyze as analyze
+import lib.complex as complex
 import lib.load as load
 import lib.device as device
 import lib.log as l
 import lib.filters as filters
 import lib.triggers as triggers
 import lib.dataset as dataset
+import lib.synthetic as synthetic
+import lib.pipeline as pipeline
+import lib.codec as codec
+import lib.shard as shard
+
+# Help of the --compression option of the commands saving traces.
+COMPRESSION_HELP = "Compress the saved traces using CODEC[:LEVEL] among: {} [empty = no compression].".format(", ".join(codec.CODECS))
+
+# Help of the --shard option of the processing commands.
+SHARD_HELP = "Process the shards planned by the shard-plan command instead of the whole subset, until none is left (see shard-merge)."
+
+def get_compression(spec):
+    """Return the compression of the SPEC string of the --compression option
+    (see codec.parse()), or exit on error."""
+    try:
+        return codec.parse(spec)
+    except Exception as e:
+        l.log_n_exit(str(e), 1, traceback=False)
 
 @click.group(context_settings={'show_default': True})
 @click.option("--log/--no-log", default=True, help="Enable or disable logging.")
@@ -96,6 +117,34 @@ def init(outdir, samp_rate, force, input_gen_init, input_gen_run, input_src_seri
     else:
         l.log_n_exit("{} doesn't exists!".format(outdir), 1)
 
+@cli.command()
+@click.argument("outdir", type=click.Path())
+@click.option("--nb-train", default=1000, help="Number of traces of the train subset.")
+@click.option("--nb-attack", default=1000, help="Number of traces of the attack subset.")
+@click.option("--nb-samples", default=1000, help="Number of samples of an AES computation.")
+@click.option("--pois", default="", help="Comma-separated indexes of the 16 leaking samples [empty = evenly spread].")
+@click.option("--width", default=1, help="Number of samples of each leakage.")
+@click.option("--leakage", default="hw", type=click.Choice(synthetic.LEAKAGES), help="Leakage model of the S-Box output.")
+@click.option("--amplitude", default=0.1, help="Amplitude of the leakage relative to the signal level.")
+@click.option("--noise", default=0.02, help="Standard deviation of the noise relative to the signal level.")
+@click.option("--jitter", default=0, help="Maximum random shift of the traces in samples.")
+@click.option("--nb-aes", default=0, help="Number of AES in raw traces [0 = extracted traces].")
+@click.option("--samp-rate", default=8e6, help="Sampling rate of the dataset.")
+@click.option("--custom-dtype/--no-custom-dtype", default=True, help="Save traces using custom Numpy dtype or default Numpy format.")
+@click.option("--seed", default=0, help="Seed of the random number generator.")
+@click.option("--compression", default="", help=COMPRESSION_HELP)
+def synthetic_create(outdir, nb_train, nb_attack, nb_samples, pois, width, leakage, amplitude, noise, jitter, nb_aes, samp_rate, custom_dtype, seed, compression):
+    """Create a synthetic dataset.
+
+    OUTDIR is the directory where the dataset of leaking AES computations will
+    be created. It can be processed and attacked as a recorded dataset.
+
+    """
+    pois = None if pois == "" else [int(poi) for poi in pois.split(",")]
+    synthetic.create(outdir, nb_train, nb_attack, nb_samples=nb_samples, pois=pois, width=width, leakage=leakage, amplitude=amplitude,
+                     noise=noise, jitter=jitter, nb_aes=nb_aes, samp_rate=samp_rate, custom_dtype=custom_dtype, seed=seed,
+                     compression=get_compression(compression))
+
 @cli.command()
 @click.argument("indir", type=click.Path())
 @click.option("--train/--no-train", default=False, help="Interrogate the train set.")
@@ -213,7 +262,9 @@ def debug_profile(indir):
 @click.option("--stop", default=1, help="Range of traces to process in the subset of the dataset. Set to -1 for maximum.")
 @click.option("--force/--no-force", default=False, help="Force a restart of the processing even if resuming is detected.")
 @click.option("--jobs", default=0, help="Number of workers for processing parallelization [0 = single process ; -1 = maximum].")
-def average(indir, outdir, subset, nb_aes, plot, template, stop, force, jobs):
+@click.option("--compression", default="", help=COMPRESSION_HELP)
+@click.option("--shard/--no-shard", default=False, help=SHARD_HELP)
+def average(indir, outdir, subset, nb_aes, plot, template, stop, force, jobs, compression, shard):
     """Average multiple AES executions.
 
     INDIR corresponds to a directory containing a dataset with traces
@@ -228,9 +279,15 @@ def average(indir, outdir, subset, nb_aes, plot, template, stop, force, jobs):
     # * Load input dataset and selected subset.
     dproc = dataset.DatasetProcessing(indir, subset, outdir=outdir, stop=stop)
     # * Resume from previously saved dataset.
-    dproc.resume(from_zero=force)
+    if shard is False:
+        dproc.resume(from_zero=force)
     # * Define and run the processing.
-    dproc.create("Average", analyze.average_aes_dproc, libplot.PlotOnce(default=plot), (nb_aes, template), nb=jobs)
+    dproc.create("Average", analyze.average_aes_dproc, libplot.PlotOnce(default=plot), (nb_aes, template), nb=jobs,
+                 compression=get_compression(compression))
+    if shard is True:
+        # NOTE: The dataset is saved by the shard-merge command.
+        dproc.process_shards()
+        return
     dproc.process()
     # * Save the resulting dataset.
     dproc.sset.prune_input(save=True)
@@ -248,7 +305,9 @@ def average(indir, outdir, subset, nb_aes, plot, template, stop, force, jobs):
 @click.option("--jobs", default=0, help="Number of workers for processing parallelization [0 = single process ; -1 = maximum].")
 @click.option("--idx", default=0, help="Index of the AES to extract from the trace.")
 @click.option("--window", default=0, help="Sample window extracted around the detected AES.")
-def extract(indir, outdir, subset, nb_aes, plot, template, stop, force, jobs, idx, window):
+@click.option("--compression", default="", help=COMPRESSION_HELP)
+@click.option("--shard/--no-shard", default=False, help=SHARD_HELP)
+def extract(indir, outdir, subset, nb_aes, plot, template, stop, force, jobs, idx, window, compression, shard):
     """Extract an aligned AES.
 
     INDIR corresponds to a directory containing a dataset with traces
@@ -265,14 +324,288 @@ def extract(indir, outdir, subset, nb_aes, plot, template, stop, force, jobs, id
     # * Load input dataset and selected subset.
     dproc = dataset.DatasetProcessing(indir, subset, outdir=outdir, stop=stop)
     # * Resume from previously saved dataset.
-    dproc.resume(from_zero=force)
+    if shard is False:
+        dproc.resume(from_zero=force)
     # * Define and run the processing.
-    dproc.create("Extract", analyze.extract_aes_dproc, libplot.PlotOnce(default=plot), (nb_aes, template, idx, window), nb=jobs)
+    dproc.create("Extract", analyze.extract_aes_dproc, libplot.PlotOnce(default=plot), (nb_aes, template, idx, window), nb=jobs,
+                 compression=get_compression(compression))
+    if shard is True:
+        # NOTE: The dataset is saved by the shard-merge command.
+        dproc.process_shards()
+        return
     dproc.process()
     # * Save the resulting dataset.
     dproc.sset.prune_input(save=True)
     dproc.dset.pickle_dump()
-    
+
+@cli.command("pipeline")
+@click.argument("indir", type=click.Path())
+@click.argument("outdir", type=click.Path())
+@click.argument("subset", type=str)
+@click.argument("stages", type=str)
+@click.option("--nb-aes", default=1, help="Number of AES in the trace [extract, average].")
+@click.option("--plot/--no-plot", default=True, help="Plot a summary of the processing.")
+@click.option("--template", default=-1, help="Specify template signal index to use. -1 means prompting [extract, average].")
+@click.option("--stop", default=1, help="Range of traces to process in the subset of the dataset. Set to -1 for maximum.")
+@click.option("--force/--no-force", default=False, help="Force a restart of the processing even if resuming is detected.")
+@click.option("--jobs", default=0, help="Number of workers for processing parallelization [0 = single process ; -1 = maximum].")
+@click.option("--idx", default=0, help="Index of the AES to extract from the trace [extract].")
+@click.option("--window", default=0, help="Sample window extracted around the detected AES [extract].")
+@click.option("--comptype", default="AMPLITUDE", help="Component to select among AMPLITUDE, PHASE or PHASE_ROT [comp].")
+@click.option("--start-point", default=0, help="Index of the first sample kept [truncate].")
+@click.option("--end-point", default=0, help="Index of the last sample kept [truncate ; 0 = last sample].")
+@click.option("--compression", default="", help=COMPRESSION_HELP)
+@click.option("--shard/--no-shard", default=False, help=SHARD_HELP)
+def pipeline_run(indir, outdir, subset, stages, nb_aes, plot, template, stop, force, jobs, idx, window, comptype, start_point, end_point, compression, shard):
+    """Process traces through chained stages.
+
+    INDIR corresponds to a directory containing a dataset with traces
+    containing multiple AES. For each trace, the program will apply all the
+    STAGES one after the other and will construct a new dataset with the
+    result, without saving the intermediate traces.
+
+    OUTDIR corresponds to the directory where the new dataset will be stored.
+
+    SUBSET corresponds to the subset's name that will be proceed.
+
+    STAGES corresponds to the comma-separated list of stages, in the order of:
+    extract, average, align, comp, truncate, normalize, compress (see
+    lib/pipeline.py).
+
+    """
+    try:
+        stages = pipeline.parse(stages)
+    except Exception as e:
+        l.log_n_exit(str(e), 1, traceback=False)
+    opts = {"nb_aes": nb_aes, "template": template, "idx": idx, "window": window,
+            "comptype": comptype, "start": start_point, "end": end_point}
+    # * Load input dataset and selected subset.
+    dproc = dataset.DatasetProcessing(indir, subset, outdir=outdir, stop=stop)
+    # * Resume from previously saved dataset.
+    if shard is False:
+        dproc.resume(from_zero=force)
+    # * Define and run the processing.
+    dproc.create("Pipeline", pipeline.pipeline_dproc, libplot.PlotOnce(default=plot), (stages, opts), nb=jobs,
+                 custom_dtype="compress" in stages, compression=get_compression(compression))
+    if shard is True:
+        # NOTE: The dataset is saved by the shard-merge command.
+        dproc.process_shards()
+        return
+    dproc.process()
+    # * Save the resulting dataset.
+    dproc.sset.prune_input(save=True)
+    dproc.dset.pickle_dump()
+
+@cli.command("shard-plan")
+@click.argument("indir", type=click.Path())
+@click.argument("outdir", type=click.Path())
+@click.argument("subset", type=str)
+@click.option("--size", default=1000, help="Number of traces of a shard.")
+@click.option("--stop", default=-1, help="Range of traces to process in the subset of the dataset. Set to -1 for maximum.")
+@click.option("--force/--no-force", default=False, help="Replace an existing plan, removing the progress of its shards.")
+def shard_plan(indir, outdir, subset, size, stop, force):
+    """Split a processing into shards.
+
+    INDIR corresponds to a directory containing a dataset.
+
+    OUTDIR corresponds to the directory where the processed dataset will be
+    stored, which has to be shared by all the workers.
+
+    SUBSET corresponds to the subset's name that will be proceed.
+
+    Save a plan splitting the traces of the subset into shards of consecutive
+    traces in OUTDIR. The average, extract and pipeline commands run with
+    --shard, from any number of processes or hosts sharing OUTDIR, then
+    claim and process the shards one by one. Once all shards are done, run
+    the shard-merge command.
+
+    """
+    dset = dataset.Dataset.pickle_load(indir, quit_on_error=True)
+    sset = dset.get_subset(subset)
+    if sset is None:
+        l.log_n_exit("Bad SUBSET value!", 1)
+    dir = shard.get_dir(outdir, sset.name)
+    if shard.load_plan(dir) is not None:
+        if force is False:
+            l.log_n_exit("A shard plan already exists in '{}', use --force to replace it!".format(dir), 1, traceback=False)
+        shutil.rmtree(dir)
+    stop = sset.get_nb_trace_ondisk() if stop == -1 else stop
+    plan = shard.plan(dir, sset.name, stop, size)
+    l.LOGGER.info("Planned {} shards of {} traces into '{}'".format(len(plan["shards"]), size, dir))
+
+@cli.command("shard-merge")
+@click.argument("indir", type=click.Path())
+@click.argument("outdir", type=click.Path())
+@click.argument("subset", type=str)
+def shard_merge(indir, outdir, subset):
+    """Merge the processed shards.
+
+    INDIR, OUTDIR and SUBSET are the ones given to the shard-plan command.
+
+    Once all the shards planned by the shard-plan command have been
+    processed, save the resulting dataset into OUTDIR as the processing
+    command would have without --shard. The bad entries and the template do
+    not depend on the workers nor on the order of the shards.
+
+    """
+    # * Load input dataset and selected subset.
+    dproc = dataset.DatasetProcessing(indir, subset, outdir=outdir)
+    # * Merge the shards.
+    try:
+        dproc.merge_shards()
+    except Exception as e:
+        l.log_n_exit(str(e), 1, traceback=False)
+    # * Save the resulting dataset.
+    dproc.sset.prune_input(save=True)
+    dproc.dset.pickle_dump()
+
+@cli.command()
+@click.argument("indir", type=click.Path())
+@click.argument("subset", type=str)
+@click.option("--template", "templates", multiple=True, default=["trace"], type=click.Choice(["trace", "profile"]),
+              help="Template of each successive alignment: first trace of the subset or mean trace of the profile. Repeat to chain alignments in the same order than attack.py.")
+@click.option("--profile", default="", type=click.Path(), help="Path of a standalone profile used instead of the dataset's one.")
+@click.option("--num-traces", default=0, help="Number of traces to align [0 = maximum].")
+@click.option("--start-point", default=0, help="Index of the first point of each trace.")
+@click.option("--end-point", default=0, help="Index of the last point of each trace.")
+@click.option("--norm/--no-norm", default=False, help="Normalize each trace individually.")
+@click.option("--norm2/--no-norm2", default=False, help="Normalize each trace set.")
+@click.option("--comptype", default="AMPLITUDE", help="Choose between amplitude [AMPLITUDE] or phase rotation [PHASE_ROT].")
+@click.option("--custom-dtype/--no-custom-dtype", default=False, help="Load traces using custom Numpy dtype or default Numpy format.")
+@click.option("--align-subsample", default="none", type=click.Choice(["none", "parabolic", "upsample"]),
+              help="Refine the alignment below the sample.")
+@click.option("--skip-bad/--no-skip-bad", default=True, help="Skip the invalid traces of the subset without loading them.")
+def align(indir, subset, templates, profile, num_traces, start_point, end_point, norm, norm2, comptype, custom_dtype, align_subsample, skip_bad):
+    """Precompute alignment shifts.
+
+    INDIR is the path of a directory containing a dataset.
+
+    SUBSET is the target subset [train | attack].
+
+    Compute and save the alignment shifts in the subset directory, such that
+    attack.py runs using the same options only apply them instead of
+    correlating the traces again.
+
+    """
+    # NOTE: The loading and the key must be kept in sync with attack.py
+    # load_data() and align_traces().
+    dset = dataset.Dataset.pickle_load(indir, quit_on_error=True)
+    sset = dset.get_subset(subset)
+    if sset is None:
+        l.log_n_exit("Bad SUBSET value!", 1)
+    if profile == "":
+        prof = dset.get_profile()
+    else:
+        prof = dataset.Profile(fp=profile)
+    if "profile" in templates:
+        if prof is None:
+            l.log_n_exit("No profile available to align against!", 1)
+        prof.load(["MEAN_TRACE", "SAMP_RATE"])
+        prof.resample(dset.samp_rate)
+    valid = sset.get_valid() if skip_bad else None
+    valid = None if valid is not None and valid.all() else valid
+    if custom_dtype is True and not load.is_dataset_packed(sset.get_path()):
+        traces = sset.load_trace_comps(range(0, num_traces), [comptype], start_point=start_point, end_point=end_point, valid=valid)[0]
+    else:
+        sset.load_trace(range(0, num_traces), nf=False, ff=True, start_point=start_point, end_point=end_point, custom_dtype=custom_dtype, valid=valid)
+        traces = sset.ff
+    _, _, _, traces = load.reduce_entry_all_dataset(sset.ks, sset.pt, None, traces, num_traces, valid=valid)
+    traces = complex.get_comp(traces, comptype)
+    if norm or norm2:
+        traces = analyze.normalize_zscore(traces, norm2)
+    subsample = align_subsample != "none"
+    key = None
+    for template in templates:
+        template = traces[0] if template == "trace" else prof.MEAN_TRACE
+        key = analyze.get_shifts_key(template, chain=key, sr=dset.samp_rate,
+                                     start=start_point, end=end_point, samples=traces.shape[1],
+                                     comptype=comptype, norm=norm, norm2=norm2,
+                                     nb=len(traces) if norm or norm2 else 0,
+                                     subsample=align_subsample, **dataset.Subset.get_valid_key(valid), **sset.get_traces_key())
+        shifts = sset.get_shifts(key, traces, dset.samp_rate, template, subsample=subsample,
+                                 method=align_subsample if subsample else "parabolic")
+        traces = analyze.shift_all(traces, shifts)
+        l.LOGGER.info("Shifts saved to '{}'".format(sset.get_shifts_path(key)))
+
+@cli.command()
+@click.argument("indir", type=click.Path())
+@click.argument("subset", type=str)
+@click.option("--custom-dtype/--no-custom-dtype", default=False, help="Load traces using custom Numpy dtype or default Numpy format.")
+def scan(indir, subset, custom_dtype):
+    """Scan traces for bad entries.
+
+    INDIR is the path of a directory containing a dataset.
+
+    SUBSET is the target subset [train | attack].
+
+    Load every trace of the subset one by one and save the validity bitmap of
+    the subset in its directory, such that attack.py and the align command
+    skip the invalid traces without loading them. A trace is invalid if it is
+    registered as a bad entry, if it cannot be loaded, if it is empty, filled
+    with zeroes or of a different length than the first trace.
+
+    """
+    dset = dataset.Dataset.pickle_load(indir, quit_on_error=True)
+    sset = dset.get_subset(subset)
+    if sset is None:
+        l.log_n_exit("Bad SUBSET value!", 1)
+    # NOTE: Start from the bad entries, but not from a previous scan.
+    valid = np.ones(max(sset.get_nb_trace_ondisk(), 0), dtype=bool)
+    valid[[i for i in sset.bad_entries if i < len(valid)]] = False
+    ref_size = None
+    for i in tqdm(range(len(valid)), desc="Scan"):
+        _, ff = load.load_pair_trace(sset.get_path(), i, nf=False, ff=True, custom_dtype=custom_dtype)
+        if ff[0] is None:
+            valid[i] = False
+            continue
+        ref_size = len(ff[0]) if ref_size is None else ref_size
+        if load.find_bad_entry(ff, ref_size=ref_size, log=False):
+            valid[i] = False
+    load.save_valid(sset.get_path(), valid)
+    l.LOGGER.info("{} invalid traces out of {}, validity bitmap saved to '{}'".format(
+        np.count_nonzero(~valid), len(valid), load.get_dataset_path_valid(sset.get_path())))
+
+@cli.command()
+@click.argument("indir", type=click.Path())
+@click.argument("subset", type=str)
+@click.option("--compression", default="zstd", help="Compress the traces using CODEC[:LEVEL] among: {} [empty = decompress].".format(", ".join(codec.CODECS)))
+@click.option("--custom-dtype/--no-custom-dtype", default=True, help="Load and save traces using custom Numpy dtype or default Numpy format.")
+def compress(indir, subset, compression, custom_dtype):
+    """Compress traces in place.
+
+    INDIR is the path of a directory containing a dataset.
+
+    SUBSET is the target subset [train | attack].
+
+    Re-write every trace of the subset using the chunked compressed format of
+    lib/codec.py, which is loaded transparently by all commands, or
+    uncompressed if COMPRESSION is empty. Every trace is replaced atomically,
+    such that the command can be interrupted and run again. The command
+    refuses to run if a trace is not saved in the format given by
+    --custom-dtype, since converting it would lose data.
+
+    """
+    compression = get_compression(compression)
+    dset = dataset.Dataset.pickle_load(indir, quit_on_error=True)
+    sset = dset.get_subset(subset)
+    if sset is None:
+        l.log_n_exit("Bad SUBSET value!", 1)
+    size_in, size_out = 0, 0
+    for i in tqdm(range(max(sset.get_nb_trace_ondisk(), 0)), desc="Compress"):
+        for fp in (load.get_dataset_path_unpack_nf(sset.get_path(), i), load.get_dataset_path_unpack_ff(sset.get_path(), i)):
+            if not path.exists(fp):
+                continue
+            if load.is_custom_dtype(fp) != custom_dtype:
+                l.log_n_exit("Trace '{}' is {}saved using our custom dtype, run again with {}!".format(
+                    fp, "" if custom_dtype is False else "not ", "--custom-dtype" if custom_dtype is False else "--no-custom-dtype"), 1, traceback=False)
+            # NOTE: Keep the extension, np.save() appends one otherwise.
+            fp_tmp = "{}.tmp.npy".format(fp[:-len(".npy")])
+            load.save_trace(fp_tmp, load.load_trace(fp, custom_dtype=custom_dtype), custom_dtype=custom_dtype, compression=compression)
+            size_in, size_out = size_in + path.getsize(fp), size_out + path.getsize(fp_tmp)
+            os.replace(fp_tmp, fp)
+    load.get_manifest(sset.get_path(), refresh=range(max(sset.get_nb_trace_ondisk(), 0)))
+    l.LOGGER.info("Traces re-written from {:.1f} MB to {:.1f} MB".format(size_in / 1e6, size_out / 1e6))
+
 if __name__ == "__main__":
     cli()
 
@@ -3,8 +3,12 @@ already loaded in memory.
 
 """
 
+import fractions
+import hashlib
+
 import numpy as np
 from scipy import signal
+from scipy import fft
 from tqdm import tqdm
 
 import lib.log as l
@@ -26,6 +30,26 @@ from lib.exception import BadAESDetection
 FMT_IQ = 0
 FMT_MAGNITUDE = 1
 
+# Maximum number of samples (signals x samples) correlated at once by
+# get_shifts_all(), used to bound the memory of the FFT.
+ALIGN_CHUNK_SAMPLES = 2**24
+# Default upsampling factor of the correlation peak for sub-sample alignment.
+ALIGN_UPSAMPLE = 16
+# Number of zeros padded to signals before applying a fractional shift.
+ALIGN_FRAC_PAD = 64
+# Number of signals accumulated at once by grouped_moments() and grouped_cov().
+GROUPED_CHUNK = 1024
+# Maximum number of samples (signals x samples) resampled at once by resample().
+RESAMPLE_CHUNK_SAMPLES = 2**24
+# Maximum denominator of the resampling ratio used by resample().
+RESAMPLE_MAX_DENOMINATOR = 1000
+
+# * Caches
+
+# Last template spectrum computed by get_template_spectrum() as a (key,
+# spectrum) tuple.
+TEMPLATE_SPECTRUM = None
+
 # * Dataset-level
 
 def print_traces_idx_with_ks_n_pt_equal(ks, pt):
@@ -188,7 +212,7 @@ def fill_zeros_if_bad(ref, test, log=True, log_idx=-1):
     bad = False
     if test is None:
         bad = True
-    if test.shape != ref.shape:
+    elif test.shape != ref.shape:
         bad = True
         if log is True:
             l.LOGGER.warning("Trace #{} is of shape {} while reference trace is {}!".format(log_idx, test.shape, ref.shape))
@@ -319,9 +343,13 @@ def average_from_starts(template, arr, starts, sr):
     Average all segments delimited by STARTS contained in ARR of sampling rate
     SR using template signal TEMPLATE.
 
+    All segments are extracted at once, then aligned at once using the FFT
+    against the template spectrum, which is computed only once for successive
+    traces.
+
     """
     extracted = analyze.extract(arr, starts, len(template))
-    aligned   = analyze.align_all(extracted, sr, template, False)
+    aligned   = analyze.shift_all(extracted, analyze.get_shifts_all(extracted, sr, template))
     # NOTE: Set NORM to False as we average signals extracted from a single
     # trace, hence with same amplitude levels.
     return analyze.average(aligned, norm=False)
@@ -362,22 +390,18 @@ def extract(s, starts, length=0, end_offset=0):
     # Extract a fixed length.
     if length > 0:
         length += end_offset
+        starts = np.asarray(starts).astype(np.int64)
         extracted = np.zeros((len(starts), length), dtype=s.dtype)
-        for i in range(len(starts)):
-            condition = np.zeros((len(s)), dtype=s.dtype)
-            # Lower and upper bounds of condition signal for extraction.
-            li = int(starts[i])
-            ui = int(starts[i] + length)
-            # If upper bound is out of bound, do not extract the signal which
-            # would be too short -- just let it initialized to 0.
-            if ui >= len(s):
-                continue
+        # If upper bound is out of bound, do not extract the signal which
+        # would be too short -- just let it initialized to 0.
+        valid = starts + length < len(s)
+        if np.any(valid):
             # Sanity-check of bounds.
-            assert li >= 0
-            assert ui < len(s)
-            # Process to the extraction.
-            condition[li:ui] = 1
-            extracted[i] = np.copy(np.extract(condition, s))
+            assert np.all(starts[valid] >= 0)
+            # Process to the extraction using a single gather from a strided
+            # view of all the windows of S (no copy of S).
+            windows = np.lib.stride_tricks.sliding_window_view(s, length)
+            extracted[valid] = windows[starts[valid]]
         return extracted
     # Extract a variable length.
     else:
@@ -445,13 +469,168 @@ def align_nb(s, nb, sr, template, tqdm_log=True):
     s_aligned = np.array(s_aligned, dtype=s.dtype)
     return s_aligned
 
-def align_all(s, sr, template=None, tqdm_log=True):
+def align_all(s, sr, template=None, tqdm_log=True, subsample=False, method="parabolic"):
     """Align the signals contained in the S 2D np.array of sampling rate
     SR. Use TEMPLATE signal (1D np.array) as template/reference signal if
     specified, otherwise use the first signal of the S array.
 
+    The alignment is computed in batch using get_shifts_all() and
+    shift_all(). If SUBSAMPLE is set to True, refine the cross-correlation
+    peak below the sample using METHOD and apply fractional shifts,
+    otherwise, shift the signals by whole samples like align().
+
+    """
+    template = template if template is not None else s[0]
+    shifts = get_shifts_all(s, sr, template, subsample=subsample, method=method, tqdm_log=tqdm_log)
+    return shift_all(s, shifts)
+
+def get_template_spectrum(template, sr, n):
+    """Return the conjugated spectrum of length N of TEMPLATE (1D np.array)
+    low-pass filtered like in align(), for a sampling rate SR.
+
+    The last spectrum is cached, such that aligning the signals of successive
+    traces against the same template (e.g. the segments of every trace in
+    average_from_starts()) only filters and transforms it once.
+
+    """
+    global TEMPLATE_SPECTRUM
+    key = get_shifts_key(template, sr=sr, n=n)
+    if TEMPLATE_SPECTRUM is None or TEMPLATE_SPECTRUM[0] != key:
+        template_lpf = filters.butter_lowpass_filter(complex.get_amplitude(template), sr / 4, sr)
+        TEMPLATE_SPECTRUM = (key, np.conj(fft.fft(template_lpf, n)))
+    return TEMPLATE_SPECTRUM[1]
+
+def get_corr_all(s, template, template_spec=None):
+    """Cross-correlate multiple signals against a template using the FFT.
+
+    Return a 2D np.array of shape (len(s), len(s[0]) + len(template) - 1)
+    where row i is equal to signal.correlate(s[i], template), i.e. the peak
+    index minus (len(template) - 1) is the shift of get_shift_corr().
+
+    Also return the complex cross-spectrum of shape (len(s), n) and the FFT
+    length n used to compute it, such that the correlation can be evaluated at
+    fractional lags afterwards (see get_shifts_all()).
+
+    If TEMPLATE_SPEC is specified, it is used as the conjugated spectrum of
+    TEMPLATE of length n instead of computing it.
+
+    """
+    assert s.ndim == 2 and template.ndim == 1
+    nb_s, nb_t = s.shape[1], len(template)
+    n = fft.next_fast_len(nb_s + nb_t - 1)
+    # NOTE: The template spectrum is computed only once for all signals.
+    template_spec = np.conj(fft.fft(template, n)) if template_spec is None else template_spec
+    spec = fft.fft(s, n, axis=-1) * template_spec
+    corr = fft.ifft(spec, axis=-1).real
+    # Re-order circular lags [0 ; nb_s - 1] and [-(nb_t - 1) ; -1] as in
+    # signal.correlate() full mode.
+    corr = np.concatenate((corr[:, n - (nb_t - 1):], corr[:, :nb_s]), axis=-1)
+    return corr, spec, n
+
+def get_shifts_all(s, sr, template, subsample=False, method="parabolic", upsample=ALIGN_UPSAMPLE, tqdm_log=False):
+    """Get the shifts aligning signals against a template.
+
+    Compute the shift maximizing the cross-correlation of every signal of the
+    S 2D np.array of sampling rate SR against the TEMPLATE signal, using the
+    same low-pass filtered amplitude than align(). Signals are processed in
+    chunks to bound the memory used by the FFT.
+
+    If SUBSAMPLE is set to False, return a 1D np.array of integers equal to
+    the shifts computed by align(get_shift_only=True). Otherwise, refine the
+    correlation peak and return a 1D np.array of floats. METHOD can be:
+    - "parabolic": Fit a parabola on the peak and its two neighbours.
+    - "upsample": Evaluate the band-limited correlation around the peak with a
+      resolution of 1/UPSAMPLE sample (matrix-multiply DFT).
+
+    """
+    assert s.ndim == 2, "Signals to align should be a 2D-ndarray!"
+    assert method in ("parabolic", "upsample"), "Bad sub-sample method!"
+    lpf_freq = sr / 4
+    template_spec = get_template_spectrum(template, sr, fft.next_fast_len(s.shape[1] + len(template) - 1))
+    shifts = np.zeros(len(s), dtype=np.float64 if subsample is True else np.int64)
+    chunk = max(1, ALIGN_CHUNK_SAMPLES // (s.shape[1] + len(template)))
+    lrange = range(0, len(s), chunk)
+    if tqdm_log:
+        lrange = tqdm(lrange, desc="Align")
+    for start in lrange:
+        stop = min(start + chunk, len(s))
+        s_lpf = filters.butter_lowpass_filter(complex.get_amplitude(s[start:stop]), lpf_freq, sr)
+        corr, spec, n = get_corr_all(s_lpf, template, template_spec)
+        peak = np.argmax(corr, axis=-1)
+        lag = peak - (len(template) - 1)
+        if subsample is False:
+            shifts[start:stop] = lag
+        elif method == "parabolic":
+            # Clip the neighbours to handle a peak located on an edge, which
+            # gives a zero refinement.
+            rows = np.arange(len(corr))
+            y0 = corr[rows, np.maximum(peak - 1, 0)]
+            y1 = corr[rows, peak]
+            y2 = corr[rows, np.minimum(peak + 1, corr.shape[1] - 1)]
+            denom = y0 - 2 * y1 + y2
+            delta = np.divide(0.5 * (y0 - y2), denom, out=np.zeros_like(denom), where=denom != 0)
+            shifts[start:stop] = lag + np.clip(delta, -0.5, 0.5)
+        elif method == "upsample":
+            # Evaluate the correlation at lags [lag - 1 ; lag + 1] using the
+            # inverse DFT of the cross-spectrum only on those points.
+            offsets = np.arange(-upsample, upsample + 1) / upsample
+            freqs = fft.fftfreq(n)
+            spec = spec * np.exp(2j * np.pi * np.outer(lag, freqs))
+            corr_up = np.empty((len(spec), len(offsets)))
+            for i, offset in enumerate(offsets):
+                corr_up[:, i] = (spec @ np.exp(2j * np.pi * freqs * offset)).real
+            shifts[start:stop] = lag + offsets[np.argmax(corr_up, axis=-1)]
+    return shifts
+
+def get_shifts_key(template, **params):
+    """Return a key identifying shifts computed against a template.
+
+    The key is a short hexadecimal hash of the TEMPLATE signal (1D np.array)
+    and of PARAMS, keyword arguments describing how the aligned signals and
+    the shifts have been obtained (e.g. sampling rate, window, component,
+    sub-sample method). Two computations using the same key are expected to
+    give the same shifts for the same signal indexes.
+
+    """
+    template = np.ascontiguousarray(template)
+    h = hashlib.sha1(template.tobytes())
+    h.update("{}{}".format(template.dtype, template.shape).encode())
+    h.update(repr(sorted(params.items())).encode())
+    return h.hexdigest()[:16]
+
+def shift_all(s, shifts):
+    """Shift multiple signals.
+
+    Shift every signal of the S 2D np.array by the corresponding value of the
+    SHIFTS 1D np.array, following the convention of shift() (positive shift
+    to the left, empty parts filled with zeros). Integer shifts are applied
+    with a single gather, while fractional shifts are applied with a phase
+    ramp in the frequency domain on top of the nearest whole shift.
+
+    Return a new 2D np.array of same shape and dtype as S.
+
     """
-    return align_nb(s, len(s), sr, template if template is not None else s[0], tqdm_log)
+    assert s.ndim == 2 and len(s) == len(shifts)
+    shifts = np.asarray(shifts)
+    shifts_int = np.rint(shifts).astype(np.int64)
+    # * Fractional part.
+    if np.issubdtype(shifts.dtype, np.floating) and np.any(shifts != shifts_int):
+        frac = shifts - shifts_int
+        # NOTE: Pad to limit the circular wrap of the interpolation, the
+        # remaining part being cropped (|frac| <= 0.5).
+        n = fft.next_fast_len(s.shape[1] + ALIGN_FRAC_PAD)
+        if complex.is_iq(s):
+            ramp = np.exp(2j * np.pi * np.outer(frac, fft.fftfreq(n)))
+            s = fft.ifft(fft.fft(s, n, axis=-1) * ramp, axis=-1)[:, :s.shape[1]].astype(s.dtype)
+        else:
+            ramp = np.exp(2j * np.pi * np.outer(frac, fft.rfftfreq(n)))
+            s = fft.irfft(fft.rfft(s, n, axis=-1) * ramp, n, axis=-1)[:, :s.shape[1]].astype(s.dtype)
+    # * Integer part.
+    idx = np.arange(s.shape[1])[np.newaxis, :] + shifts_int[:, np.newaxis]
+    valid = (idx >= 0) & (idx < s.shape[1])
+    shifted = np.take_along_axis(s, np.clip(idx, 0, s.shape[1] - 1), axis=-1)
+    shifted[~valid] = 0
+    return shifted
 
 def average(arr, norm=False):
     """Average a series of signals between them.
@@ -672,3 +851,148 @@ def process_iq(sig, amplitude=False, phase=False, norm=False, log=False):
     else:
         assert complex.is_iq(sig) == False, "Bad signal type after processing!"
     return sig
+
+# * Resampling
+
+def get_resample_ratio(sr_from, sr_to):
+    """Return the resampling ratio from SR_FROM to SR_TO sampling rates as a
+    tuple (UP, DOWN) of integers."""
+    ratio = fractions.Fraction(sr_to / sr_from).limit_denominator(RESAMPLE_MAX_DENOMINATOR)
+    return ratio.numerator, ratio.denominator
+
+def resample(s, sr_from, sr_to, chunk=RESAMPLE_CHUNK_SAMPLES):
+    """Resample the signals of S from SR_FROM to SR_TO sampling rates.
+
+    S is a 1D np.array or a 2D np.array of shape (nb_signals, nb_samples). The
+    resampling uses a polyphase filter (scipy.signal.resample_poly()) applied
+    on batches of signals of at most CHUNK samples, preserving the dtype of
+    S. Return the resampled signals, whose length is ceil(nb_samples * SR_TO /
+    SR_FROM).
+
+    """
+    up, down = get_resample_ratio(sr_from, sr_to)
+    if s.ndim == 1:
+        return signal.resample_poly(s, up, down).astype(s.dtype)
+    nb = max(chunk // s.shape[1], 1)
+    out = np.empty((len(s), -(-s.shape[1] * up // down)), dtype=s.dtype)
+    for start in range(0, len(s), nb):
+        out[start:start + nb] = signal.resample_poly(s[start:start + nb], up, down, axis=1)
+    return out
+
+def resample_idx(idx, sr_from, sr_to, nb_samples=None):
+    """Map the IDX sample indexes from SR_FROM to SR_TO sampling rates,
+    clipped to [0 ; NB_SAMPLES[ if NB_SAMPLES is given."""
+    up, down = get_resample_ratio(sr_from, sr_to)
+    idx = np.rint(np.asarray(idx) * up / down).astype(np.asarray(idx).dtype)
+    return idx if nb_samples is None else np.clip(idx, 0, nb_samples - 1)
+
+# * Statistics
+
+def grouped_classes(classes, nb_classes):
+    """Return the CLASSES 2D np.array of integers as an np.int64 array, where
+    negative classes index the NB_CLASSES classes from the end like
+    Python lists."""
+    classes = np.asarray(classes, dtype=np.int64)
+    return np.where(classes < 0, classes + nb_classes, classes)
+
+def grouped_sums(s, classes, nb_classes, ref=0, chunk=GROUPED_CHUNK, dtype=np.float64):
+    """Accumulate the sums of signals grouped by classes.
+
+    S, CLASSES and NB_CLASSES are the same than for grouped_moments(). REF is
+    a 1D np.array of shape (nb_samples,) (or a scalar) subtracted from every
+    signal before the accumulation to limit the cancellation when computing
+    variances from the sums of squares.
+
+    The per-class sums of all groups are accumulated at once using a matrix
+    multiplication between a one-hot encoding of the classes and the chunk of
+    signals. Return a tuple (COUNT, SUM1, SUM2) of shapes (nb_groups,
+    nb_classes), (nb_groups, nb_classes, nb_samples) and (nb_groups,
+    nb_classes, nb_samples), such that sums of multiple sets of signals can be
+    added together.
+
+    """
+    classes = grouped_classes(classes, nb_classes)
+    assert s.ndim == 2 and classes.ndim == 2 and classes.shape[1] == len(s)
+    nb_groups = len(classes)
+    offset = (np.arange(nb_groups) * nb_classes)[:, np.newaxis]
+    count = np.stack([np.bincount(c, minlength=nb_classes) for c in classes])
+    ref = np.asarray(ref, dtype=dtype)
+    sums = [np.zeros((nb_groups * nb_classes, s.shape[1]), dtype=dtype) for _ in range(2)]
+    # Compensations of the sums, only needed below np.float64.
+    comps = [np.zeros_like(sums[0]) for _ in range(2)] if np.finfo(dtype).bits < 64 else None
+    for start in range(0, len(s), chunk):
+        stop = min(start + chunk, len(s))
+        x = np.asarray(s[start:stop], dtype=dtype) - ref
+        onehot = np.zeros((nb_groups * nb_classes, stop - start), dtype=dtype)
+        onehot[(classes[:, start:stop] + offset).ravel(), np.tile(np.arange(stop - start), nb_groups)] = 1
+        for i, part in enumerate((onehot @ x, onehot @ (x ** 2))):
+            if comps is None:
+                sums[i] += part
+                continue
+            part -= comps[i]
+            total = sums[i] + part
+            comps[i] = (total - sums[i]) - part
+            sums[i] = total
+    sum1, sum2 = sums
+    shape = (nb_groups, nb_classes, s.shape[1])
+    return count, sum1.reshape(shape), sum2.reshape(shape)
+
+def grouped_moments(s, classes, nb_classes, chunk=GROUPED_CHUNK, dtype=np.float64):
+    """Compute the moments of signals grouped by classes.
+
+    S is a 2D np.array of shape (nb_signals, nb_samples), which is only read by
+    chunks of CHUNK signals such that it can be a np.memmap bigger than the
+    memory. CLASSES is a 2D np.array of integers of shape (nb_groups,
+    nb_signals) containing the class in [0 ; NB_CLASSES[ of each signal for
+    each grouping of the signals (e.g. the leakage variable of each key byte).
+
+    Return a tuple (COUNT, MEAN, VAR) of shapes (nb_groups, nb_classes),
+    (nb_groups, nb_classes, nb_samples) and (nb_groups, nb_classes,
+    nb_samples), VAR being the population variance like np.var(). Moments of
+    empty classes are set to NaN. MEAN and VAR are computed and stored using
+    DTYPE (see grouped_sums()).
+
+    """
+    # NOTE: Shift the signals by a reference to limit the cancellation when
+    # computing the variance from the sum of squares.
+    ref = np.mean(np.asarray(s[:chunk], dtype=np.float64), axis=0).astype(dtype)
+    count, sum1, sum2 = grouped_sums(s, classes, nb_classes, ref, chunk, dtype)
+    n = count[:, :, np.newaxis].astype(dtype)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = sum1 / n
+        var = np.maximum(sum2 / n - mean ** 2, 0)
+    return count, mean + ref, var
+
+def grouped_cov(s, classes, nb_classes, pois, means, chunk=GROUPED_CHUNK):
+    """Compute the covariance matrices of signals grouped by classes.
+
+    S, CLASSES and NB_CLASSES are the same than for grouped_moments(). POIS is
+    a 2D np.array of integers of shape (nb_groups, nb_pois) containing the
+    points of S used for each group, and MEANS is a 3D np.array of shape
+    (nb_groups, nb_classes, nb_pois) containing the class means at these
+    points (e.g. from grouped_moments()). Only the columns of the POIS are
+    read from S.
+
+    Return a 4D np.array of shape (nb_groups, nb_classes, nb_pois, nb_pois)
+    containing the sample covariance like np.cov(). Covariances of empty
+    classes are set to 0.
+
+    """
+    classes = grouped_classes(classes, nb_classes)
+    pois = np.asarray(pois)
+    nb_groups, nb_pois = pois.shape
+    count = np.stack([np.bincount(c, minlength=nb_classes) for c in classes])
+    sums = np.zeros((nb_groups, nb_classes, nb_pois, nb_pois))
+    groups = np.arange(nb_groups)[:, np.newaxis]
+    for start in range(0, len(s), chunk):
+        stop = min(start + chunk, len(s))
+        cla = classes[:, start:stop]
+        # Centered signals at the POIs of shape (nb_groups, chunk, nb_pois).
+        x = np.asarray(s[start:stop][:, pois], dtype=np.float64).transpose(1, 0, 2) - means[groups, cla]
+        onehot = np.zeros((nb_groups, nb_classes, stop - start))
+        onehot[groups, cla, np.arange(stop - start)] = 1
+        sums += np.einsum("gcj,gjp,gjq->gcpq", onehot, x, x, optimize=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        covs = sums / (count - 1)[:, :, np.newaxis, np.newaxis]
+    covs[count == 0] = 0
+    return covs
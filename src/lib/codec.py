@@ -0,0 +1,180 @@
+"""Chunked compressed storage of traces.
+
+A compressed trace file starts with MAGIC, followed by the length of a JSON
+header (little-endian uint32), the JSON header itself and the compressed
+chunks. The header stores the codec, the dtype and the shape of the trace and
+the length of every compressed chunk. Before compression, the bytes of every
+chunk are shuffled by element (e.g. all the low bytes of the np.int16 of our
+custom dtype followed by all the high bytes), which groups the slowly varying
+high bytes of IQ samples together and improves the compression ratio.
+
+Chunks are (de)compressed in parallel by a pool of threads, since both zlib
+and zstd release the GIL. The zstd codec requires the zstandard module, while
+the zlib codec is always available and used as a fallback.
+
+Files not starting with MAGIC are regular trace files, such that compressed
+and uncompressed traces can be mixed and loaded transparently (see
+load.load_trace()).
+
+"""
+
+import os
+import json
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import lib.log as l
+
+try:
+    import zstandard
+except ImportError: # Don't make this module mandatory, zlib is used instead.
+    zstandard = None
+
+# * Constants
+
+# Magic number of a compressed trace file.
+MAGIC = b"\x93TRACEZ\x01"
+# Available codecs, with their default compression level.
+CODECS = {"zstd": 3, "zlib": 1}
+# Size of a chunk before compression [bytes]. Small enough to decompress a
+# trace of a few MB using all threads, large enough to not degrade the
+# compression ratio.
+CHUNK = 2 ** 18
+
+# * Global variables
+
+# Pool of threads used to (de)compress the chunks and to load traces (see
+# load.load_all_traces_comps()), and PID of its process.
+POOL = None
+POOL_PID = None
+# Set to True once the fallback to zlib has been reported.
+FALLBACK_LOGGED = False
+
+# * Functions
+
+def get_pool():
+    """Return the pool of threads of the current process."""
+    global POOL, POOL_PID
+    # NOTE: Threads of a pool are not inherited by the workers forked by
+    # DatasetProcessing, hence use a new pool in every process.
+    if POOL is None or POOL_PID != os.getpid():
+        POOL, POOL_PID = ThreadPoolExecutor(max_workers=os.cpu_count()), os.getpid()
+    return POOL
+
+def map_chunks(fn, chunks):
+    """Apply FN to every element of the CHUNKS list, in parallel if there is
+    more than one. Return the list of results."""
+    if len(chunks) < 2:
+        return [fn(c) for c in chunks]
+    return list(get_pool().map(fn, chunks))
+
+def parse(spec):
+    """Return a tuple composed of the codec and the level of the "CODEC[:LEVEL]"
+    SPEC string, or None if SPEC is empty. Raise an Exception on an unknown
+    codec."""
+    if spec == "":
+        return None
+    codec, _, level = spec.partition(":")
+    if codec not in CODECS:
+        raise Exception("Unknown compression codec: {} (available: {})".format(codec, ", ".join(CODECS)))
+    return codec, int(level) if level != "" else CODECS[codec]
+
+def get_codec(codec, level):
+    """Return a tuple of the CODEC and LEVEL really usable, falling back to
+    zlib if zstd is not installed."""
+    global FALLBACK_LOGGED
+    if codec == "zstd" and zstandard is None:
+        if FALLBACK_LOGGED is False:
+            l.LOGGER.warning("zstandard is not installed, compress traces using zlib instead")
+            FALLBACK_LOGGED = True
+        return "zlib", CODECS["zlib"]
+    return codec, level
+
+def get_shuffle_size(dtype):
+    """Return the size of the elements of DTYPE which are shuffled [bytes],
+    i.e. the size of its scalar components."""
+    if dtype.fields is not None:
+        return min(f[0].itemsize for f in dtype.fields.values())
+    if dtype.kind == "c":
+        return dtype.itemsize // 2
+    return dtype.itemsize
+
+def shuffle(buf, size):
+    """Return the bytes of BUF shuffled by elements of SIZE bytes as a 1D
+    np.ndarray of np.uint8."""
+    # NOTE: Copying one byte position at a time is much faster than copying a
+    # transposed view.
+    src = np.frombuffer(buf, dtype=np.uint8).reshape(-1, size)
+    dst = np.empty((size, len(src)), dtype=np.uint8)
+    for k in range(size):
+        dst[k] = src[:, k]
+    return dst.reshape(-1)
+
+def unshuffle(buf, size, out):
+    """Un-shuffle the bytes of BUF shuffled by shuffle() into the OUT 1D
+    np.ndarray of np.uint8."""
+    src = np.frombuffer(buf, dtype=np.uint8).reshape(size, -1)
+    dst = out.reshape(-1, size)
+    for k in range(size):
+        dst[:, k] = src[k]
+
+def compress(buf, codec, level):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(buf)
+    return zlib.compress(buf, level)
+
+def decompress(buf, codec):
+    if codec == "zstd":
+        if zstandard is None:
+            raise Exception("Cannot decompress a zstd trace, zstandard is not installed!")
+        return zstandard.ZstdDecompressor().decompress(buf)
+    return zlib.decompress(buf)
+
+def save(file, arr, codec="zstd", level=None):
+    """Save the ARR np.ndarray into FILE compressed using CODEC at LEVEL
+    (default level of the codec if None)."""
+    codec, level = get_codec(codec, CODECS[codec] if level is None else level)
+    arr = np.ascontiguousarray(arr)
+    size = get_shuffle_size(arr.dtype)
+    buf = memoryview(arr.reshape(-1).view(np.uint8))
+    chunks = map_chunks(lambda c: compress(shuffle(c, size), codec, level),
+                        [buf[i:i + CHUNK] for i in range(0, len(buf), CHUNK)])
+    header = json.dumps({"codec": codec, "dtype": np.lib.format.dtype_to_descr(arr.dtype), "shape": arr.shape,
+                         "shuffle": size, "chunks": [len(c) for c in chunks]}).encode()
+    with open(file, "wb") as f:
+        f.write(MAGIC + struct.pack("<I", len(header)) + header)
+        for c in chunks:
+            f.write(c)
+
+def read_header(f):
+    """Return the header of the compressed trace opened as the F binary file,
+    or None if it is not a compressed trace."""
+    if f.read(len(MAGIC)) != MAGIC:
+        return None
+    return json.loads(f.read(struct.unpack("<I", f.read(4))[0]))
+
+def load_header(file):
+    """Return the header of the compressed trace FILE (see save()), or None if
+    FILE is not a compressed trace."""
+    with open(file, "rb") as f:
+        return read_header(f)
+
+def load(file):
+    """Load a trace compressed by save() from FILE. Return the np.ndarray of
+    the stored dtype and shape, or None if FILE is not a compressed trace."""
+    with open(file, "rb") as f:
+        header = read_header(f)
+        if header is None:
+            return None
+        data = memoryview(f.read())
+    arr = np.empty(header["shape"], dtype=np.lib.format.descr_to_dtype(header["dtype"]))
+    out = arr.reshape(-1).view(np.uint8)
+    offsets = np.concatenate(([0], np.cumsum(header["chunks"], dtype=np.int64)))
+    size = header["shuffle"]
+    def load_chunk(i):
+        unshuffle(decompress(data[offsets[i]:offsets[i + 1]], header["codec"]), size, out[i * CHUNK:(i + 1) * CHUNK])
+    map_chunks(load_chunk, list(range(len(header["chunks"]))))
+    return arr
@@ -60,7 +60,7 @@ def get_phase(traces):
     else:
         return traces
 
-def get_phase_rot(trace):
+def get_phase_rot(traces):
     """Get the phase of one or multiple traces."""
     if traces.dtype == np.complex64:
         return np.angle(traces)
@@ -7,8 +7,12 @@ from enum import Enum
 import numpy as np
 import matplotlib.pyplot as plt
 import pickle
+import hashlib
+import json
+import queue
 import signal
 import sys
+import time
 from tqdm import tqdm
 from tqdm.contrib.logging import logging_redirect_tqdm
 
@@ -23,6 +27,7 @@ import lib.complex as complex
 import lib.analyze as analyze
 import lib.utils as utils
 import lib.debug as debug
+import lib.shard as shard
 
 # NOTE: start=0 because used to index tuples returning (traces_nf, traces_ff).
 TraceType = Enum('TraceType', ['NF', 'FF'], start=0)
@@ -37,6 +42,9 @@ DPROC = None
 class Dataset():
     """Top-level class representing a dataset."""
     FILENAME = "dataset.pyc"
+    # Append-only journal of the processing progress, folded into the pickled
+    # dataset at the end of the processing.
+    JOURNAL_FILENAME = "dataset.journal"
 
     def __init__(self, name, dir, samp_rate):
         self.name = name
@@ -125,6 +133,8 @@ class Dataset():
     def resume_from_savedir(self, subset=None):
         assert(Dataset.is_pickable(self.dirsave))
         dset_dirsave = Dataset.pickle_load(self.dirsave)
+        if subset is not None:
+            dset_dirsave.journal_replay(dset_dirsave.get_subset(subset))
         self.run_resumed = True
         self.dirty = dset_dirsave.dirty
         self.dirty_idx = dset_dirsave.dirty_idx
@@ -132,8 +142,66 @@ class Dataset():
             sset = self.get_subset(subset)
             sset_dirsave = dset_dirsave.get_subset(subset)
             sset.template = sset_dirsave.template
+            sset.reference = getattr(sset_dirsave, "reference", None)
             sset.bad_entries = sset_dirsave.bad_entries
 
+    @staticmethod
+    def get_hash(trace):
+        """Return a short hexadecimal hash of the TRACE np.array, or None if
+        TRACE is None."""
+        if trace is None:
+            return None
+        return hashlib.sha1(np.ascontiguousarray(trace).tobytes()).hexdigest()[:16]
+
+    def get_journal_path(self):
+        return path.join(self.dirsave, Dataset.JOURNAL_FILENAME)
+
+    def journal_append(self, sset, bad_entries):
+        """Append the processing progress of the SSET Subset to the journal.
+
+        The entry contains the current dirty index, the BAD_ENTRIES list of
+        bad entries found since the previous entry and the hash of the
+        template of SSET. It is flushed to the disk before returning, which is
+        much cheaper than pickle_dump() since nothing else is rewritten.
+
+        """
+        entry = {"subset": sset.name, "dirty_idx": int(self.dirty_idx),
+                 "bad_entries": [int(i) for i in bad_entries], "template": Dataset.get_hash(sset.template)}
+        with open(self.get_journal_path(), "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def journal_replay(self, sset):
+        """Apply the journal of the saving directory to the SSET Subset.
+
+        Update the dirty index and the bad entries of SSET using the entries
+        of the journal written for the same subset and the same template than
+        the ones of the pickled dataset. Entries written for another template
+        (e.g. by a previous processing) and lines truncated by a crash are
+        ignored.
+
+        """
+        if not path.exists(self.get_journal_path()):
+            return
+        template = Dataset.get_hash(sset.template)
+        with open(self.get_journal_path(), "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry["subset"] != sset.name or entry["template"] != template:
+                    continue
+                self.dirty_idx = max(self.dirty_idx, entry["dirty_idx"])
+                sset.bad_entries += [i for i in entry["bad_entries"] if i not in sset.bad_entries]
+        l.LOGGER.debug("Journal replayed: resume at trace #{}".format(self.dirty_idx))
+
+    def journal_clear(self):
+        """Remove the journal, once folded into the pickled dataset."""
+        if path.exists(self.get_journal_path()):
+            os.remove(self.get_journal_path())
+
     def pickle_dump(self, force=False, unload=True, log=True):
         """Dump the Dataset on the disk.
 
@@ -220,6 +288,10 @@ class Subset():
     # Set to True when inserting a new input at run time.
     run_new_input = False
 
+    # Filename of alignment shifts saved in the subset directory, formatted
+    # with a key returned by analyze.get_shifts_key().
+    SHIFTS_FN = "shifts_{}.npy"
+
     def __init__(self, dataset, name, subtype, input_gen, input_src, nb_trace_wanted = 0):
         assert subtype in SubsetType, "Bad subset type!"
         assert input_gen in InputGeneration, "Bad input generation value!"
@@ -234,6 +306,9 @@ class Subset():
         self.nf = None
         self.ff = None
         self.template = None
+        # Processed trace #0, used as reference of the shape and the dtype of
+        # the next processed traces.
+        self.reference = None
         self.bad_entries = []
         if self.input_gen == InputGeneration.INIT_TIME and nb_trace_wanted < 1:
             l.LOGGER.error("initialization of plaintexts and keys at init time using {} traces is not possible!".format(nb_trace_wanted))
@@ -253,7 +328,7 @@ class Subset():
             self.ks_type = InputType.FIXED
 
     # NOTE: The get_trace_from_disk() is a modified copy of this function.
-    def load_trace(self, idx=-1, nf=True, ff=True, check=False, start_point=0, end_point=0, log=False, custom_dtype=True):
+    def load_trace(self, idx=-1, nf=True, ff=True, check=False, start_point=0, end_point=0, log=False, custom_dtype=True, valid=None):
         """Load the on-disk traces into memory.
 
         The loading will put the traces in the self.nf and self.ff
@@ -271,6 +346,10 @@ class Subset():
         during loading the traces. If END_POINT is set to different from 0, use it
         as end index during loading the traces.
 
+        If IDX is -1 or a RANGE, VALID can be set to a validity bitmap (see
+        get_valid()) to skip the invalid traces without reading them. The
+        loaded traces can then not be saved back using save_trace().
+
         :param log: Set to True to enable logging.
 
         """
@@ -278,13 +357,13 @@ class Subset():
             l.LOGGER.info("Load traces (nf={}, ff={}) from {} subset...".format(nf, ff, self.name))
         assert(path.exists(self.get_path()))
         if isinstance(idx, int) and idx == -1:
-            self.nf, self.ff = load.load_all_traces(self.get_path(), nf_wanted=nf, ff_wanted=ff, start_point=start_point, end_point=end_point, custom_dtype=custom_dtype)
+            self.nf, self.ff = load.load_all_traces(self.get_path(), nf_wanted=nf, ff_wanted=ff, start_point=start_point, end_point=end_point, custom_dtype=custom_dtype, valid=valid)
         elif isinstance(idx, int):
             self.nf, self.ff = load.load_pair_trace(self.get_path(), idx, nf=nf, ff=ff, custom_dtype=custom_dtype)
             self.nf[0] = None if self.nf[0] is None else load.truncate(self.nf[0], start_point, end_point)
             self.ff[0] = None if self.ff[0] is None else load.truncate(self.ff[0], start_point, end_point)
         elif isinstance(idx, range):
-            self.nf, self.ff = load.load_all_traces(self.get_path(), start=idx.start, stop=idx.stop, nf_wanted=nf, ff_wanted=ff, start_point=start_point, end_point=end_point, custom_dtype=custom_dtype)
+            self.nf, self.ff = load.load_all_traces(self.get_path(), start=idx.start, stop=idx.stop, nf_wanted=nf, ff_wanted=ff, start_point=start_point, end_point=end_point, custom_dtype=custom_dtype, valid=valid)
         # Search for bad entries and set them to 0.
         # NOTE: Otherwise, we can load traces of different shape, even empty (0).
         # Then, the load.reshape function would reshape all traces to 0.
@@ -305,6 +384,20 @@ class Subset():
         assert self.ff is None or self.ff.ndim == 2
         return self.nf, self.ff
 
+    def load_trace_comps(self, idx, comps, start_point=0, end_point=0, valid=None):
+        """Load the on-disk FF traces of the IDX range directly as the COMPS
+        list of components (see load.load_all_traces_comps()), for traces
+        saved using our custom dtype.
+
+        Return a list of 2D np.ndarray of np.float32, one per component,
+        without storing them in self.ff. START_POINT, END_POINT and VALID are
+        used as in load_trace().
+
+        """
+        assert(path.exists(self.get_path()))
+        return load.load_all_traces_comps(self.get_path(), comps, start=idx.start, stop=idx.stop,
+                                          start_point=start_point, end_point=end_point, valid=valid)
+
     # NOTE: This function is a modified copy of the load_trace() function. It
     # should be worth to refactor the twos to use get_trace_from_disk() inside
     # load_trace().
@@ -350,24 +443,24 @@ class Subset():
         del self.ff
         self.ff = None
 
-    def save_trace(self, nf=True, ff=True, custom_dtype=True):
+    def save_trace(self, nf=True, ff=True, custom_dtype=True, compression=None):
         if isinstance(self.load_trace_idx, int) and self.load_trace_idx == -1:
             load.save_all_traces(self.get_path(save=True),
                                  self.nf if nf is True else None,
                                  self.ff if ff is True else None,
                                  packed=False,
-                                 custom_dtype=custom_dtype)
+                                 custom_dtype=custom_dtype, compression=compression)
         elif isinstance(self.load_trace_idx, int) and self.load_trace_idx > -1:
             load.save_pair_trace(self.get_path(save=True), self.load_trace_idx,
                                  self.nf[0] if nf is True else None,
                                  self.ff[0] if ff is True else None,
-                                 custom_dtype=custom_dtype)
+                                 custom_dtype=custom_dtype, compression=compression)
         elif isinstance(self.load_trace_idx, range):
             load.save_all_traces(self.get_path(save=True),
                                  self.nf if nf is True else None,
                                  self.ff if ff is True else None,
                                  packed=False, start=self.load_trace_idx.start, stop=self.load_trace_idx.stop,
-                                 custom_dtype=custom_dtype)
+                                 custom_dtype=custom_dtype, compression=compression)
         self.unload_trace()
 
     def get_save_trace_exist(self, idx=-1):
@@ -463,6 +556,62 @@ class Subset():
     def get_nb_trace_ondisk(self, save=False):
         return load.get_nb(self.get_path(save))
 
+    def get_valid(self, nb=0, save=False):
+        """Return the validity bitmap of the NB first traces (all traces on
+        disk if set to 0) as a 1D np.ndarray of bool.
+
+        A trace is invalid if it is registered in the bad entries or marked as
+        invalid in the bitmap saved on disk by save_valid() or by the scan
+        command of dataset.py.
+
+        """
+        nb = max(self.get_nb_trace_ondisk(save), 0) if nb == 0 else nb
+        valid = load.load_valid(self.get_path(save))
+        valid = np.ones(nb, dtype=bool) if valid is None else load.get_valid_range(valid, 0, nb)
+        bad = np.asarray([i for i in self.bad_entries if i < nb], dtype=int)
+        valid[bad] = False
+        return valid
+
+    @staticmethod
+    def get_valid_key(valid):
+        """Return the parameters identifying the traces skipped using the
+        VALID bitmap for analyze.get_shifts_key(), since shifts are indexed by
+        loaded traces. Return no parameter if VALID is None, such that keys
+        are not modified when no trace is skipped."""
+        return {} if valid is None else {"valid": Dataset.get_hash(valid)}
+
+    def get_traces_key(self):
+        """Return the parameters identifying the content of the trace files of
+        the subset for analyze.get_shifts_key(), using their size and their
+        modification time (see load.get_manifest()), such that shifts are
+        computed again once traces have been re-written, removed or added."""
+        manifest = load.get_manifest(self.get_path())
+        if manifest is not None:
+            st = np.stack((manifest["size"].astype(np.float64), manifest["mtime"]))
+        else:
+            fps = [load.get_dataset_path_pack_nf(self.get_path()), load.get_dataset_path_pack_ff(self.get_path())]
+            st = np.array([(os.stat(fp).st_size, os.stat(fp).st_mtime) for fp in fps if path.exists(fp)], dtype=np.float64)
+        return {"traces": Dataset.get_hash(st)}
+
+    def save_valid(self, valid=None, stop=None):
+        """Save the validity bitmap of the traces in the saving directory.
+
+        If VALID is None and STOP is None, it is computed from the bad entries
+        for the traces on disk (see get_valid()). If STOP is set, the traces
+        [0 ; STOP[ have just been processed, hence their validity is only
+        given by the bad entries and replaces the saved one, while the saved
+        validity of the next traces is kept. Otherwise, VALID is saved as it.
+
+        """
+        if valid is None and stop is not None:
+            saved = load.load_valid(self.get_path(save=True))
+            valid = np.ones(stop, dtype=bool) if saved is None else load.get_valid_range(saved, 0, max(stop, len(saved)))
+            valid[:stop] = True
+            valid[[i for i in self.bad_entries if i < stop]] = False
+        valid = self.get_valid(save=True) if valid is None else valid
+        load.save_valid(self.get_path(save=True), valid)
+        l.LOGGER.debug("Validity bitmap saved: {} invalid traces out of {}".format(np.count_nonzero(~valid), len(valid)))
+
     def get_path(self, save=False):
         """Return the full path of the subset. Must be dynamic since the full
         path of the dataset can change since its creation when pickling it.
@@ -470,6 +619,61 @@ class Subset():
         """
         return path.join(self.dataset.dir if not save else self.dataset.dirsave, self.dir)
 
+    def get_shifts_path(self, key, save=False):
+        """Return the full path of the alignment shifts identified by KEY."""
+        return path.join(self.get_path(save), Subset.SHIFTS_FN.format(key))
+
+    def load_shifts(self, key, nb=0, save=False):
+        """Load the alignment shifts identified by KEY from the disk.
+
+        KEY is returned by analyze.get_shifts_key(). Return a 1D np.ndarray
+        containing the NB first shifts (all of them if set to 0), or None if
+        no shifts are saved under KEY or if less than NB shifts are saved.
+
+        """
+        fp = self.get_shifts_path(key, save)
+        if not path.exists(fp):
+            return None
+        shifts = np.load(fp)
+        nb = len(shifts) if nb == 0 else nb
+        return shifts[:nb] if len(shifts) >= nb else None
+
+    def save_shifts(self, key, shifts, save=False):
+        """Save the alignment SHIFTS (1D np.ndarray) identified by KEY on the
+        disk, unless more shifts are already saved under the same KEY.
+
+        """
+        fp = self.get_shifts_path(key, save)
+        if path.exists(fp) and len(np.load(fp, mmap_mode="r")) >= len(shifts):
+            return
+        # NOTE: Write then rename to never leave a truncated file behind.
+        fp_tmp = fp + ".tmp.npy"
+        np.save(fp_tmp, shifts)
+        os.replace(fp_tmp, fp)
+
+    def get_shifts(self, key, s, sr, template, subsample=False, method="parabolic", tqdm_log=True):
+        """Get the alignment shifts of the S 2D np.ndarray against TEMPLATE.
+
+        Re-use the shifts saved under KEY (see analyze.get_shifts_key()) and
+        only compute the shifts of the signals which are not saved yet using
+        analyze.get_shifts_all(), then save the complete shifts vector. S[i]
+        should correspond to the trace #i of the subset.
+
+        """
+        shifts = self.load_shifts(key)
+        nb_saved = 0 if shifts is None else min(len(shifts), len(s))
+        if nb_saved == len(s):
+            l.LOGGER.info("Load {} saved alignment shifts ({})".format(nb_saved, key))
+            return shifts[:len(s)]
+        l.LOGGER.info("Compute {} alignment shifts ({} already saved, key {})".format(len(s) - nb_saved, nb_saved, key))
+        shifts_new = analyze.get_shifts_all(s[nb_saved:], sr, template, subsample=subsample, method=method, tqdm_log=tqdm_log)
+        shifts = shifts_new if nb_saved == 0 else np.concatenate((shifts[:nb_saved], shifts_new))
+        try:
+            self.save_shifts(key, shifts)
+        except OSError as e:
+            l.LOGGER.warning("Cannot save alignment shifts: {}".format(e))
+        return shifts
+
     def replace_trace(self, sig, typ):
         """Replace traces with new one(s).
 
@@ -622,6 +826,15 @@ class Profile():
     STDS_FN       = "PROFILE_STDS.npy"
     COVS_FN       = "PROFILE_COVS.npy"
     MEAN_TRACE_FN = "PROFILE_MEAN_TRACE.npy"
+    SAMP_RATE_FN  = "PROFILE_SAMP_RATE.npy"
+    # Single-file container of the profile's data.
+    PROFILE_FN    = "PROFILE.npz"
+
+    # Profile's data fields and their filenames in the legacy layout (one file
+    # per field).
+    FIELDS = {"POIS": POIS_FN, "RS": RS_FN, "RZS": RZS_FN, "MEANS": MEANS_FN,
+              "STDS": STDS_FN, "COVS": COVS_FN, "MEAN_TRACE": MEAN_TRACE_FN,
+              "SAMP_RATE": SAMP_RATE_FN}
 
     # Profile's data.
     POIS        = None
@@ -631,6 +844,8 @@ class Profile():
     STDS        = None
     COVS        = None
     MEAN_TRACE  = None
+    # Sampling rate of the traces used to build the profile (None if unknown).
+    SAMP_RATE   = None
     # Starting point used in original trace.
     POINT_START = None
     # Ending point used in original trace.
@@ -674,30 +889,67 @@ class Profile():
             assert False, "Profile has not been configured correctly!"
 
     def save(self, full_path=None):
-        """Store traces and points from the Profile."""
+        """Store traces and points from the Profile into the single-file
+        container. Fields set to None are not stored."""
         # NOTE: Feature to test.
         fp = False
         # if full_path is not None:
         #     self.fp = path.abspath(full_path)
         #     fp = True
         os.makedirs(self.get_path(fp=fp), exist_ok=True)
-        np.save(path.join(self.get_path(fp=fp), Profile.POIS_FN), self.POIS)
-        np.save(path.join(self.get_path(fp=fp), Profile.RS_FN), self.RS)
-        np.save(path.join(self.get_path(fp=fp), Profile.RZS_FN), self.RZS)
-        np.save(path.join(self.get_path(fp=fp), Profile.MEANS_FN), self.MEANS)
-        np.save(path.join(self.get_path(fp=fp), Profile.STDS_FN), self.STDS)
-        np.save(path.join(self.get_path(fp=fp), Profile.COVS_FN), self.COVS)
-        np.save(path.join(self.get_path(fp=fp), Profile.MEAN_TRACE_FN), self.MEAN_TRACE)
-
-    # Load the profile, for comparison or for attacks.
-    def load(self):
-        self.POIS       = np.load(path.join(self.get_path(), Profile.POIS_FN))
-        self.RS         = np.load(path.join(self.get_path(), Profile.RS_FN))
-        self.RZS        = np.load(path.join(self.get_path(), Profile.RZS_FN))
-        self.MEANS      = np.load(path.join(self.get_path(), Profile.MEANS_FN))
-        self.COVS       = np.load(path.join(self.get_path(), Profile.COVS_FN))
-        self.STDS       = np.load(path.join(self.get_path(), Profile.STDS_FN))
-        self.MEAN_TRACE = np.load(path.join(self.get_path(), Profile.MEAN_TRACE_FN))
+        np.savez(path.join(self.get_path(fp=fp), Profile.PROFILE_FN),
+                 **{field: getattr(self, field) for field in Profile.FIELDS if getattr(self, field) is not None})
+
+    def load(self, fields=None):
+        """Load the profile, for comparison or for attacks.
+
+        If FIELDS is set to a list of field names (keys of Profile.FIELDS),
+        only load those fields, otherwise load all of them. Fields which are
+        already loaded are not read again. Read the single-file container if it
+        exists, otherwise the legacy layout of one file per field. Missing
+        fields are left to None.
+
+        """
+        fields = [f for f in (Profile.FIELDS if fields is None else fields) if getattr(self, f) is None]
+        if len(fields) == 0:
+            return
+        container = path.join(self.get_path(), Profile.PROFILE_FN)
+        if path.exists(container):
+            # NOTE: The members of the container are only read when accessed.
+            with np.load(container) as npz:
+                for field in fields:
+                    if field in npz.files:
+                        setattr(self, field, npz[field])
+        else:
+            for field in fields:
+                if path.exists(path.join(self.get_path(), Profile.FIELDS[field])):
+                    setattr(self, field, np.load(path.join(self.get_path(), Profile.FIELDS[field])))
+
+    def resample(self, sr_to):
+        """Resample the profile to the SR_TO sampling rate.
+
+        Resample the loaded curves (MEAN_TRACE, RS, RZS) and remap the POIS,
+        such that a profile built at a sampling rate can be used against traces
+        recorded at another one. The class statistics (MEANS, STDS, COVS) are
+        kept since they are estimated at the POIS. Do nothing if the sampling
+        rate of the profile is unknown or already SR_TO.
+
+        """
+        if self.SAMP_RATE is None or float(self.SAMP_RATE) == sr_to:
+            return
+        sr_from = float(self.SAMP_RATE)
+        l.LOGGER.info("Resample the profile from {:.2f} MHz to {:.2f} MHz".format(sr_from / 1e6, sr_to / 1e6))
+        nb_samples = None
+        if self.MEAN_TRACE is not None:
+            self.MEAN_TRACE = analyze.resample(self.MEAN_TRACE, sr_from, sr_to)
+            nb_samples = len(self.MEAN_TRACE)
+        if self.RS is not None:
+            self.RS = analyze.resample(self.RS, sr_from, sr_to)
+        if self.RZS is not None:
+            self.RZS = analyze.resample(self.RZS, sr_from, sr_to)
+        if self.POIS is not None:
+            self.POIS = analyze.resample_idx(self.POIS, sr_from, sr_to, nb_samples)
+        self.SAMP_RATE = sr_to
 
     def plot(self, delim=False, save=None, plt_param_dict={}):
         # Code taken from attack.py:find_pois().
@@ -770,9 +1022,9 @@ class DatasetProcessing():
     - resume: Resume from previous processing.
     - create: Create a new processing.
     - process: Execute the previously created processing.
+    - process_shards: Execute the processing shard by shard.
+    - merge_shards: Merge the processed shards into the dataset.
     - disable_plot: Disable the plot(s) for next processing.
-    - disable_parallel: Disable the processing parallelization.
-    - restore_parallel: Restore the previous processing parallelization.
     - is_parallel: To know if parallelization is enabled.
 
     """
@@ -803,7 +1055,18 @@ class DatasetProcessing():
     # > 0 = specified number of processes.
     # 0 = no process, run sequentially.
     process_nb = None
-    _process_nb = None # Backup.
+    # Save the processed traces using our custom dtype.
+    process_custom_dtype = False
+    # Compression of the processed traces (see codec.parse()).
+    process_compression = None
+    # Shard directory (see lib/shard.py) and processed shard as a tuple of
+    # (index, start, stop) when processing shards, None otherwise.
+    shard_dir = None
+    shard = None
+    # Period between two entries of the processing journal [s].
+    CHECKPOINT_PERIOD = 1
+    # Maximum number of traces queued per worker.
+    WORKER_QUEUE_FACTOR = 2
 
     def __init__(self, indir, subset, outdir=None, stop=-1):
         """Initialize a dataset processing.
@@ -849,7 +1112,7 @@ class DatasetProcessing():
             l.LOGGER.info("Resume at trace {} using template from previous processing".format(self.start))
             l.LOGGER.debug("Template: shape={}".format(self.sset.template.shape))
 
-    def create(self, title, fn, plot, args, nb = -1):
+    def create(self, title, fn, plot, args, nb = -1, custom_dtype=False, compression=None):
         """Create a processing.
 
         The processing will be titled TITLE, running the function FN using the
@@ -859,18 +1122,25 @@ class DatasetProcessing():
         set to a positive number, use this as number of workers. If set to 0,
         disable multi-process processing and use a single-process processing.
 
+        If CUSTOM_DTYPE is set to True, save the processed traces using our
+        custom dtype (processed traces have to be complex).
+
+        If COMPRESSION is set to a tuple of codec and level (see
+        codec.parse()), save the processed traces compressed.
+
         """
         assert isinstance(plot, libplot.PlotOnce), "plot parameter must be a PlotOnce class!"
         self.process_title = title
         self.process_fn = fn
         self.process_plot = plot
         self.process_args = args
+        self.process_custom_dtype = custom_dtype
+        self.process_compression = compression
         if nb < 0:
             self.process_nb = os.cpu_count() - 1
             l.LOGGER.info("Automatically select {} processes for parallelization".format(self.process_nb))
         else:
             self.process_nb = nb
-        self._process_nb = self.process_nb
 
     def process(self):
         """Run the (parallelized) processing.
@@ -878,6 +1148,20 @@ class DatasetProcessing():
         The processing must be configured using DatasetProcessing.create()
         before to use this function.
 
+        The first trace is processed in the main process. Remaining traces are
+        processed by a pool of long-lived workers fed by a queue of trace
+        indexes, whose results are streamed back as soon as a trace is
+        processed, such that a slow trace does not stall the other workers.
+        The progress (index of the first trace not processed yet, used as
+        resuming index, and new bad entries) is appended to the journal of the
+        dataset every CHECKPOINT_PERIOD seconds. The dataset itself is only
+        pickled after the first trace (to save the template) and at the end
+        (including on SIGINT), folding the journal.
+
+        When processing a shard (see process_shards()), the journal and the
+        pickled dataset are replaced by the state of the shard, and the
+        template is published after the first trace.
+
         """
         # Check that self.create() function has been called.
         assert self.process_title is not None
@@ -885,136 +1169,231 @@ class DatasetProcessing():
         assert self.process_plot is not None
         assert self.process_args is not None
         assert self.process_nb >= 0
-        
-        def _init(i, stop):
-            """Initialize the processing starting at trace index I.
 
-            Return a tuple composed of the Queue for result transfer and a list
-            of processes.
+        # Results of the processed traces which are not contiguous to the
+        # already checkpointed ones, as a dictionary of trace index -> check.
+        pending = {}
+        # Bad entries registered since the last journal entry.
+        bad_new = []
+
+        def _collect(check, i_processed, i_done, pbar):
+            """Register the result CHECK of trace index I_PROCESSED. Return the
+            index I_DONE of the first trace not processed yet."""
+            pending[i_processed] = check
+            pbar.update(1)
+            # NOTE: Only register bad entries of contiguous traces, since the
+            # other ones would be processed again on resume.
+            while i_done in pending:
+                if pending.pop(i_done) is True:
+                    self.sset.bad_entries.append(i_done)
+                    bad_new.append(i_done)
+                i_done += 1
+            return i_done
+
+        def _save_shard(i_done):
+            """Save the state of the processed shard for further resuming at
+            trace index I_DONE, publishing the template if needed."""
+            k, start, stop = self.shard
+            key = Dataset.get_hash(self.sset.template)
+            if i_done > 0:
+                shard.publish_template(self.shard_dir, self.sset.template, getattr(self.sset, "reference", None), key)
+            shard.save_state(self.shard_dir, k, i_done, [i for i in self.sset.bad_entries if start <= i < stop], key)
+
+        def _checkpoint(i_done):
+            """Journal the processing state for further resuming at trace index
+            I_DONE."""
+            if i_done != self.dset.dirty_idx or bad_new:
+                self.dset.dirty_idx = i_done
+                if self.shard is None:
+                    self.dset.journal_append(self.sset, bad_new)
+                else:
+                    _save_shard(i_done)
+                bad_new.clear()
+                l.LOGGER.debug("Checkpoint processing: resume at trace #{}".format(i_done))
+            return time.monotonic()
+
+        def _save(i_done):
+            """Save the processing state in the pickled dataset for further
+            resuming at trace index I_DONE and clear the journal."""
+            self.dset.dirty_idx = i_done
+            if self.shard is None:
+                self.dset.pickle_dump(unload=False, log=False)
+                self.dset.journal_clear()
+            else:
+                _save_shard(i_done)
+            bad_new.clear()
 
-            """
+        # Setup progress bar.
+        with (logging_redirect_tqdm(loggers=[l.LOGGER]),
+              tqdm(initial=self.start, total=self.stop, desc=self.process_title) as pbar,):
+            i_done = self.start
             # NOTE: The first processing needs to be executed in the main
             # process to modify the dataset object. Remaning processings could
             # rely on this one to get some parameters (e.g. the template
             # signal).
-            self.disable_parallel(i == 0)
-            # Queue for transferring results from processing function (parallelized or not).
-            q = Queue()
-            # List of processes. Only create necessary processes.
-            ps_len = self.process_nb
-            if i + self.process_nb >= stop:
-                ps_len -= i + self.process_nb - stop
-            ps = [None] * ps_len
-            # Initialize the processes if needed (but do not run them).
-            for idx, _ in enumerate(ps):
-                l.LOGGER.debug("Create process index #{} for trace index #{}".format(idx, i + idx))
-                ps[idx] = Process(target=self.__process_fn, args=(q, self.dset, self.sset, i + idx, self.process_plot.pop(), self.process_args,))
-            return q, ps
-
-        def _run(i, q, ps):
-            """Run the processing starting at trace index I using the Queue Q
-            and the processes of list PS.
-
-            """
-            # Create the processes and perform the parallelized processing...
+            if i_done == 0 and i_done < self.stop:
+                q = Queue()
+                self.__process_fn(q, self.dset, self.sset, 0, self.process_plot.pop(), self.process_args)
+                i_done = _collect(*q.get(), i_done, pbar)
+                _save(i_done)
             if self.is_parallel():
-                for idx, proc in enumerate(ps):
-                    proc.start()
-                    l.LOGGER.debug("Started process: idx={}".format(idx))
-            # ...or perform process sequentially.
+                i_done = self.__process_pool(i_done, _collect, _checkpoint, pbar)
             else:
-                self.__process_fn(q, self.dset, self.sset, i, self.process_plot.pop(), self.process_args)
-
-        def _get(q, ps):
-            """Get the processing results using the Queue Q and the processes of list PS."""
-            # Check the result.
-            for _, __ in enumerate(ps):
-                l.LOGGER.debug("Wait result from queue...")
-                check, i_processed = q.get()
-                if check is True:
-                    self.sset.bad_entries.append(i_processed)
-
-        def _end(i_done, ps, pbar=None):
-            """Terminate the processing for trace index I_DONE.
-
-            1. Update the processing loop information to prepare the next
-               processing.
-            2. Save the processing state in the dataset for further
-               resuming.
-            3. If parallelized, terminated the processing contained in
-               the PS list.
-            4. If specified, update TQDM's PBAR just like index I_DONE.
-
-            Return the new index I for next processing.
-
-            """
-            # Terminate the processes.
-            for idx, proc in enumerate(ps):
-                l.LOGGER.debug("Join process... idx={}".format(idx))
-                proc.join()
-            # Update the progress index and bar.
-            # NOTE: Handle case where process_nb == 0 for single-process processing.
-            i_step = len(ps) if self.process_nb > 0 else 1
-            i = i_done + i_step
-            pbar.update(i_step)
-            # Save dataset for resuming if not finishing the loop.
-            self.dset.dirty_idx = i
-            self.dset.pickle_dump(unload=False, log=False)
-            # Restore parallelization after first trace processing if needed.
-            # NOTE: Should be at the end since it will modify self.process_nb.
-            self.restore_parallel(i_done == 0)
-            l.LOGGER.debug("Finished processing: trace #{} -> #{}".format(i_done, i - 1))
-            return i
-            
-        # Setup progress bar.
-        with (logging_redirect_tqdm(loggers=[l.LOGGER]),
-              tqdm(initial=self.start, total=self.stop, desc=self.process_title) as pbar,):
-            i = self.start
-            while i < self.stop:
-                # Initialize processing for trace(s) starting at index i.
-                q, ps = _init(i, self.stop)
-                # Run the processing.
-                _run(i, q, ps)
-                # Get and check the results.
-                _get(q, ps)
-                # Terminate the processing.
-                i = _end(i, ps, pbar=pbar)
-
-    def disable_plot(self, cond=True):
-        """Disable the plotting parameter if COND is True."""
-        if cond is True and self.process_plot is True:
-            l.LOGGER.debug("Disable plotting for next processings")
-            self.process_plot = False
-
-    def disable_parallel(self, cond=True):
-        """Disable the parallel processing if COND is True.
-
-        One can call restore_parallel() to restore the previous parallelization
-        value.
+                q = Queue()
+                last = time.monotonic()
+                while i_done < self.stop:
+                    self.__process_fn(q, self.dset, self.sset, i_done, self.process_plot.pop(), self.process_args)
+                    i_done = _collect(*q.get(), i_done, pbar)
+                    if time.monotonic() - last >= self.CHECKPOINT_PERIOD:
+                        last = _checkpoint(i_done)
+            _save(i_done)
+            # NOTE: Shards are merged by merge_shards().
+            if self.shard is None:
+                load.get_manifest(self.sset.get_path(save=True), refresh=range(self.start, i_done))
+                # NOTE: Bad entries of a resumed processing include the ones
+                # of the previous runs.
+                self.sset.save_valid(stop=i_done)
+            l.LOGGER.debug("Finished processing: trace #{} -> #{}".format(self.start, i_done - 1))
+
+    def process_shards(self):
+        """Run the processing shard by shard.
+
+        The shards are the ones of the plan saved in the saving directory (see
+        lib/shard.py and the shard-plan command of dataset.py). Claim the
+        shards one by one until none is left and process each of them using
+        process(), resuming from its saved state. The shard starting at trace
+        #0 publishes the template, which is awaited by the other ones. On
+        SIGINT, the claim of the current shard is released, such that any
+        worker can resume it. The same applies on error.
+
+        The dataset is not saved, see merge_shards() once all shards are done.
 
         """
-        if cond is True and self.is_parallel() is True:
-            l.LOGGER.debug("Disable parallelization for next processings")
-            self._process_nb = self.process_nb
-            self.process_nb = 0
+        self.shard_dir = shard.get_dir(self.dset.dirsave, self.sset.name)
+        plan = shard.load_plan(self.shard_dir)
+        if plan is None or plan["subset"] != self.sset.name:
+            raise Exception("No shard plan for subset '{}' in '{}'!".format(self.sset.name, self.shard_dir))
+        bad_entries = list(self.sset.bad_entries)
+        while self.stop != 0:
+            k = shard.claim_next(self.shard_dir, plan)
+            if k is None:
+                break
+            start, stop = plan["shards"][k]
+            state = shard.load_state(self.shard_dir, k)
+            self.shard = (k, start, stop)
+            self.start = start if state is None else state["dirty_idx"]
+            self.stop = stop
+            self.dset.dirty_idx = self.start
+            self.sset.bad_entries = bad_entries + ([] if state is None else [i for i in state["bad_entries"] if i not in bad_entries])
+            if self.start > 0:
+                published = shard.wait_template(self.shard_dir)
+                self.sset.template, self.sset.reference = published["template"], published["reference"]
+            l.LOGGER.info("Process shard #{}: trace #{} -> #{}".format(k, self.start, stop - 1))
+            try:
+                self.process()
+            finally:
+                if self.dset.dirty_idx < stop:
+                    shard.release(self.shard_dir, k)
+                    l.LOGGER.info("Shard #{} interrupted at trace #{}".format(k, self.dset.dirty_idx))
+        self.shard = None
+
+    def merge_shards(self):
+        """Merge the shards processed by process_shards() into the dataset.
+
+        The bad entries of the subset are the sorted union of the ones of the
+        input subset and of all shards, and its template is the one published
+        by the shard starting at trace #0, such that the result does not
+        depend on the workers nor on the order in which shards have been
+        processed. The trace manifest and the validity bitmap are updated for
+        all the traces. Raise an Exception if a shard is not done.
 
-    def restore_parallel(self, cond=True):
-        """Restore the process parallelization as before disable_parallel()
-        call if COND is True.
+        """
+        self.shard_dir = shard.get_dir(self.dset.dirsave, self.sset.name)
+        plan, published, bad_entries = shard.merge(self.shard_dir)
+        self.sset.template, self.sset.reference = published["template"], published["reference"]
+        self.sset.bad_entries = sorted(set(self.sset.bad_entries) | set(bad_entries))
+        self.dset.dirty_idx = plan["stop"]
+        self.dset.journal_clear()
+        load.get_manifest(self.sset.get_path(save=True), refresh=range(0, plan["stop"]))
+        self.sset.save_valid(stop=plan["stop"])
+        l.LOGGER.info("Merged {} shards: {} bad entries".format(len(plan["shards"]), len(self.sset.bad_entries)))
+
+    def __process_pool(self, i, collect, checkpoint, pbar):
+        """Process the traces from index I using a pool of workers.
+
+        Start self.process_nb workers running self.__process_worker(). Trace
+        indexes are fed into a task queue, keeping at most
+        WORKER_QUEUE_FACTOR tasks per worker in flight, until reaching the
+        stop index (which is set to 0 on SIGINT to stop feeding). Results are
+        registered using the COLLECT function as soon as they are received and
+        the state is saved every CHECKPOINT_PERIOD seconds using the
+        CHECKPOINT function. PBAR is TQDM's progress bar.
+
+        Return the index of the first trace not processed yet.
 
         """
-        if cond is True and self.is_parallel(was=True):
-            l.LOGGER.debug("Restore previous parallelization value for next processings")
-            self.process_nb = self._process_nb
+        tasks = Queue()
+        results = Queue()
+        ps = [Process(target=self.__process_worker, args=(tasks, results)) for _ in range(self.process_nb)]
+        for idx, proc in enumerate(ps):
+            proc.start()
+            l.LOGGER.debug("Started worker: idx={}".format(idx))
+        i_done = i
+        i_next = i
+        in_flight = 0
+        last = time.monotonic()
+        try:
+            while True:
+                # Feed the workers.
+                while i_next < self.stop and in_flight < self.WORKER_QUEUE_FACTOR * len(ps):
+                    tasks.put((i_next, self.process_plot.pop()))
+                    i_next += 1
+                    in_flight += 1
+                if in_flight == 0:
+                    break
+                # Get the next result.
+                try:
+                    check, i_processed = results.get(timeout=1)
+                except queue.Empty:
+                    if not all(proc.is_alive() for proc in ps):
+                        raise Exception("A worker of the processing died unexpectedly!")
+                    continue
+                in_flight -= 1
+                i_done = collect(check, i_processed, i_done, pbar)
+                if time.monotonic() - last >= self.CHECKPOINT_PERIOD:
+                    last = checkpoint(i_done)
+        finally:
+            # Stop and terminate the workers.
+            for _ in ps:
+                tasks.put(None)
+            for idx, proc in enumerate(ps):
+                l.LOGGER.debug("Join worker... idx={}".format(idx))
+                proc.join(timeout=None if proc.is_alive() else 0)
+        return i_done
 
-    def is_parallel(self, was=False):
-        """Return True if parallelization is enabled, False otherwise.
+    def __process_worker(self, tasks, results):
+        """Main function of the workers.
 
-        Set WAS to True to test against the value before the disable_parallel()
-        call.
+        Process the (trace index, plot flag) tuples received from the TASKS
+        Queue using self.__process_fn() and transmit their results using the
+        RESULTS Queue, until receiving None.
 
         """
-        return self.process_nb > 0 if was is False else self._process_nb > 0
+        # NOTE: SIGINT is handled by the main process, which stops feeding the
+        # workers and waits for the traces in flight.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for i, plot in iter(tasks.get, None):
+            self.__process_fn(results, self.dset, self.sset, i, plot, self.process_args)
+
+    def disable_plot(self, cond=True):
+        """Disable the plotting parameter if COND is True."""
+        if cond is True and self.process_plot is True:
+            l.LOGGER.debug("Disable plotting for next processings")
+            self.process_plot = False
+
+    def is_parallel(self):
+        """Return True if parallelization is enabled, False otherwise."""
+        return self.process_nb > 0
 
     def __signal_install(self):
         """Install the signal handler.
@@ -1051,10 +1430,15 @@ class DatasetProcessing():
         # * Check the trace is valid.
         check = False
         if i > 0:
-            check, ff_checked = analyze.fill_zeros_if_bad(sset.template, ff, log=True, log_idx=i)
+            # NOTE: Subsets pickled before the reference was introduced only
+            # have a template.
+            ref = getattr(sset, "reference", None)
+            ref = sset.template if ref is None else ref
+            check, ff_checked = analyze.fill_zeros_if_bad(ref, ff, log=True, log_idx=i)
         elif i == 0 and ff is not None:
             l.LOGGER.info("Trace #0 processing (e.g. creating a template) is assumed to be valid!")
             ff_checked = ff
+            sset.reference = ff
         else:
             raise Exception("Trace #0 processing encountered an error!")
         sset.replace_trace(ff_checked, TraceType.FF)
@@ -1062,7 +1446,7 @@ class DatasetProcessing():
         if sset.ff[0] is not None:
             libplot.plot_time_spec_sync_axis(sset.ff[0:1], samp_rate=dset.samp_rate, cond=plot, comp=complex.CompType.AMPLITUDE)
         # * Save the processed trace and transmit result to caller process.
-        sset.save_trace(nf=False, custom_dtype=False)
+        sset.save_trace(nf=False, custom_dtype=self.process_custom_dtype, compression=self.process_compression)
         q.put((check, i))
         l.LOGGER.debug("End __process_fn() for trace #{}".format(i))
 
@@ -0,0 +1,89 @@
+"""Instrumentation of processing stages.
+
+Measure the wall time, the CPU time, the peak resident memory and the number
+of bytes read of the process (and its terminated children) during a stage.
+Measures only rely on getrusage() and /proc/self/io, hence they are cheap
+enough to be always enabled.
+
+"""
+
+import resource
+import time
+
+# * Constants
+
+# Path of the I/O statistics of the current process (Linux only).
+PROC_IO = "/proc/self/io"
+
+# * Functions
+
+def get_read_bytes():
+    """Return the number of bytes read by the current process using read()
+    system calls (including the ones served by the page cache), or None if
+    the statistics are not available."""
+    try:
+        with open(PROC_IO, "r") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def snapshot():
+    """Return a dictionary of the current counters of the process."""
+    self = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "wall": time.time(),
+        "cpu": self.ru_utime + self.ru_stime + children.ru_utime + children.ru_stime,
+        # NOTE: ru_maxrss is in kilobytes on Linux.
+        "rss_peak": self.ru_maxrss * 1024,
+        "read": get_read_bytes(),
+    }
+
+def measure(start, end):
+    """Return the metrics of a stage given the START and END snapshots: wall
+    and CPU durations in seconds, peak resident memory at the end of the stage
+    and its growth during the stage in bytes, and number of bytes read."""
+    return {
+        "wall": end["wall"] - start["wall"],
+        "cpu": end["cpu"] - start["cpu"],
+        "rss_peak": end["rss_peak"],
+        "rss_growth": end["rss_peak"] - start["rss_peak"],
+        "read": end["read"] - start["read"] if end["read"] is not None and start["read"] is not None else None,
+    }
+
+def accumulate(total, metrics):
+    """Accumulate the METRICS of a stage run multiple times into TOTAL, and
+    return TOTAL."""
+    if total is None:
+        return dict(metrics, calls=1)
+    for k in ("wall", "cpu", "rss_growth"):
+        total[k] += metrics[k]
+    total["rss_peak"] = max(total["rss_peak"], metrics["rss_peak"])
+    total["read"] = total["read"] + metrics["read"] if total["read"] is not None and metrics["read"] is not None else None
+    total["calls"] += 1
+    return total
+
+def format_size(nbytes):
+    """Return a human readable string of the NBYTES size."""
+    if nbytes is None:
+        return "-"
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(nbytes) < 1024:
+            return "{:.1f} {}".format(nbytes, unit)
+        nbytes /= 1024
+    return "{:.1f} TiB".format(nbytes)
+
+def format_table(stages):
+    """Return a summary table of the STAGES dictionary, indexed by stage names
+    where nested stages are joined with '/', as a string."""
+    lines = ["{:<32} {:>6} {:>10} {:>10} {:>12} {:>12} {:>12}".format(
+        "stage", "calls", "wall [s]", "cpu [s]", "rss peak", "rss growth", "read")]
+    for name, m in stages.items():
+        depth = name.count("/")
+        lines.append("{:<32} {:>6d} {:>10.3f} {:>10.3f} {:>12} {:>12} {:>12}".format(
+            "  " * depth + name.split("/")[-1], m["calls"], m["wall"], m["cpu"],
+            format_size(m["rss_peak"]), format_size(m["rss_growth"]), format_size(m["read"])))
+    return "\n".join(lines)
@@ -0,0 +1,385 @@
+"""Key enumeration using histograms.
+
+Enumerate full keys in decreasing order of score from per-byte scores
+(LOG_PROBA) in the way of the HEL library: key bytes are merged two by two and
+the scores of the merged bytes are quantized into histograms. Candidates are
+verified against known plaintext/ciphertext pairs using a vectorized AES.
+
+The enumeration is split into tasks, walked in decreasing order of score and
+spread over worker processes. The completed tasks are checkpointed into a JSON
+file such that an enumeration can be interrupted and resumed.
+
+"""
+
+import collections
+import hashlib
+import json
+import multiprocessing
+import os
+from os import path
+import signal
+import time
+
+import numpy as np
+
+import lib.log as l
+import lib.keyrank as keyrank
+
+# * Constants
+
+# Number of candidate keys verified at once by the vectorized AES.
+BATCH = 2**16
+# Approximate number of keys enumerated by a single task.
+TASK_KEYS = 2**20
+# Number of seconds between two progress reports and checkpoints.
+PROGRESS_PERIOD = 10
+
+SBOX = np.array((
+0x63,0x7c,0x77,0x7b,0xf2,0x6b,0x6f,0xc5,0x30,0x01,0x67,0x2b,0xfe,0xd7,0xab,0x76,
+0xca,0x82,0xc9,0x7d,0xfa,0x59,0x47,0xf0,0xad,0xd4,0xa2,0xaf,0x9c,0xa4,0x72,0xc0,
+0xb7,0xfd,0x93,0x26,0x36,0x3f,0xf7,0xcc,0x34,0xa5,0xe5,0xf1,0x71,0xd8,0x31,0x15,
+0x04,0xc7,0x23,0xc3,0x18,0x96,0x05,0x9a,0x07,0x12,0x80,0xe2,0xeb,0x27,0xb2,0x75,
+0x09,0x83,0x2c,0x1a,0x1b,0x6e,0x5a,0xa0,0x52,0x3b,0xd6,0xb3,0x29,0xe3,0x2f,0x84,
+0x53,0xd1,0x00,0xed,0x20,0xfc,0xb1,0x5b,0x6a,0xcb,0xbe,0x39,0x4a,0x4c,0x58,0xcf,
+0xd0,0xef,0xaa,0xfb,0x43,0x4d,0x33,0x85,0x45,0xf9,0x02,0x7f,0x50,0x3c,0x9f,0xa8,
+0x51,0xa3,0x40,0x8f,0x92,0x9d,0x38,0xf5,0xbc,0xb6,0xda,0x21,0x10,0xff,0xf3,0xd2,
+0xcd,0x0c,0x13,0xec,0x5f,0x97,0x44,0x17,0xc4,0xa7,0x7e,0x3d,0x64,0x5d,0x19,0x73,
+0x60,0x81,0x4f,0xdc,0x22,0x2a,0x90,0x88,0x46,0xee,0xb8,0x14,0xde,0x5e,0x0b,0xdb,
+0xe0,0x32,0x3a,0x0a,0x49,0x06,0x24,0x5c,0xc2,0xd3,0xac,0x62,0x91,0x95,0xe4,0x79,
+0xe7,0xc8,0x37,0x6d,0x8d,0xd5,0x4e,0xa9,0x6c,0x56,0xf4,0xea,0x65,0x7a,0xae,0x08,
+0xba,0x78,0x25,0x2e,0x1c,0xa6,0xb4,0xc6,0xe8,0xdd,0x74,0x1f,0x4b,0xbd,0x8b,0x8a,
+0x70,0x3e,0xb5,0x66,0x48,0x03,0xf6,0x0e,0x61,0x35,0x57,0xb9,0x86,0xc1,0x1d,0x9e,
+0xe1,0xf8,0x98,0x11,0x69,0xd9,0x8e,0x94,0x9b,0x1e,0x87,0xe9,0xce,0x55,0x28,0xdf,
+0x8c,0xa1,0x89,0x0d,0xbf,0xe6,0x42,0x68,0x41,0x99,0x2d,0x0f,0xb0,0x54,0xbb,0x16), dtype=np.uint8)
+RCON = np.array((0x01, 0x02, 0x04, 0x08, 0x10, 0x20, 0x40, 0x80, 0x1b, 0x36), dtype=np.uint8)
+XTIME = np.array([((x << 1) ^ (0x1b if x & 0x80 else 0)) & 0xff for x in range(256)], dtype=np.uint8)
+
+def get_tables():
+    """Return the AES T-tables as a tuple (T, SUB) of 2D np.array of shape
+    (4, 256). Words are little-endian columns of the state, such that T[i]
+    combines SubBytes and MixColumns for the byte of row i of a column and
+    SUB[i] is SubBytes for the byte of row i."""
+    s = SBOX.astype(np.uint32)
+    s2 = XTIME[SBOX].astype(np.uint32)
+    s3 = s2 ^ s
+    t = np.stack((s2 | s << 8 | s << 16 | s3 << 24,
+                  s3 | s2 << 8 | s << 16 | s << 24,
+                  s | s3 << 8 | s2 << 16 | s << 24,
+                  s | s << 8 | s3 << 16 | s2 << 24)).astype("<u4")
+    sub = np.stack([s << (8 * i) for i in range(4)]).astype("<u4")
+    return t, sub
+
+T, SUB = get_tables()
+
+# Context of the enumeration in worker processes (see init_worker()).
+CTX = None
+
+# * Vectorized AES
+
+def aes_expand_keys(keys):
+    """Return the AES-128 round keys of the KEYS 2D np.array of shape
+    (nb_keys, 16) as a 3D np.array of little-endian words of shape (11, 4,
+    nb_keys)."""
+    keys = np.ascontiguousarray(keys, dtype=np.uint8)
+    rk = np.empty((11, 4, len(keys)), dtype="<u4")
+    rk[0] = keys.view("<u4").T
+    for r in range(1, 11):
+        w = rk[r - 1][3]
+        # RotWord, SubWord and Rcon.
+        w = SUB[0][(w >> 8) & 0xff] ^ SUB[1][(w >> 16) & 0xff] ^ SUB[2][w >> 24] ^ SUB[3][w & 0xff] ^ RCON[r - 1]
+        rk[r][0] = rk[r - 1][0] ^ w
+        rk[r][1] = rk[r - 1][1] ^ rk[r][0]
+        rk[r][2] = rk[r - 1][2] ^ rk[r][1]
+        rk[r][3] = rk[r - 1][3] ^ rk[r][2]
+    return rk
+
+def aes_round(s, rk, tables):
+    """Compute an AES round on the S tuple of 4 columns using the RK round
+    key and the TABLES (either T or SUB for the last round)."""
+    return tuple(tables[0][s[c] & 0xff] ^ tables[1][(s[(c + 1) % 4] >> 8) & 0xff]
+                 ^ tables[2][(s[(c + 2) % 4] >> 16) & 0xff] ^ tables[3][s[(c + 3) % 4] >> 24] ^ rk[c]
+                 for c in range(4))
+
+def aes_encrypt(pt, keys):
+    """Encrypt the PT plaintext (16 bytes) under every key of the KEYS 2D
+    np.array of shape (nb_keys, 16) using AES-128 with T-tables. Return the
+    ciphertexts as a 2D np.array of shape (nb_keys, 16)."""
+    rk = aes_expand_keys(keys)
+    pt = np.frombuffer(np.asarray(pt, dtype=np.uint8).tobytes(), dtype="<u4")
+    s = tuple(rk[0][c] ^ pt[c] for c in range(4))
+    for r in range(1, 10):
+        s = aes_round(s, rk[r], T)
+    s = aes_round(s, rk[10], SUB)
+    return np.stack(s, axis=1).astype("<u4").view(np.uint8)
+
+# * Enumeration
+
+def get_context(log_proba, pts, cts, nb_bins=keyrank.NB_BINS):
+    """Build the context of an enumeration.
+
+    LOG_PROBA is a 2D np.array of shape (16, 256) containing the scores of
+    every key byte guess (the higher the more likely). PTS and CTS are two
+    known plaintext/ciphertext pairs. Key bytes are merged two by two and the
+    scores of the 8 merged bytes are quantized into NB_BINS bins of same
+    width.
+
+    Return a dictionary used by the enumeration functions.
+
+    """
+    log_proba = np.asarray(log_proba, dtype=np.float64)
+    assert log_proba.shape == (16, 256), "Enumeration only supports AES-128 scores!"
+    assert len(pts) == 2 and len(cts) == 2
+    merged = (log_proba[0::2, :, np.newaxis] + log_proba[1::2, np.newaxis, :]).reshape(8, -1)
+    lo = np.min(merged, axis=1, keepdims=True)
+    width = np.max(np.max(merged, axis=1, keepdims=True) - lo) / nb_bins
+    width = width if width > 0 else 1
+    idx = np.minimum(((merged - lo) / width).astype(np.int64), nb_bins - 1)
+    hists = np.stack([np.bincount(i, minlength=nb_bins) for i in idx])
+    # Number of full keys for every sum of bins of merged bytes [j ; 8[.
+    suffix = [np.ones(1)]
+    for j in reversed(range(8)):
+        suffix.insert(0, np.convolve(hists[j].astype(np.float64), suffix[0]))
+    # For every merged byte j and every sum of bins REST of the merged bytes
+    # [j ; 8[, bins of the merged byte j which can be completed, stored as
+    # (PTR, VALID) where VALID[PTR[REST]:PTR[REST + 1]] are the bins.
+    valid = []
+    for j in range(8):
+        cands = np.flatnonzero(hists[j])
+        nrest = np.arange(len(suffix[j]))[:, np.newaxis] - cands[np.newaxis, :]
+        ok = (nrest >= 0) & (nrest < len(suffix[j + 1]))
+        ok[ok] = suffix[j + 1][nrest[ok]] > 0
+        valid.append((np.concatenate(([0], np.cumsum(np.sum(ok, axis=1)))), np.broadcast_to(cands, ok.shape)[ok]))
+    return {
+        "hists": hists,
+        "valid": valid,
+        "order": np.argsort(idx, axis=1, kind="stable"),
+        "starts": np.concatenate((np.zeros((8, 1), dtype=np.int64), np.cumsum(hists, axis=1)), axis=1),
+        "suffix": suffix,
+        "pts": np.asarray(pts, dtype=np.uint8),
+        "cts": np.asarray(cts, dtype=np.uint8),
+        "digest": hashlib.sha1(log_proba.tobytes()).hexdigest(),
+        "nb_bins": nb_bins,
+    }
+
+def iter_prefixes(ctx, bin, prefix):
+    """Yield the tuples (NB_KEYS, BIN, PREFIX) splitting the keys of the BIN
+    sum of bins whose first merged bytes are in the bins of PREFIX, such that
+    every prefix contains at most TASK_KEYS keys when possible."""
+    hists, suffix = ctx["hists"], ctx["suffix"]
+    j, rest = len(prefix), bin - sum(prefix)
+    if not 0 <= rest < len(suffix[j]) or suffix[j][rest] == 0:
+        return
+    nb_keys = np.prod([float(hists[k][b]) for k, b in enumerate(prefix)]) * suffix[j][rest]
+    if nb_keys <= TASK_KEYS or j == 7:
+        yield nb_keys, bin, prefix
+    else:
+        for b in np.flatnonzero(hists[j]):
+            yield from iter_prefixes(ctx, bin, prefix + (int(b),))
+
+def get_tasks(ctx, bit_bound_end, start=0):
+    """Yield the tasks of an enumeration in decreasing order of score.
+
+    A task is a tuple (IDX, ITEMS) where ITEMS is a list of tuples (BIN,
+    PREFIX): BIN is the sum of the bins of the 8 merged bytes and PREFIX the
+    bins of the first merged bytes. Consecutive items are grouped such that
+    a task contains about TASK_KEYS keys. Stop after the bin in which the rank
+    reaches 2^BIT_BOUND_END. Skip the START first tasks.
+
+    """
+    idx, nb_keys = 0, 0
+    items, items_keys = [], 0
+    for bin in reversed(range(len(ctx["suffix"][0]))):
+        if nb_keys >= 2.0 ** bit_bound_end:
+            break
+        for nb, bin, prefix in iter_prefixes(ctx, bin, ()):
+            items.append((bin, prefix))
+            items_keys += nb
+            nb_keys += nb
+            if items_keys >= TASK_KEYS:
+                if idx >= start:
+                    yield idx, items
+                idx += 1
+                items, items_keys = [], 0
+    if len(items) > 0 and idx >= start:
+        yield idx, items
+
+def iter_bins(ctx, j, bins, rest):
+    """Yield every assignment of bins to the merged bytes [j ; 8[ completing
+    the BINS 2D np.array of shape (nb_prefixes, j) such that they sum to the
+    REST 1D np.array. Assignments are computed in a vectorized way and yielded
+    by batches of about BATCH rows in a 2D np.array of shape (nb, 8)."""
+    if j == 8:
+        yield bins
+        return
+    ptr, valid = ctx["valid"][j]
+    counts = ptr[rest + 1] - ptr[rest]
+    ends = np.cumsum(counts)
+    # Split the prefixes such that every chunk produces about BATCH rows.
+    splits = np.searchsorted(ends, np.arange(BATCH, ends[-1], BATCH), side="right") if len(ends) > 0 else []
+    for rows in np.split(np.arange(len(bins)), splits):
+        if len(rows) == 0:
+            continue
+        row = np.repeat(rows, counts[rows])
+        if len(row) == 0:
+            continue
+        offset = np.arange(len(row)) - np.repeat(ends[rows] - counts[rows] - (ends[rows[0]] - counts[rows[0]]), counts[rows])
+        b = valid[ptr[rest[row]] + offset]
+        yield from iter_bins(ctx, j + 1, np.concatenate((bins[row], b[:, np.newaxis]), axis=1), rest[row] - b)
+
+def iter_keys(ctx, bins):
+    """Yield the full keys whose merged bytes are in the bins of the BINS 2D
+    np.array of shape (nb_assignments, 8), by batches of at most BATCH keys in
+    a 2D np.array of shape (nb_keys, 16)."""
+    sizes = ctx["hists"][np.arange(8), bins]
+    counts = np.prod(sizes, axis=1)
+    assert np.all(np.prod(sizes, axis=1, dtype=np.float64) < 2.0 ** 62), "Too many keys in a single bin assignment!"
+    ends = np.cumsum(counts)
+    for start in range(0, int(ends[-1]), BATCH):
+        # Index of the assignment and of the key inside it for every key.
+        idx = np.arange(start, min(start + BATCH, int(ends[-1])))
+        assign = np.searchsorted(ends, idx, side="right")
+        offset = idx - (ends[assign] - counts[assign])
+        keys = np.empty((len(idx), 16), dtype=np.uint8)
+        for j in reversed(range(8)):
+            size = sizes[assign, j]
+            merged = ctx["order"][j][ctx["starts"][j][bins[assign, j]] + offset % size]
+            offset //= size
+            keys[:, 2 * j] = merged >> 8
+            keys[:, 2 * j + 1] = merged & 0xff
+        yield keys
+
+def check_keys(ctx, keys):
+    """Return the key of the KEYS 2D np.array matching the two known
+    plaintext/ciphertext pairs, or None."""
+    match = np.flatnonzero(np.all(aes_encrypt(ctx["pts"][0], keys) == ctx["cts"][0], axis=1))
+    for i in match:
+        if np.all(aes_encrypt(ctx["pts"][1], keys[i:i + 1]) == ctx["cts"][1]):
+            return keys[i]
+    return None
+
+def run_task(task):
+    """Enumerate and check all keys of TASK (see get_tasks()) using the
+    context of the worker. Return a tuple (IDX, KEY, NB_KEYS) where KEY is
+    the found key or None."""
+    idx, items = task
+    ctx = CTX
+    nb_keys = 0
+    batch, size = [], 0
+    for bin, prefix in items:
+        for bins in iter_bins(ctx, len(prefix), np.array([prefix], dtype=np.int64).reshape(1, -1), np.array([bin - sum(prefix)])):
+            for keys in iter_keys(ctx, bins):
+                # Group small sets of candidates to keep the AES vectorized.
+                batch.append(keys)
+                size += len(keys)
+                if size >= BATCH:
+                    keys = np.concatenate(batch)
+                    batch, size = [], 0
+                    key = check_keys(ctx, keys)
+                    nb_keys += len(keys)
+                    if key is not None:
+                        return idx, key, nb_keys
+    if size > 0:
+        keys = np.concatenate(batch)
+        key = check_keys(ctx, keys)
+        nb_keys += len(keys)
+        if key is not None:
+            return idx, key, nb_keys
+    return idx, None, nb_keys
+
+def init_worker(ctx):
+    """Initialize a worker process with the CTX enumeration context."""
+    global CTX
+    CTX = ctx
+    # NOTE: Only the main process handles C^c to save the checkpoint.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def checkpoint_load(fp, ctx):
+    """Return the tuple (task, nb_keys) saved in the checkpoint FP for the
+    CTX enumeration, or (0, 0) if no compatible checkpoint exists."""
+    if fp is None or fp == "" or not path.exists(fp):
+        return 0, 0
+    with open(fp, "r") as f:
+        ckpt = json.load(f)
+    if ckpt.get("digest") != ctx["digest"] or ckpt.get("nb_bins") != ctx["nb_bins"]:
+        l.LOGGER.warning("Ignore checkpoint '{}' computed for other scores".format(fp))
+        return 0, 0
+    return ckpt["task"], ckpt["nb_keys"]
+
+def checkpoint_save(fp, ctx, task, nb_keys, key=None):
+    """Save the number of completed tasks TASK and the number of enumerated
+    keys NB_KEYS of the CTX enumeration into the checkpoint FP."""
+    if fp is None or fp == "":
+        return
+    ckpt = {"digest": ctx["digest"], "nb_bins": ctx["nb_bins"], "task": task, "nb_keys": nb_keys,
+            "rank_bound": float(np.log2(max(nb_keys, 1))), "key": None if key is None else bytes(key).hex()}
+    with open(fp + ".tmp", "w") as f:
+        json.dump(ckpt, f)
+    os.replace(fp + ".tmp", fp)
+
+def iter_results(pool, tasks, jobs):
+    """Yield the results of the TASKS run by the POOL of JOBS workers in
+    order. Contrary to Pool.imap(), only a few tasks are submitted in advance
+    since the tasks of a whole enumeration do not fit into memory."""
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(run_task, (task,)))
+        if len(pending) >= 2 * jobs:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+def enumerate_keys(log_proba, pts, cts, bit_bound_end, jobs=0, checkpoint=None, nb_bins=keyrank.NB_BINS):
+    """Enumerate keys until finding the one matching known pairs.
+
+    Walk the keys in decreasing order of the LOG_PROBA scores until a rank of
+    2^BIT_BOUND_END, using JOBS worker processes (0 for all CPUs). PTS and
+    CTS are two known plaintext/ciphertext pairs. If CHECKPOINT is set to a
+    file path, resume from it if it exists and periodically save the progress
+    into it.
+
+    Return a tuple (KEY, NB_KEYS) where KEY is the found key as a 1D np.array
+    or None.
+
+    """
+    ctx = get_context(log_proba, pts, cts, nb_bins)
+    task, nb_keys = checkpoint_load(checkpoint, ctx)
+    if task > 0:
+        l.LOGGER.info("Resume enumeration from task {} after 2^{:.2f} keys".format(task, np.log2(max(nb_keys, 1))))
+    jobs = os.cpu_count() if jobs < 1 else jobs
+    tasks = get_tasks(ctx, bit_bound_end, start=task)
+    if jobs == 1:
+        global CTX
+        CTX = ctx
+        pool = None
+        results = map(run_task, tasks)
+    else:
+        pool = multiprocessing.Pool(jobs, initializer=init_worker, initargs=(ctx,))
+        results = iter_results(pool, tasks, jobs)
+    key, nb = None, 0
+    nb_keys_start, time_start = nb_keys, time.time()
+    time_last = time_start
+    try:
+        # NOTE: Results are ordered, hence the completed tasks always form a
+        # contiguous prefix which can be checkpointed. The task of a found key
+        # is not marked as completed to find it again on resume.
+        for idx, key, nb in results:
+            if key is not None:
+                break
+            nb_keys += nb
+            task = idx + 1
+            if time.time() - time_last > PROGRESS_PERIOD:
+                time_last = time.time()
+                l.LOGGER.info("Enumerated 2^{:.2f} keys ({:.2e} keys/s)".format(
+                    np.log2(max(nb_keys, 1)), (nb_keys - nb_keys_start) / (time_last - time_start)))
+                checkpoint_save(checkpoint, ctx, task, nb_keys)
+    except KeyboardInterrupt:
+        l.LOGGER.warning("Enumeration interrupted after task {}".format(task))
+    finally:
+        if pool is not None:
+            pool.terminate()
+        checkpoint_save(checkpoint, ctx, task, nb_keys, key)
+    nb_keys += nb if key is not None else 0
+    duration = time.time() - time_start
+    l.LOGGER.info("Enumerated 2^{:.2f} keys in {:.2f}s ({:.2e} keys/s)".format(
+        np.log2(max(nb_keys, 1)), duration, (nb_keys - nb_keys_start) / max(duration, 1e-9)))
+    return key, nb_keys
@@ -0,0 +1,84 @@
+"""Key rank estimation using histograms.
+
+Pure Numpy implementation of the histogram convolution rank estimation
+(Glowacz et al., "Simpler and More Efficient Rank Estimation for Side-Channel
+Security Assessment", FSE 2015), which is also the method of the HEL library,
+used as a fallback when HEL is not installed.
+
+"""
+
+import time
+
+import numpy as np
+
+# Default number of bins of the histogram of a single key byte.
+NB_BINS = 512
+
+def get_histograms(log_proba, key, nb_bins=NB_BINS):
+    """Quantize the scores of every key byte into histograms.
+
+    LOG_PROBA is a 2D np.array of shape (nb_bytes, nb_guesses) containing the
+    scores of every key guess (the higher the more likely) and KEY is the
+    known key. All bytes use the same bin width, such that the bin index of a
+    full key is the sum of the bin indexes of its bytes.
+
+    Return a tuple (HISTS, KEY_BIN) where HISTS is a 2D np.array of shape
+    (nb_bytes, NB_BINS) and KEY_BIN the bin index of the known key in the
+    convolution of HISTS.
+
+    """
+    log_proba = np.asarray(log_proba, dtype=np.float64)
+    assert log_proba.ndim == 2 and len(key) == len(log_proba)
+    assert np.all(np.isfinite(log_proba)), "Scores should not contain infinite or NaN values!"
+    lo = np.min(log_proba, axis=1, keepdims=True)
+    width = np.max(np.max(log_proba, axis=1, keepdims=True) - lo) / nb_bins
+    width = width if width > 0 else 1
+    idx = np.minimum(((log_proba - lo) / width).astype(np.int64), nb_bins - 1)
+    hists = np.stack([np.bincount(i, minlength=nb_bins) for i in idx]).astype(np.float64)
+    key_bin = int(np.sum(idx[np.arange(len(key)), np.asarray(key)]))
+    return hists, key_bin
+
+def convolve_all(hists):
+    """Convolve all histograms contained in the HISTS 2D np.array together.
+
+    The convolution is computed as a tree. The first two levels, whose counts
+    are exactly represented in float64, are computed in batch using the FFT
+    and rounded. Upper levels are computed with direct convolutions, whose
+    relative error stays bounded when counts reach 2^128.
+
+    """
+    hists = [h for h in hists]
+    for _ in range(2):
+        if len(hists) < 2:
+            break
+        odd = [hists[-1]] if len(hists) % 2 == 1 else []
+        a, b = np.stack(hists[0:len(hists) - len(odd):2]), np.stack(hists[1:len(hists) - len(odd):2])
+        n = 2 * a.shape[1] - 1
+        conv = np.fft.irfft(np.fft.rfft(a, n, axis=1) * np.fft.rfft(b, n, axis=1), n, axis=1)
+        hists = [np.maximum(np.rint(h), 0) for h in conv] + odd
+    while len(hists) > 1:
+        odd = [hists[-1]] if len(hists) % 2 == 1 else []
+        hists = [np.convolve(hists[i], hists[i + 1]) for i in range(0, len(hists) - len(odd), 2)] + odd
+    return hists[0]
+
+def rank(log_proba, key, nb_bins=NB_BINS):
+    """Estimate the rank of the known KEY given the LOG_PROBA scores.
+
+    See get_histograms() for the arguments. Since the error of the bin index
+    of a full key is lower than one bin per byte, keys located more than
+    nb_bytes bins above (resp. below) the key bin are certainly ranked before
+    (resp. after) the key.
+
+    Return a tuple (RANK_MIN, RANK_ROUNDED, RANK_MAX, TIME) where ranks are
+    log2 of the number of keys ranked before or with the known key and TIME is
+    the computation time in seconds.
+
+    """
+    start = time.time()
+    hists, key_bin = get_histograms(log_proba, key, nb_bins)
+    hist = convolve_all(hists)
+    nb_bytes = len(hists)
+    rank_min = 1 + np.sum(hist[key_bin + nb_bytes:])
+    rank_rounded = 1 + np.sum(hist[key_bin + 1:]) + (hist[key_bin] - 1) / 2
+    rank_max = np.sum(hist[max(key_bin - nb_bytes + 1, 0):])
+    return float(np.log2(rank_min)), float(np.log2(max(rank_rounded, 1))), float(np.log2(max(rank_max, 1))), time.time() - start
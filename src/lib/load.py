@@ -12,6 +12,7 @@ from tqdm import tqdm
 
 import lib.log as l
 import lib.plot as libplot
+import lib.codec as codec
 from lib.soapysdr import MySoapySDR
 
 # * Global variables
@@ -41,6 +42,14 @@ DATASET_RAW_INPUT_PLAINTEXT_UNPACK="{}_p.txt"
 DATASET_RAW_INPUT_FORMAT="{}_{}"
 DATASET_NPY_INPUT_KEY="k.npy"
 DATASET_NPY_INPUT_PLAINTEXT="p.npy"
+# Validity bitmap of the traces of a subset (see save_valid()).
+DATASET_NPZ_VALID="valid.npz"
+# Index of the trace files of a subset (see get_manifest()).
+DATASET_NPZ_MANIFEST="manifest.npz"
+# Number of indexed traces checked against the manifest when loading it.
+MANIFEST_CHECK_NB=8
+# Magic number of the files saved by np.save().
+NPY_MAGIC=b"\x93NUMPY"
 
 # * Misc
 
@@ -48,18 +57,113 @@ def get_nb_if_not_set(indir, nb):
     return nb if nb > 0 else get_nb(indir)
 
 def get_nb(dir):
-    """Return the number of traces contained in a dataset."""
+    """Return the number of traces contained in a dataset, i.e. the number of
+    consecutive indexes for which all the existing fields (NF and/or FF) have
+    a trace file. The count is maintained in the manifest of the dataset (see
+    get_manifest())."""
     if is_raw_traces(dir):
         return 1
-    for i in range(0, sys.maxsize):
-        if get_dataset_is_nf_exist(dir) and not path.exists(get_dataset_path_unpack_nf(dir, i)):
-            return i
-        elif get_dataset_is_ff_exist(dir) and not path.exists(get_dataset_path_unpack_ff(dir, i)):
-            return i
-        elif not get_dataset_is_nf_exist(dir) and not get_dataset_is_ff_exist(dir):
+    manifest = get_manifest(dir)
+    return -1 if manifest is None else len(manifest["size"])
+
+def get_dataset_path_manifest(dir):
+    return path.join(dir, DATASET_NPZ_MANIFEST)
+
+def stat_traces(dir, i, fields):
+    """Return a tuple of the total size and the latest modification time of
+    the trace files of index I for the FIELDS list of field identifiers, or
+    None if one of them does not exist."""
+    size, mtime = 0, 0.
+    for field in fields:
+        try:
+            st = os.stat(path.join(dir, DATASET_FILENAME_UNPACK.format(i, field)))
+        except FileNotFoundError:
+            return None
+        size, mtime = size + st.st_size, max(mtime, st.st_mtime)
+    return size, mtime
+
+def check_manifest(dir, manifest, fields, idx):
+    """Check the entries IDX of MANIFEST against the trace files of DIR for
+    the FIELDS list of field identifiers, updating the stale ones in place.
+    Return a tuple of the number of traces until the first missing one
+    (len(MANIFEST["size"]) if none is missing) and the number of stale
+    entries."""
+    stale = 0
+    for i in idx:
+        st = stat_traces(dir, i, fields)
+        if st is None:
+            return i, stale
+        if st != (manifest["size"][i], manifest["mtime"][i]):
+            manifest["size"][i], manifest["mtime"][i] = st
+            stale += 1
+    return len(manifest["size"]), stale
+
+def get_manifest(dir, refresh=None, verify=False):
+    """Return the manifest of the unpacked traces of DIR, or None if DIR
+    does not contain traces.
+
+    The manifest is a dictionary whose "size" and "mtime" entries are 1D
+    np.ndarray containing the total size and the latest modification time of
+    the trace files of each index. It is saved in DIR, such that it is only
+    checked and extended with the new traces instead of probing every file
+    again. The check compares the last indexed trace and MANIFEST_CHECK_NB
+    entries spread over the subset against their files. If one of them has
+    been removed or re-written, or if VERIFY is True, all entries are checked:
+    stale entries are updated and the manifest is truncated before the first
+    missing trace.
+
+    REFRESH can be set to an iterable of already indexed trace indexes which
+    have been re-written, to update their entries.
+
+    """
+    fields = [f for f, exist in ((DATASET_FIELD_ID_NF, get_dataset_is_nf_exist(dir)),
+                                 (DATASET_FIELD_ID_FF, get_dataset_is_ff_exist(dir))) if exist]
+    if len(fields) == 0:
+        return None
+    fp = get_dataset_path_manifest(dir)
+    manifest = {"size": np.zeros(0, dtype=np.int64), "mtime": np.zeros(0, dtype=np.float64)}
+    if path.exists(fp):
+        try:
+            with np.load(fp) as npz:
+                if list(npz["fields"]) == fields:
+                    manifest = {"size": npz["size"], "mtime": npz["mtime"]}
+        except Exception as e:
+            l.LOGGER.warning("Cannot load the manifest '{}': {}".format(fp, e))
+    nb = len(manifest["size"])
+    refreshed = False
+    if nb > 0:
+        idx = np.unique(np.append(np.linspace(0, nb - 1, MANIFEST_CHECK_NB, dtype=int), nb - 1))
+        nb_ok, stale = check_manifest(dir, manifest, fields, range(nb) if verify else idx)
+        if verify is False and (nb_ok < nb or stale > 0):
+            nb_ok, stale_all = check_manifest(dir, manifest, fields, range(nb))
+            stale += stale_all
+        if nb_ok < nb or stale > 0:
+            l.LOGGER.debug("Update the manifest of '{}': {} stale entries, {} traces until the first missing one".format(dir, stale, nb_ok))
+            manifest, nb, refreshed = {"size": manifest["size"][:nb_ok], "mtime": manifest["mtime"][:nb_ok]}, nb_ok, True
+    for i in [] if refresh is None else refresh:
+        st = stat_traces(dir, i, fields) if i < nb else None
+        if st is not None:
+            manifest["size"][i], manifest["mtime"][i] = st
+            refreshed = True
+    new = []
+    for i in range(nb, sys.maxsize):
+        st = stat_traces(dir, i, fields)
+        if st is None:
             break
-        assert(i < 1e5), "Infinite loop?"
-    return -1
+        new.append(st)
+    if len(new) > 0 or refreshed or not path.exists(fp):
+        new = np.array(new, dtype=np.float64).reshape(-1, 2)
+        manifest["size"] = np.concatenate((manifest["size"], new[:, 0].astype(np.int64)))
+        manifest["mtime"] = np.concatenate((manifest["mtime"], new[:, 1]))
+        # NOTE: Write then rename to never leave a truncated file behind,
+        # using a unique temporary file for concurrent processes.
+        fp_tmp = "{}.{}.tmp.npz".format(fp, os.getpid())
+        try:
+            np.savez(fp_tmp, fields=fields, size=manifest["size"], mtime=manifest["mtime"])
+            os.replace(fp_tmp, fp)
+        except OSError as e:
+            l.LOGGER.debug("Cannot save the manifest '{}': {}".format(fp, e))
+    return manifest
 
 def find_bad_entry(arr, ref_size=None, log=True):
     """Return bad entry (metadata or trace) indexes from the 2D np.array or
@@ -88,6 +192,9 @@ def prune_entry(arr, idx):
     """Remove entries from 1D np.array ARR having indexes equal to values in
     list IDX. WARNING: np.delete is not in-place, it will return a copy of the
     array, doesn't work well with GB traces."""
+    # NOTE: Avoid the copy when there is nothing to remove.
+    if isinstance(arr, np.ndarray) and len(idx) == 0:
+        return arr
     return np.delete(arr, idx, 0)
 
 def prune_entry_all_dataset(ks, pt, nf, ff):
@@ -97,9 +204,16 @@ def prune_entry_all_dataset(ks, pt, nf, ff):
     return (prune_entry(ks, bad), prune_entry(pt, bad),
             prune_entry(nf, bad), prune_entry(ff, bad))
 
-def reduce_entry_all_dataset(ks, pt, nf, ff, nb=0):
+def reduce_entry_all_dataset(ks, pt, nf, ff, nb=0, valid=None):
     """Remove entries above NB for the entire dataset, hence containing NB
-    entries. Set to 0 for maximum traces."""
+    entries. Set to 0 for maximum traces.
+
+    If VALID is set to a validity bitmap (see load_valid()), also remove the
+    invalid entries among the NB first ones. Arrays which do not contain NB
+    entries (e.g. traces loaded while skipping the invalid ones, see
+    load_all_traces()) are assumed to be already free of invalid entries.
+
+    """
     nb = len(ks) if nb == 0 else nb
     if ks is not None:
         ks = prune_entry(ks, range(nb, len(ks)))
@@ -109,8 +223,42 @@ def reduce_entry_all_dataset(ks, pt, nf, ff, nb=0):
         nf = prune_entry(nf, range(nb, len(nf)))
     if ff is not None:
         ff = prune_entry(ff, range(nb, len(ff)))
+    if valid is not None:
+        valid = get_valid_range(valid, 0, nb)
+        ks, pt, nf, ff = [arr if arr is None or len(arr) != nb else prune_entry(arr, np.flatnonzero(~valid)) for arr in (ks, pt, nf, ff)]
     return ks, pt, nf, ff
 
+# * Validity
+
+def get_dataset_path_valid(dir):
+    return path.join(dir, DATASET_NPZ_VALID)
+
+def save_valid(dir, valid):
+    """Save the VALID validity bitmap (1D np.array of bool, False for an
+    invalid trace) in DIR, packed with 1 bit per trace."""
+    fp = get_dataset_path_valid(dir)
+    # NOTE: Write then rename to never leave a truncated file behind.
+    fp_tmp = fp + ".tmp.npz"
+    np.savez(fp_tmp, bits=np.packbits(valid), nb=len(valid))
+    os.replace(fp_tmp, fp)
+
+def load_valid(dir):
+    """Load the validity bitmap saved in DIR by save_valid(). Return a 1D
+    np.array of bool, or None if no bitmap is saved."""
+    fp = get_dataset_path_valid(dir)
+    if not path.exists(fp):
+        return None
+    with np.load(fp) as npz:
+        return np.unpackbits(npz["bits"], count=int(npz["nb"])).astype(bool)
+
+def get_valid_range(valid, start, stop):
+    """Return the validity of traces [START ; STOP[ using the VALID bitmap,
+    traces outside of the bitmap being considered as valid."""
+    out = np.ones(stop - start, dtype=bool)
+    known = valid[start:stop]
+    out[:len(known)] = known
+    return out
+
 # * Metadata
 
 def is_key_fixed(dir):
@@ -246,7 +394,7 @@ def np_load_if_exist(fp):
     None. NOTE: Use this function only for traces, not for inputs.
 
     """
-    return None if not path.exists(fp) else MySoapySDR.numpy_load(fp)
+    return None if not path.exists(fp) else load_trace(fp)
 
 def is_dataset_packed(dir):
     """Return True if the dataset is packed, False otherwise."""
@@ -290,27 +438,60 @@ def load_raw_trace(dir, rad_idx, rec_idx, log=False):
     if path.exists(fp):
         l.LOGGER.info("Load RAW trace from {}".format(fp))
         try:
-            trace = MySoapySDR.numpy_load(fp)
+            trace = load_trace(fp)
         except Exception as e:
             print(e)
     else:
         l.LOGGER.warning("No loaded raw trace for radio index #{}!".format(rad_idx))
     return trace
 
-def save_pair_trace(dir, idx, nf, ff, custom_dtype=True):
+def save_trace(fp, trace, custom_dtype=True, compression=None):
+    """Save a single TRACE into the FP file, using our custom dtype if
+    CUSTOM_DTYPE is True. If COMPRESSION is set to a tuple of codec and level
+    (see codec.parse()), the trace is compressed (see codec.save())."""
+    if compression is not None:
+        if custom_dtype is True and trace.dtype == np.complex64:
+            trace = MySoapySDR.complex64_to_dtype(trace)
+        codec.save(fp, trace, *compression)
+    elif custom_dtype is True:
+        MySoapySDR.numpy_save(fp, trace)
+    else:
+        np.save(fp, trace)
+
+def is_npy(fp):
+    """Return True if the FP file has been saved by np.save()."""
+    with open(fp, "rb") as f:
+        return f.read(len(NPY_MAGIC)) == NPY_MAGIC
+
+def is_custom_dtype(fp):
+    """Return True if the trace of the FP file has been saved using our custom
+    dtype, compressed or not, and False if it has been saved using the default
+    Numpy format."""
+    header = codec.load_header(fp)
+    if header is not None:
+        return np.lib.format.descr_to_dtype(header["dtype"]) == MySoapySDR.DTYPE
+    return not is_npy(fp)
+
+def load_trace(fp, custom_dtype=True):
+    """Load a single trace from the FP file, saved by save_trace(). Compressed
+    traces and traces saved by np.save() are detected automatically,
+    otherwise the trace is loaded using our custom dtype if CUSTOM_DTYPE is
+    True."""
+    trace = codec.load(fp)
+    if trace is not None:
+        return MySoapySDR.dtype_to_complex64(trace) if trace.dtype == MySoapySDR.DTYPE else trace
+    # NOTE: Never interpret the header of a Numpy file as samples.
+    return MySoapySDR.numpy_load(fp) if custom_dtype is True and not is_npy(fp) else np.load(fp)
+
+def save_pair_trace(dir, idx, nf, ff, custom_dtype=True, compression=None):
     """Save one pair of traces (NF & FF) located in directory DIR at index
-    IDX. If NF or FF are None, they are ignored. """
+    IDX. If NF or FF are None, they are ignored. See save_trace() for
+    CUSTOM_DTYPE and COMPRESSION."""
     if nf is not None:
-        if custom_dtype is True:
-            MySoapySDR.numpy_save(get_dataset_path_unpack_nf(dir, idx), nf)
-        else:
-            np.save(get_dataset_path_unpack_nf(dir, idx), nf)
+        save_trace(get_dataset_path_unpack_nf(dir, idx), nf, custom_dtype=custom_dtype, compression=compression)
     if ff is not None:
-        if custom_dtype is True:
-            MySoapySDR.numpy_save(get_dataset_path_unpack_ff(dir, idx), ff)
-        else:
-            np.save(get_dataset_path_unpack_ff(dir, idx), ff)
- 
+        save_trace(get_dataset_path_unpack_ff(dir, idx), ff, custom_dtype=custom_dtype, compression=compression)
+
 def load_pair_trace(dir, idx, nf=True, ff=True, custom_dtype=True):
     """Load one pair of traces (NF & FF) located in directory DIR at index IDX.
     Return a tuple composed of two lists containing each a single NF or FF
@@ -321,26 +502,21 @@ def load_pair_trace(dir, idx, nf=True, ff=True, custom_dtype=True):
     trace_nf = None
     trace_ff = None
     try:
-        if custom_dtype is True:
-            trace_nf = None if nf is False else MySoapySDR.numpy_load(get_dataset_path_unpack_nf(dir, idx))
-        else:
-            trace_nf = None if nf is False else np.load(get_dataset_path_unpack_nf(dir, idx)) 
+        trace_nf = None if nf is False else load_trace(get_dataset_path_unpack_nf(dir, idx), custom_dtype=custom_dtype)
     except Exception as e:
         l.LOGGER.warn(e)
     try:
-        if custom_dtype is True:
-            trace_ff = None if ff is False else MySoapySDR.numpy_load(get_dataset_path_unpack_ff(dir, idx))
-        else:
-            trace_ff = None if ff is False else np.load(get_dataset_path_unpack_ff(dir, idx))
+        trace_ff = None if ff is False else load_trace(get_dataset_path_unpack_ff(dir, idx), custom_dtype=custom_dtype)
     except Exception as e:
         l.LOGGER.warn(e)
     return [trace_nf], [trace_ff]
 
-def save_all_traces(dir, nf, ff, packed=False, start=0, stop=0, custom_dtype=True):
+def save_all_traces(dir, nf, ff, packed=False, start=0, stop=0, custom_dtype=True, compression=None):
     """Save traces in DIR. NF and FF can be a 2D np.array of shape (nb_traces,
     nb_samples) or None. If PACKED is set to True or if STOP is set to < 1,
     then all the traces are saved. Othserwise, START and STOP can be specified
-    to save a specific range of file to the disk.
+    to save a specific range of file to the disk. See save_trace() for
+    CUSTOM_DTYPE and COMPRESSION of an unpacked dataset.
 
     """
     l.LOGGER.info("saving traces...")
@@ -357,18 +533,13 @@ def save_all_traces(dir, nf, ff, packed=False, start=0, stop=0, custom_dtype=Tru
             stop = len(nf) if nf is not None else len(ff) 
         for i in tqdm(range(start, stop), desc="save all traces"):
             if nf is not None:
-                if custom_dtype is True:
-                    MySoapySDR.numpy_save(get_dataset_path_unpack_nf(dir, i), nf[i - start])
-                else:
-                    np.save(get_dataset_path_unpack_nf(dir, i), nf[i - start])
+                save_trace(get_dataset_path_unpack_nf(dir, i), nf[i - start], custom_dtype=custom_dtype, compression=compression)
             if ff is not None:
-                if custom_dtype is True:
-                    MySoapySDR.numpy_save(get_dataset_path_unpack_ff(dir, i), ff[i - start])
-                else:
-                    np.save(get_dataset_path_unpack_ff(dir, i), ff[i - start])
+                save_trace(get_dataset_path_unpack_ff(dir, i), ff[i - start], custom_dtype=custom_dtype, compression=compression)
+        get_manifest(dir, refresh=range(start, stop))
     l.LOGGER.info("done!")
 
-def load_all_traces(dir, start=0, stop=0, nf_wanted=True, ff_wanted=True, bar=True, start_point=0, end_point=0, custom_dtype=True):
+def load_all_traces(dir, start=0, stop=0, nf_wanted=True, ff_wanted=True, bar=True, start_point=0, end_point=0, custom_dtype=True, valid=None):
     """Load traces contained in DIR. Can be packed or unpacked. Return a 2D
     np.array of shape (nb_traces, nb_samples). START and STOP can be specified
     to load a specific range of file from the disk for an unpacked
@@ -382,6 +553,10 @@ def load_all_traces(dir, start=0, stop=0, nf_wanted=True, ff_wanted=True, bar=Tr
     during loading the traces. If END_POINT is set to different from 0, use it
     as end index during loading the traces.
 
+    If VALID is set to a validity bitmap (see load_valid()), invalid traces of
+    an unpacked dataset are skipped without being read, hence the returned
+    arrays only contain the valid traces.
+
     """
     l.LOGGER.info("Loading traces...")
     if is_dataset_packed(dir):
@@ -396,37 +571,32 @@ def load_all_traces(dir, start=0, stop=0, nf_wanted=True, ff_wanted=True, bar=Tr
     elif is_dataset_unpacked(dir):
         nf, ff = None, None
         stop = get_nb(dir) if stop < 1 else stop
-        nb = stop - start
+        idx = list(range(start, stop))
+        if valid is not None:
+            idx = [i for i, v in zip(idx, get_valid_range(valid, start, stop)) if v]
+        nb = len(idx)
         nf_exist = get_dataset_is_nf_exist(dir)
         ff_exist = get_dataset_is_ff_exist(dir)
         if nf_wanted is True and nf_exist is True:
             nf = [None] * nb
-            iterator = tqdm(range(start, stop), desc="Load NF traces") if bar else list(range(start, stop))
-            for i in iterator:
+            iterator = tqdm(idx, desc="Load NF traces") if bar else idx
+            for j, i in enumerate(iterator):
                 nf_p = get_dataset_path_unpack_nf(dir, i)
                 # NOTE: Make sure "copy" is enabled to not overflow the memory
                 # after truncating loaded trace.
-                loaded_trace = None
-                if custom_dtype is True:
-                    loaded_trace = MySoapySDR.numpy_load(nf_p)
-                else:
-                    loaded_trace = np.load(nf_p)
-                nf[i - start] = truncate(loaded_trace, start=start_point, end=end_point, copy=True)
+                loaded_trace = load_trace(nf_p, custom_dtype=custom_dtype)
+                nf[j] = truncate(loaded_trace, start=start_point, end=end_point, copy=True)
         else:
              l.LOGGER.warning("No loaded NF traces!")
         if ff_wanted is True and ff_exist is True:
             ff = [None] * nb
-            iterator = tqdm(range(start, stop), desc="Load FF traces") if bar else list(range(start, stop))
-            for i in iterator:
+            iterator = tqdm(idx, desc="Load FF traces") if bar else idx
+            for j, i in enumerate(iterator):
                 ff_p = get_dataset_path_unpack_ff(dir, i)
                 # NOTE: Make sure "copy" is enabled to not overflow the memory
                 # after truncating loaded trace.
-                loaded_trace = None
-                if custom_dtype is True:
-                    loaded_trace = MySoapySDR.numpy_load(ff_p)
-                else:
-                    loaded_trace = np.load(ff_p)
-                ff[i - start] = truncate(loaded_trace, start=start_point, end=end_point, copy=True)
+                loaded_trace = load_trace(ff_p, custom_dtype=custom_dtype)
+                ff[j] = truncate(loaded_trace, start=start_point, end=end_point, copy=True)
         else:
             l.LOGGER.warning("No loaded FF traces!")
         if nf_exist or ff_exist:
@@ -439,6 +609,70 @@ def load_all_traces(dir, start=0, stop=0, nf_wanted=True, ff_wanted=True, bar=Tr
         l.LOGGER.error("Unknown dataset format!")
         return None, None
 
+def load_trace_comps(fp, comps, start_point=0, end_point=0, outs=None, nb_samples=None):
+    """Load a single trace saved using our custom dtype from the FP file
+    directly as the COMPS list of components (see
+    MySoapySDR.dtype_to_comps()), compressed or not.
+
+    Only the samples between START_POINT and END_POINT (see truncate()) are
+    read from an uncompressed trace. Return a list of 1D np.ndarray of
+    np.float32, written into OUTS if given, or None if NB_SAMPLES is given and
+    the truncated trace does not contain NB_SAMPLES samples.
+
+    """
+    trace = codec.load(fp)
+    if trace is None and is_npy(fp):
+        trace = truncate(np.load(fp), start=start_point, end=end_point)
+    elif trace is None:
+        count = -1 if end_point == 0 else end_point - start_point
+        trace = np.fromfile(fp, dtype=MySoapySDR.DTYPE, count=count, offset=start_point * MySoapySDR.DTYPE.itemsize)
+    else:
+        trace = truncate(trace, start=start_point, end=end_point)
+    if nb_samples is not None and len(trace) != nb_samples:
+        return None
+    return MySoapySDR.dtype_to_comps(trace, comps, outs=outs)
+
+def load_all_traces_comps(dir, comps, start=0, stop=0, start_point=0, end_point=0, bar=True, valid=None):
+    """Load the FF traces of an unpacked dataset saved using our custom dtype
+    directly as the COMPS list of components (complex.CompType or their
+    names). Return a list of 2D np.array of np.float32 of shape (nb_traces,
+    nb_samples), one per component.
+
+    Compared to load_all_traces() followed by complex.get_comp(), the I/Q
+    samples of every trace are converted into the rows of the returned arrays
+    without keeping the np.complex64 traces in memory, and traces are loaded
+    in parallel by a pool of threads. A trace whose length differs from the
+    first one is filled with zeroes.
+
+    START, STOP, START_POINT, END_POINT and VALID are used as in
+    load_all_traces().
+
+    """
+    l.LOGGER.info("Loading traces...")
+    stop = get_nb(dir) if stop < 1 else stop
+    idx = list(range(start, stop))
+    if valid is not None:
+        idx = [i for i, v in zip(idx, get_valid_range(valid, start, stop)) if v]
+    if len(idx) == 0:
+        l.LOGGER.error("No loaded traces!")
+        return [np.zeros((0, 0), dtype=np.float32) for _ in comps]
+    # NOTE: The first trace gives the number of samples of all traces.
+    first = load_trace_comps(get_dataset_path_unpack_ff(dir, idx[0]), comps, start_point=start_point, end_point=end_point)
+    outs = [np.empty((len(idx), len(f)), dtype=np.float32) for f in first]
+    for out, f in zip(outs, first):
+        out[0] = f
+    def load_row(j):
+        if load_trace_comps(get_dataset_path_unpack_ff(dir, idx[j]), comps, start_point=start_point, end_point=end_point,
+                            outs=[out[j] for out in outs], nb_samples=outs[0].shape[1]) is None:
+            l.LOGGER.warning("Trace #{} does not contain {} samples, fill it with zeroes".format(idx[j], outs[0].shape[1]))
+            for out in outs:
+                out[j] = 0
+    rows = codec.get_pool().map(load_row, range(1, len(idx)))
+    for _ in tqdm(rows, total=len(idx) - 1, desc="Load FF traces") if bar else rows:
+        pass
+    l.LOGGER.info("Done!")
+    return outs
+
 def reshape_trimming_zeroes():
     """I don't need it, but in case of future needs...
     np.trim_zeros:
@@ -0,0 +1,117 @@
+"""Chained processing stages of a dataset.
+
+A pipeline is a list of stages applied one after the other to every trace of
+a subset, in a single pass of a DatasetProcessing over the input dataset, such
+that only the output of the last stage is saved on disk. Resuming and bad
+entries tracking are the ones of DatasetProcessing.
+
+Stages are applied in the order of STAGES:
+- extract: Extract a single aligned AES (see analyze.extract_aes()).
+- average: Average all the AES (see analyze.average_aes()).
+- align: Align the trace against the template of the subset, which is the
+  processed trace #0 if the pipeline does not start with extract or average.
+- comp: Select a component of the trace (e.g. amplitude).
+- truncate: Keep the samples between a start and an end index.
+- normalize: Normalize the trace using a Z-score normalization (real traces
+  only, hence requires comp).
+- compress: Save the trace using our custom dtype (complex traces only).
+
+"""
+
+import lib.analyze as analyze
+import lib.complex as complex
+
+# * Constants
+
+# Available stages, in order of application.
+STAGES = ["extract", "average", "align", "comp", "truncate", "normalize", "compress"]
+# Stages producing real traces from complex traces.
+STAGES_REAL = ["comp"]
+
+# * Stages
+
+# Every stage has the signature FUNC(trace, dset, sset, plot, opts), where
+# TRACE is the trace produced by the previous stage, DSET the Dataset, SSET the
+# Subset, PLOT the plot switch and OPTS the dictionary of options of the
+# pipeline. It returns the processed trace or None on error.
+
+def stage_extract(trace, dset, sset, plot, opts):
+    ff, sset.template = analyze.extract_aes(trace, dset.samp_rate, opts["nb_aes"], opts["template"] if sset.template is None else sset.template,
+                                            opts["idx"], opts["window"], plot_enable=plot)
+    return ff
+
+def stage_average(trace, dset, sset, plot, opts):
+    ff, sset.template = analyze.average_aes(trace, dset.samp_rate, opts["nb_aes"], opts["template"] if sset.template is None else sset.template,
+                                            plot_enable=plot)
+    return ff
+
+def stage_align(trace, dset, sset, plot, opts):
+    # NOTE: The template is set while processing trace #0 in the main
+    # process, hence before the workers are started.
+    if sset.template is None:
+        sset.template = trace
+    return analyze.align(sset.template, trace, dset.samp_rate)
+
+def stage_comp(trace, dset, sset, plot, opts):
+    return complex.get_comp(trace, opts["comptype"])
+
+def stage_truncate(trace, dset, sset, plot, opts):
+    return trace[opts["start"]:opts["end"] if opts["end"] != 0 else len(trace)]
+
+def stage_normalize(trace, dset, sset, plot, opts):
+    return analyze.normalize_zscore(trace)
+
+def stage_compress(trace, dset, sset, plot, opts):
+    # NOTE: The compression is applied by DatasetProcessing when saving.
+    return trace
+
+# Functions of the stages.
+FUNCTIONS = {
+    "extract": stage_extract,
+    "average": stage_average,
+    "align": stage_align,
+    "comp": stage_comp,
+    "truncate": stage_truncate,
+    "normalize": stage_normalize,
+    "compress": stage_compress,
+}
+
+# * Functions
+
+def parse(spec):
+    """Return the list of stages of the comma-separated SPEC string, checking
+    that they exist and are given in the order of STAGES. Raise an Exception
+    otherwise."""
+    stages = [s.strip() for s in spec.split(",") if s.strip() != ""]
+    if len(stages) == 0:
+        raise Exception("The pipeline should contain at least one stage!")
+    for s in stages:
+        if s not in STAGES:
+            raise Exception("Unknown pipeline stage: {} (available: {})".format(s, ", ".join(STAGES)))
+    order = [STAGES.index(s) for s in stages]
+    if order != sorted(set(order)):
+        raise Exception("Pipeline stages should be unique and ordered as: {}".format(" -> ".join(STAGES)))
+    if "extract" in stages and "average" in stages:
+        raise Exception("The extract and average stages are mutually exclusive!")
+    # NOTE: analyze.normalize_zscore() only supports real traces.
+    if "normalize" in stages and "comp" not in stages:
+        raise Exception("The normalize stage requires real traces, add the comp stage before it!")
+    if "compress" in stages and any(s in stages for s in STAGES_REAL):
+        raise Exception("The compress stage requires complex traces, incompatible with: {}".format(", ".join(STAGES_REAL)))
+    return stages
+
+def pipeline_dproc(dset, sset, plot, args):
+    """Run the stages of a pipeline for the DatasetProcessing class.
+
+    ARGS is a tuple of the list of stages (see parse()) and the dictionary of
+    options of the stages. Return the trace processed by all the stages, or
+    None as soon as a stage fails.
+
+    """
+    stages, opts = args
+    trace = sset.ff[0]
+    for s in stages:
+        trace = FUNCTIONS[s](trace, dset, sset, plot, opts)
+        if trace is None:
+            return None
+    return trace
@@ -0,0 +1,170 @@
+"""Structured records of attack results.
+
+Every attack builds a record (configuration, metrics of its stages, per-byte
+PGE and HD, best guess, key rank bounds, scores) which is appended as a single
+JSON line to a results store, by default located in the dataset directory.
+Appends are serialized using a file lock, such that parallel attacks can share
+the same store, and records can be aggregated later without parsing the
+standard output.
+
+"""
+
+import contextlib
+import datetime
+import fcntl
+import json
+import os
+from os import path
+import socket
+
+import numpy as np
+
+import lib.log as l
+import lib.instrument as instrument
+
+# * Constants
+
+# File name of the results store inside a dataset directory.
+RESULTS_FN = "results.jsonl"
+
+# * Functions
+
+def to_json(obj):
+    """Convert OBJ containing Numpy types into native Python types which can
+    be serialized in JSON."""
+    if isinstance(obj, dict):
+        return {str(k): to_json(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_json(v) for v in obj]
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+def get_path(dirpath):
+    """Return the path of the results store inside the DIRPATH directory."""
+    return path.join(dirpath, RESULTS_FN)
+
+def append(fp, record):
+    """Append the RECORD dictionary as a single JSON line to the FP results
+    store, holding an exclusive lock during the write."""
+    line = json.dumps(to_json(record)) + "\n"
+    with open(fp, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def load(fp, command=None):
+    """Load the records of the FP results store as a list of dictionaries.
+    If COMMAND is set, only keep the records of this command. Lines which
+    cannot be decoded (e.g. truncated by a crash) are skipped."""
+    records = []
+    with open(fp, "r") as f:
+        fcntl.flock(f, fcntl.LOCK_SH)
+        lines = f.readlines()
+        fcntl.flock(f, fcntl.LOCK_UN)
+    for i, line in enumerate(lines):
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            l.LOGGER.warning("Skip invalid record at line {} of {}".format(i + 1, fp))
+            continue
+        if command is None or record.get("command") == command:
+            records.append(record)
+    return records
+
+def flatten(record, prefix=""):
+    """Flatten the nested dictionaries of RECORD into a single dictionary
+    whose keys are joined with dots (e.g. config.num_traces)."""
+    flat = {}
+    for k, v in record.items():
+        if isinstance(v, dict):
+            flat.update(flatten(v, prefix + k + "."))
+        else:
+            flat[prefix + k] = v
+    return flat
+
+def export(records, fp, fields=None):
+    """Export the RECORDS into FP, either a CSV file or a Parquet file
+    (requires pandas and a Parquet engine) depending on its extension. If
+    FIELDS is set to a list of flattened keys, only export those fields."""
+    rows = [flatten(r) for r in records]
+    if fields is None:
+        fields = []
+        for row in rows:
+            fields += [k for k in row if k not in fields]
+    if path.splitext(fp)[1] == ".parquet":
+        import pandas as pd
+        pd.DataFrame([{k: row.get(k) for k in fields} for row in rows], columns=fields).to_parquet(fp)
+        return
+    with open(fp, "w") as f:
+        f.write(";".join(fields) + "\n")
+        for row in rows:
+            f.write(";".join("" if row.get(k) is None else json.dumps(row.get(k)) for k in fields) + "\n")
+
+# * Classes
+
+class Record():
+    """Result record of a single attack."""
+
+    def __init__(self, command, config):
+        """Initialize a record for the COMMAND attack using the CONFIG
+        dictionary of options."""
+        self.data = {
+            "command": command,
+            "date": datetime.datetime.now().isoformat(),
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "config": to_json(config),
+            "stages": {},
+        }
+        self.start = instrument.snapshot()
+        # Names of the currently running (nested) stages.
+        self.running = []
+
+    def set(self, **kwargs):
+        """Set the fields given as keyword arguments."""
+        self.data.update(to_json(kwargs))
+
+    def set_config(self, config):
+        """Update the configuration using the CONFIG dictionary."""
+        self.data["config"].update(to_json(config))
+
+    def has_result(self):
+        """Return True if an attack result has been recorded."""
+        return "pge" in self.data or "rank_rounded" in self.data
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager recording the metrics of the NAME stage (see
+        instrument.measure()). Stages run inside another stage are recorded
+        as PARENT/NAME and stages run multiple times are accumulated."""
+        self.running.append(name)
+        key = "/".join(self.running)
+        # NOTE: Insert the key now to list parent stages before their children.
+        self.data["stages"].setdefault(key, None)
+        start = instrument.snapshot()
+        try:
+            yield self
+        finally:
+            self.running.pop()
+            metrics = instrument.measure(start, instrument.snapshot())
+            self.data["stages"][key] = instrument.accumulate(self.data["stages"].get(key), metrics)
+
+    def close(self):
+        """Record the metrics of the whole command as the total stage."""
+        self.data["stages"]["total"] = instrument.accumulate(None, instrument.measure(self.start, instrument.snapshot()))
+
+    def summary(self):
+        """Return the summary table of the recorded stages."""
+        return instrument.format_table(self.data["stages"])
+
+    def save(self, fp):
+        """Append the record to the FP results store."""
+        append(fp, self.data)
+        l.LOGGER.info("Result record appended to '{}'".format(fp))
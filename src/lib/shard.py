@@ -0,0 +1,225 @@
+"""Sharded processing of a subset across processes or hosts.
+
+A subset is split into shards of consecutive trace indexes by a plan saved in
+the shard directory of the output dataset (see get_dir()). Workers sharing this
+directory (e.g. a local directory or a network file system) claim the shards
+one by one by creating a claim file using O_CREAT | O_EXCL, which is atomic,
+such that every shard is processed by a single worker without any scheduler.
+
+Each shard saves its own state (resuming index and bad entries) instead of the
+pickled dataset, and the template of the subset is published once by the shard
+processing trace #0, such that all shards use the same template. Once all
+shards are done, their states are merged into the output dataset (see
+merge()), independently of the order in which they have been processed.
+
+Files of the shard directory:
+- plan.json: Subset name, stop index and [start, stop[ ranges of the shards.
+- template.pickle: Template and reference of the subset and their hash.
+- claim_K: Claim of shard K, containing the host and the PID of its worker.
+- state_K.json: State of shard K.
+
+"""
+
+import os
+from os import path
+import json
+import pickle
+import socket
+import time
+
+import lib.log as l
+
+# * Constants
+
+# Name of the directory containing the shard directories of the subsets.
+DIRNAME = "shards"
+PLAN_FILENAME = "plan.json"
+TEMPLATE_FILENAME = "template.pickle"
+CLAIM_FILENAME = "claim_{}"
+STATE_FILENAME = "state_{}.json"
+# Period between two checks of the template while waiting for it [s].
+WAIT_PERIOD = 1
+
+# * Files
+
+def get_dir(outdir, subset):
+    """Return the shard directory of the SUBSET name in the OUTDIR dataset."""
+    return path.join(outdir, DIRNAME, subset)
+
+def write_atomic(fp, data):
+    """Write the DATA bytes into FP, such that other workers never read a
+    truncated file."""
+    fp_tmp = "{}.{}.{}.tmp".format(fp, socket.gethostname(), os.getpid())
+    with open(fp_tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(fp_tmp, fp)
+
+def load_json(fp):
+    """Return the JSON content of FP, or None if it does not exist."""
+    if not path.exists(fp):
+        return None
+    with open(fp, "r") as f:
+        return json.load(f)
+
+# * Plan
+
+def plan(dir, subset, stop, size):
+    """Split the traces of the SUBSET name from #0 to STOP (excluded) into
+    shards of SIZE traces and save the plan into DIR. Return the plan."""
+    assert size > 0, "Shards should contain at least one trace!"
+    os.makedirs(dir, exist_ok=True)
+    shards = [[start, min(start + size, stop)] for start in range(0, stop, size)]
+    plan = {"subset": subset, "stop": stop, "shards": shards}
+    write_atomic(path.join(dir, PLAN_FILENAME), json.dumps(plan).encode())
+    return plan
+
+def load_plan(dir):
+    """Return the plan saved in DIR, or None if there is none."""
+    return load_json(path.join(dir, PLAN_FILENAME))
+
+# * Claims
+
+def claim(dir, k):
+    """Try to claim shard K in DIR. Return True if it has been claimed by the
+    current process, False if it was already claimed."""
+    try:
+        fd = os.open(path.join(dir, CLAIM_FILENAME.format(k)), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        json.dump({"host": socket.gethostname(), "pid": os.getpid(), "time": time.time()}, f)
+    return True
+
+def release(dir, k):
+    """Release the claim of shard K in DIR, such that another worker can
+    resume it."""
+    fp = path.join(dir, CLAIM_FILENAME.format(k))
+    if path.exists(fp):
+        os.remove(fp)
+
+def reclaim(dir, k):
+    """Try to claim shard K in DIR if its claim is stale, i.e. its worker ran on
+    the current host and is not running anymore. Return True if it has been
+    claimed by the current process, False otherwise.
+
+    Claims of other hosts are never considered as stale, their claim file has
+    to be removed manually to process the shard again.
+
+    """
+    fp = path.join(dir, CLAIM_FILENAME.format(k))
+    try:
+        owner = load_json(fp)
+    except (OSError, json.JSONDecodeError):
+        # NOTE: The claim file is being written.
+        return False
+    if owner is None or owner["host"] != socket.gethostname():
+        return False
+    try:
+        os.kill(owner["pid"], 0)
+        return False
+    except ProcessLookupError:
+        pass
+    except PermissionError:
+        return False
+    # NOTE: Only one worker succeeds to rename the stale claim.
+    try:
+        os.replace(fp, "{}.stale.{}".format(fp, os.getpid()))
+    except FileNotFoundError:
+        return False
+    os.remove("{}.stale.{}".format(fp, os.getpid()))
+    l.LOGGER.warning("Reclaim shard #{} of dead worker {}".format(k, owner["pid"]))
+    return claim(dir, k)
+
+def claim_next(dir, plan):
+    """Claim the first shard of PLAN in DIR which is neither done nor claimed
+    by a running worker. Return its index, or None if there is none."""
+    for k, (start, stop) in enumerate(plan["shards"]):
+        if is_done(dir, k, stop):
+            continue
+        if claim(dir, k) or reclaim(dir, k):
+            # NOTE: The shard may have been finished since the check.
+            if is_done(dir, k, stop):
+                continue
+            return k
+    return None
+
+# * States
+
+def save_state(dir, k, dirty_idx, bad_entries, template):
+    """Save the state of shard K into DIR: the DIRTY_IDX index of the first
+    trace not processed yet, the BAD_ENTRIES list of bad entries and the hash
+    of the TEMPLATE used for processing."""
+    state = {"dirty_idx": int(dirty_idx), "bad_entries": sorted(int(i) for i in bad_entries), "template": template}
+    write_atomic(path.join(dir, STATE_FILENAME.format(k)), json.dumps(state).encode())
+
+def load_state(dir, k):
+    """Return the state of shard K saved in DIR, or None if there is none."""
+    return load_json(path.join(dir, STATE_FILENAME.format(k)))
+
+def is_done(dir, k, stop):
+    """Return True if shard K of DIR stopping at trace index STOP is done."""
+    state = load_state(dir, k)
+    return state is not None and state["dirty_idx"] >= stop
+
+# * Template
+
+def publish_template(dir, template, reference, key):
+    """Publish the TEMPLATE and the REFERENCE of the subset into DIR, along
+    with their KEY hash, if not already published."""
+    if not path.exists(path.join(dir, TEMPLATE_FILENAME)):
+        write_atomic(path.join(dir, TEMPLATE_FILENAME),
+                     pickle.dumps({"template": template, "reference": reference, "key": key}))
+
+def load_template(dir):
+    """Return the dictionary published by publish_template() in DIR, or None
+    if not published yet."""
+    fp = path.join(dir, TEMPLATE_FILENAME)
+    if not path.exists(fp):
+        return None
+    with open(fp, "rb") as f:
+        return pickle.load(f)
+
+def wait_template(dir):
+    """Return the dictionary published by publish_template() in DIR, waiting
+    for the shard processing trace #0 to publish it."""
+    published = load_template(dir)
+    if published is None:
+        l.LOGGER.info("Wait for the template published by the shard processing trace #0...")
+    while published is None:
+        time.sleep(WAIT_PERIOD)
+        published = load_template(dir)
+    return published
+
+# * Merge
+
+def merge(dir):
+    """Merge the shards of DIR.
+
+    Return a tuple composed of the plan, the dictionary published by
+    publish_template() and the sorted list of the bad entries of all shards.
+    Raise an Exception if a shard is not done or has been processed using
+    another template than the published one.
+
+    """
+    plan = load_plan(dir)
+    if plan is None:
+        raise Exception("No shard plan in '{}'!".format(dir))
+    published = load_template(dir)
+    if published is None:
+        raise Exception("No template published in '{}', the shard processing trace #0 is not done!".format(dir))
+    bad_entries = set()
+    missing = []
+    for k, (start, stop) in enumerate(plan["shards"]):
+        state = load_state(dir, k)
+        if state is None or state["dirty_idx"] < stop:
+            missing.append(k)
+            continue
+        if state["template"] != published["key"]:
+            raise Exception("Shard #{} has been processed using another template!".format(k))
+        bad_entries.update(state["bad_entries"])
+    if missing:
+        raise Exception("{} shards are not done: {} (remove the claim file of a dead worker to process its shard again)".format(
+            len(missing), ", ".join("#{}".format(k) for k in missing)))
+    return plan, published, sorted(bad_entries)
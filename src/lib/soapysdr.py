@@ -236,6 +236,9 @@ class MySoapySDR():
     # XXX: May be simpler to use np.float16?
     # To not waste space but get ride of int <-> float casting/rescaling? Since
     # we need float anyway for signal processing...
+    # Number of samples converted at once by dtype_to_comps(), small enough
+    # for the temporary np.complex64 buffer to stay in the CPU cache.
+    COMPS_CHUNK = 2 ** 14
 
     # Default length (power of 2) of RX temporary buffer. This length
     # corresponds to the number of samples.
@@ -285,6 +288,36 @@ class MySoapySDR():
         """
         return MySoapySDR.dtype_to_complex64(np.fromfile(file, dtype=MySoapySDR.DTYPE))
 
+    @staticmethod
+    def dtype_to_comps(arr, comps, outs=None):
+        """Convert an array from our custom DTYPE (or np.complex64) to the COMPS
+        list of components (complex.CompType or their names).
+
+        Return a list of 1D np.ndarray of np.float32, one per component,
+        written into the OUTS list of arrays if given. The conversion is
+        performed by chunks of COMPS_CHUNK samples, such that the np.complex64
+        representation of the whole array is never allocated, while giving
+        the same values than complex.get_comp().
+
+        """
+        comps = [complex.CompType[c] if isinstance(c, str) else c for c in comps]
+        outs = [np.empty(len(arr), dtype=np.float32) for _ in comps] if outs is None else outs
+        buf = np.empty(min(len(arr), MySoapySDR.COMPS_CHUNK), dtype=np.complex64)
+        for start in range(0, len(arr), MySoapySDR.COMPS_CHUNK):
+            chunk = arr[start:start + MySoapySDR.COMPS_CHUNK]
+            z = buf[:len(chunk)]
+            if arr.dtype == MySoapySDR.DTYPE:
+                z.view(np.float32)[:] = chunk.view(np.int16)
+            else:
+                z[:] = chunk
+            for comp, out in zip(comps, outs):
+                if comp == complex.CompType.AMPLITUDE:
+                    np.abs(z, out=out[start:start + len(chunk)])
+                else:
+                    # NOTE: Same as np.angle(), which has no OUT parameter.
+                    np.arctan2(z.imag, z.real, out=out[start:start + len(chunk)])
+        return outs
+
     @staticmethod
     def dtype_to_complex64(arr):
         """Convert an array from our custom DTYPE to a standard np.complex64
@@ -0,0 +1,168 @@
+"""Synthetic datasets of leaking AES computations.
+
+Generate traces of an AES whose first round S-Box output leaks into the
+amplitude and the phase of the signal, and write them as a regular Dataset on
+disk (same directory layout, custom dtype and inputs as a recorded dataset),
+such that the processing and attack code can be run without recordings.
+
+Two kinds of traces can be generated:
+- Extracted traces, containing a single AES computation, equivalent to the
+  output of the average or extract commands of dataset.py.
+- Raw traces, containing several AES computations of the same inputs separated
+  by a carrier which is interrupted during each computation, equivalent to the
+  traces recorded by the radio and detected by analyze.find_aes_configured().
+
+"""
+
+import os
+
+import numpy as np
+
+import lib.dataset as dataset
+import lib.load as load
+import lib.log as l
+import lib.keyenum as keyenum
+
+# * Constants
+
+# Available leakage models of the S-Box output.
+LEAKAGES = ["hw", "identity"]
+# Hamming weight of every byte value.
+HW = np.array([bin(n).count("1") for n in range(256)], dtype=np.uint8)
+# Scaling of the signal before saving it using the custom dtype of np.int16.
+SCALE = 2 ** 10
+# Frequency of the carrier interrupted during AES computations [Hz]. It lies
+# inside the band-pass filter of analyze.find_aes_configured().
+CARRIER_FREQ = 2.75e6
+# Duration of the carrier interruption preceding the leaking samples of an AES
+# computation in raw traces [s], as expected by the offset of
+# analyze.find_aes_configured().
+CARRIER_OFF = 2e-4
+# Duration of the carrier between two AES computations in raw traces [s].
+CARRIER_ON = 4e-4
+# Relative amplitude of the fixed pattern of an AES computation, on which the
+# traces can be aligned.
+PATTERN = 0.1
+# Number of traces generated at once.
+CHUNK = 256
+
+# * Functions
+
+def get_pois(nb_samples, width=1):
+    """Return the default leaking samples of the 16 key bytes, evenly spread
+    over a trace of NB_SAMPLES samples with a leakage of WIDTH samples."""
+    step = nb_samples // 17
+    assert step >= width, "Traces are too short for 16 leaking bytes!"
+    return step * np.arange(1, 17)
+
+def get_pattern(nb_samples):
+    """Return the fixed pattern of an AES computation of NB_SAMPLES samples,
+    i.e. the signal common to all traces without leakage nor noise, as a 1D
+    np.array of float32."""
+    # NOTE: Use a fixed seed to get the same pattern for all subsets and datasets.
+    pattern = np.random.default_rng(0).standard_normal(nb_samples)
+    pattern = np.convolve(pattern, np.ones(4) / 4, mode="same")
+    return (1 + PATTERN * pattern / np.std(pattern)).astype(np.float32)
+
+def get_leakage(pt, ks, leakage="hw"):
+    """Return the leakage of the S-Box output for the plaintexts PT and keys
+    KS (2D np.array of shape (nb_traces, 16)) as a 2D np.array of float32
+    normalized in [0, 1], using the LEAKAGE model in LEAKAGES."""
+    assert leakage in LEAKAGES, "Unknown leakage model: {}".format(leakage)
+    sbox_out = keyenum.SBOX[np.bitwise_xor(pt, ks)]
+    if leakage == "hw":
+        return HW[sbox_out].astype(np.float32) / 8
+    return sbox_out.astype(np.float32) / 255
+
+def generate(pt, ks, nb_samples, pois, width=1, leakage="hw", amplitude=0.1, noise=0.02, jitter=0, rng=None):
+    """Generate extracted traces of an AES computation.
+
+    PT and KS are the inputs (2D np.array of shape (nb_traces, 16)). Each key
+    byte leaks during WIDTH samples starting at the index stored in POIS, with
+    the LEAKAGE model and an AMPLITUDE relative to the signal level, into both
+    the amplitude and the phase, on top of the pattern of get_pattern(). A gaussian NOISE of relative standard
+    deviation is added. Each trace is randomly shifted by at most JITTER
+    samples. RNG is a np.random.Generator.
+
+    Return a 2D np.array of shape (nb_traces, NB_SAMPLES) of np.complex64.
+
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    nb = len(pt)
+    leak = amplitude * get_leakage(pt, ks, leakage)
+    amp = get_pattern(nb_samples) + noise * rng.standard_normal((nb, nb_samples), dtype=np.float32)
+    phase = noise * rng.standard_normal((nb, nb_samples), dtype=np.float32)
+    for b, poi in enumerate(pois):
+        amp[:, poi:poi + width] += leak[:, b, None]
+        phase[:, poi:poi + width] += leak[:, b, None]
+    if jitter > 0:
+        shifts = rng.integers(-jitter, jitter + 1, size=(nb, 1))
+        idx = (np.arange(nb_samples) - shifts) % nb_samples
+        amp = np.take_along_axis(amp, idx, axis=1)
+        phase = np.take_along_axis(phase, idx, axis=1)
+    return (SCALE * amp * np.exp(1j * phase)).astype(np.complex64)
+
+def generate_raw(traces, nb_aes, samp_rate, noise=0.02, rng=None):
+    """Generate raw traces from extracted TRACES (see generate()).
+
+    Every raw trace repeats NB_AES times its extracted trace, each one
+    preceded by a carrier interruption, such that the AES computations can be
+    found by analyze.find_aes_configured() for a SAMP_RATE sampling rate. NOISE
+    and RNG are used as in generate().
+
+    Return a 2D np.array of shape (nb_traces, nb_samples_raw) of np.complex64.
+
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    nb, nb_samples = traces.shape
+    on, off = int(CARRIER_ON * samp_rate), int(CARRIER_OFF * samp_rate)
+    period = on + off + nb_samples
+    t = np.arange(nb_aes * period + on) / samp_rate
+    carrier = 1 + 0.5 * np.cos(2 * np.pi * CARRIER_FREQ * t).astype(np.float32)
+    amp = SCALE * (carrier + noise * rng.standard_normal((nb, len(t)), dtype=np.float32))
+    raw = amp.astype(np.complex64)
+    for i in range(nb_aes):
+        start = on + i * period
+        raw[:, start:start + off] = SCALE * (1 + noise * rng.standard_normal((nb, off), dtype=np.float32))
+        raw[:, start + off:start + off + nb_samples] = traces
+    return raw
+
+def create(outdir, nb_train, nb_attack, nb_samples=1000, pois=None, width=1, leakage="hw", amplitude=0.1, noise=0.02, jitter=0,
+           nb_aes=0, samp_rate=8e6, custom_dtype=True, seed=0, compression=None):
+    """Create a synthetic dataset in the OUTDIR directory.
+
+    The train subset of NB_TRAIN traces uses random keys and the attack subset
+    of NB_ATTACK traces a fixed key, both with random plaintexts (a subset of 0
+    traces is not created). If NB_AES is 0, traces are extracted traces of
+    NB_SAMPLES samples, otherwise raw traces of NB_AES AES computations.
+    SAMP_RATE is the sampling rate of the dataset. Traces are saved using our
+    custom dtype if CUSTOM_DTYPE is True, compressed if COMPRESSION is set (see
+    codec.parse()). SEED initializes the random number generator. See
+    generate() for the other arguments.
+
+    Return the created Dataset.
+
+    """
+    rng = np.random.default_rng(seed)
+    pois = get_pois(nb_samples, width) if pois is None else np.asarray(pois)
+    assert len(pois) == 16 and np.max(pois) + width <= nb_samples, "Leaking samples should be inside the traces!"
+    os.makedirs(outdir, exist_ok=True)
+    dset = dataset.Dataset("synthetic", outdir, samp_rate)
+    if nb_train > 0:
+        dset.add_subset("train", dataset.SubsetType.TRAIN, dataset.InputGeneration.INIT_TIME, None, nb_trace_wanted=nb_train)
+    if nb_attack > 0:
+        dset.add_subset("attack", dataset.SubsetType.ATTACK, dataset.InputGeneration.INIT_TIME, None, nb_trace_wanted=nb_attack)
+    dset.create_dirsave()
+    for sset in (sset for sset in (dset.train_set, dset.attack_set) if sset is not None):
+        pt = np.asarray(sset.pt, dtype=np.uint8)
+        ks = np.asarray(sset.ks, dtype=np.uint8)
+        ks = np.repeat(ks, len(pt), axis=0) if len(ks) == 1 else ks
+        for i in range(0, len(pt), CHUNK):
+            traces = generate(pt[i:i + CHUNK], ks[i:i + CHUNK], nb_samples, pois, width, leakage, amplitude, noise, jitter, rng)
+            if nb_aes > 0:
+                traces = generate_raw(traces, nb_aes, samp_rate, noise, rng)
+            for j, trace in enumerate(traces):
+                load.save_pair_trace(sset.get_path(save=True), i + j, None, trace, custom_dtype=custom_dtype, compression=compression)
+        l.LOGGER.info("Generated {} traces into '{}'".format(len(pt), sset.get_path(save=True)))
+    dset.pickle_dump(force=True)
+    return dset
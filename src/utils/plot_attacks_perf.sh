@@ -8,6 +8,8 @@
 
 # Output CSV file for Python.
 OUTFILE="attack_results.csv"
+# Results store in which attacks append their records.
+RESULTS="attack_results.jsonl"
 # Dataset path.
 DATASET="/home/drac/storage/dataset/240112_multi-leak-insub-1m-lna_avg"
 # Profile path.
@@ -15,35 +17,20 @@ PROFILE="$DATASET"/profile_pois_1
 
 # * CSV building
 
-# Write header.
-echo "trace_nb;log2(key_rank);correct_bytes;pge_median" > "$OUTFILE"
-
 function iterate() {
     i_start=$1
     i_step=$2
     i_end=$(($3 - 1 ))
     # Iteration over number of traces.
     for num_traces in $(seq $i_start $i_step $i_end); do
-        # Write number of traces.
-        echo -n "$num_traces;" | tee -a "$OUTFILE"
-
-        # Attack and extract:
-        # 1) The key rank
-        # 2) The correct number of bytes.
-        # 3) The median of the PGE
+        echo "num_traces=$num_traces"
+        # Attack and append the result record (key rank, correct number of
+        # bytes, PGE...) to the results store.
         ./attack.py --no-log --no-plot --norm --dataset-path "$DATASET" \
-                    --start-point 740 --end-point 1140 --num-traces $num_traces attack \
+                    --start-point 740 --end-point 1140 --num-traces $num_traces \
+                    --result-path "$RESULTS" attack \
                     --attack-algo pcc --profile "$PROFILE" \
-                    --num-pois 1 --poi-spacing 2 --variable p_xor_k --align 2>/dev/null \
-            | grep -E 'actual rounded|CORRECT|MEDIAN' \
-            | cut -f 2 -d ':' \
-            | tr -d ' ' \
-            | tr '[\n]' '[;]' \
-            | sed 's/2^//' \
-            | sed 's/;$//' \
-            | tee -a "$OUTFILE"
-
-        echo "" | tee -a "$OUTFILE"
+                    --num-pois 1 --poi-spacing 2 --variable p_xor_k --align 2>/dev/null
     done
 }
 
@@ -64,4 +51,12 @@ function iterate_long() {
     iterate 10000 250 $((15000 + 1))
 }
 
+# Start from an empty results store, otherwise records of previous runs are
+# exported along with the new ones.
+rm -f "$RESULTS"
+
 iterate_long
+
+# Export the records as CSV with the columns expected by plot_attacks_perf.py.
+./attack.py --no-log --result-path "$RESULTS" results-export "$OUTFILE" --command attack \
+            --fields config.num_traces,rank_rounded,correct_bytes,pge_median